@@ -1,28 +1,44 @@
 import streamlit as st
-from google import genai
-from google.genai import types
-from typing import Optional
-import random
-import json
+import copy
 import os
-import base64
-import io
+import time
+import asyncio
+import uuid
 from datetime import datetime
-from utils.load_env import load_api_key_from_env
-import matplotlib.pyplot as plt
-import matplotlib
-
-matplotlib.use('Agg')  # Use non-interactive backend
-
-_ENV_FILE_ = os.path.join(os.path.dirname(__file__),"variables.env")
-DATA_PATH = './data/'
-DATA_FILE = 'titanic.csv'
+from utils.config_service import DEFAULT_AGENT_PERSONA, default_agent, get_config_service
+from utils.chat_manager import get_client, get_fake_client, get_chat_session, mark_synced, reset_chat
+from utils.context_window import build_context
+from utils.executor import get_executor
+from utils.dataset import dataset_fingerprint
+from utils.response_cache import get_response_cache
+from utils.chat_store import get_chat_store, new_chat_name
+from utils.profiler import get_profile, with_profile
+from utils.multi_agent import run_agents
+from utils.turn_engine import clean_code, run_chat_turn, wait_for_exec
+from utils.turn_queue import CANCELLED, get_turn_queue
+from utils.fake_model import use_fake_model
+from utils.blob_store import get_chart, get_thumbnail, normalize_chart_content, put_chart
+from utils.dataset_registry import READY, get_dataset_registry
+from utils.metrics import TurnTrace, observe_stage, percentile, start_metrics_server
+from utils.scheduler import get_scheduler
+from utils.startup import get_startup_report, start_prewarm
+
+SESSION_TRACE_LIMIT = 50
+HISTORY_WINDOW = 10  # turns rendered before "Show earlier messages"
+TURN_POLL_INTERVAL = 0.5  # seconds between progress updates of a running turn
 
 
 #### ----- SET-UP AND PRE-AMBLE ----- ####
 
+# Datasets in ./data/ and uploads, prepared once per process in the background
+dataset_registry = get_dataset_registry()
+
 if "dataset" not in st.session_state:
-    st.session_state.dataset = os.path.join(DATA_PATH, DATA_FILE)
+    st.session_state.dataset = dataset_registry.default_path()
+
+# Uploads already handed to the registry
+if "uploaded_files" not in st.session_state:
+    st.session_state.uploaded_files = set()
 
 # Initialize session state for API key and messages
 if "messages" not in st.session_state:
@@ -31,23 +47,49 @@ if "messages" not in st.session_state:
 if "gemini_api_key" not in st.session_state:
     st.session_state.gemini_api_key = ""
 
-# Initialize saved chats in session state if not exists
-if "saved_chats" not in st.session_state:
-    st.session_state.saved_chats = {}
-
 # Initialize agents in session state if not exists
 if "agents" not in st.session_state:
     st.session_state.agents = []
 
-if "last_config_modified" not in st.session_state:
-    st.session_state.last_config_modified = 0
+# Version of the shared configuration snapshot the session's agents came from
+if "config_version" not in st.session_state:
+    st.session_state.config_version = 0
+
+# Trace records of this session's recent turns, for the latency panel
+if "session_id" not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
 
-# Try to load API key from env file
-env_api_key = load_api_key_from_env(_ENV_FILE_)
-if env_api_key:
+if "turn_traces" not in st.session_state:
+    st.session_state.turn_traces = []
+
+# The session's turn running in the background, if any
+if "turn_job" not in st.session_state:
+    st.session_state.turn_job = None
+
+# Number of most recent turns rendered in the chat view
+if "history_window" not in st.session_state:
+    st.session_state.history_window = HISTORY_WINDOW
+
+# Prometheus-style /metrics endpoint, started once per server process
+start_metrics_server()
+
+# Agents and the API key come from the process-wide config service, which
+# watches agent_config.json and variables.env for every session
+config = get_config_service().snapshot
+env_api_key = config.api_key
+if not use_fake_model(env_api_key):
     # Only run this block for Gemini Developer API
     st.session_state.gemini_api_key = env_api_key
-    client = genai.Client(api_key=env_api_key)
+    client = get_client(env_api_key)
+else:
+    # Without an API key, answers are replayed by the offline fake model
+    client = get_fake_client()
+
+response_cache = get_response_cache()
+
+# Imports, sandbox workers, dataset and API connection are warmed once per
+# process; a no-op when serve.py already did it at server start
+start_prewarm(st.session_state.dataset, client if st.session_state.gemini_api_key else None)
    
 
 models = ["models/gemini-1.5-pro-latest",
@@ -59,8 +101,6 @@ models = ["models/gemini-1.5-pro-latest",
           ]
 
 
-DEFAULT_AGENT_PERSONA = f"""You are a helpful AI assistant focused on data analysis and insights. You communicate clearly and professionally while maintaining a friendly tone. You ask clarifying questions when needed and provide detailed explanations for your analysis. To answer questions use the following data: {st.session_state.dataset}. Whenever possible, show a data visualization with an explanation. Use the MATPLOTLIB library to create the visualizations. If you cannot answer the question with the dataset, say so, and provide only a short explanation, with no code."""
-
 st.session_state.default_agent = DEFAULT_AGENT_PERSONA
 
 
@@ -74,6 +114,126 @@ st.set_page_config(
     layout="wide"
 )
 
+# Model settings run as a fragment: changing one only reruns this block, and
+# the new value is picked up by the next prompt, which reruns the whole script
+@st.fragment
+def model_settings():
+    try:
+        #To see all models, uncomment the line below
+        #models = [m.name for m in genai.list_models()]
+        st.selectbox(
+            "Select Gemini Model",
+            models,
+            key="selected_model",
+            help="Choose which Gemini model to use"
+        )
+        st.success(f"Using model: {st.session_state.selected_model}")
+        st.toggle(
+            "Stream responses",
+            value=True,
+            key="stream_responses",
+            help="Show the explanation as it is generated"
+        )
+        st.toggle(
+            "Use response cache",
+            value=True,
+            key="use_response_cache",
+            help="Reuse earlier answers to the same question about the same data"
+        )
+        st.toggle(
+            "Route between models",
+            value=False,
+            key="model_routing",
+            help="Send simple questions to a fast model and harder ones, or failed answers, to a stronger one, "
+                 "and retry slow requests on a second model (single-agent chat only)"
+        )
+        st.toggle(
+            "Multi-agent mode",
+            value=False,
+            key="multi_agent_mode",
+            help="Ask every active agent at once and compare their answers side by side"
+        )
+        cache_stats = response_cache.stats()
+        st.caption(f"Response cache: {cache_stats['hits']} hits / {cache_stats['misses']} misses ({cache_stats['entries']} entries)")
+        scheduler_stats = get_scheduler().stats()
+        st.caption(f"Model requests: {scheduler_stats['running']} running · {scheduler_stats['queued']} queued · "
+                   f"p95 wait {scheduler_stats['wait_p95']:.2f}s · {scheduler_stats['retries']} retried · "
+                   f"{scheduler_stats['coalesced']} shared")
+    except Exception as e:
+        st.error(f"Error loading models: {str(e)}")
+
+# Chat options, also isolated from the chat view; New Chat reruns the whole app
+@st.fragment
+def chat_options():
+    if st.button("💾 Save Chat"):
+        if st.session_state.messages:
+            timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+            chat_name = new_chat_name(timestamp)
+            
+            # Save to the chat store (one atomic write for this chat only)
+            try:
+                get_chat_store().save_chat(chat_name, st.session_state.messages, timestamp=timestamp)
+                st.success(f"Chat saved as '{chat_name}'!")
+            except Exception as e:
+                st.error(f"Error saving chat: {str(e)}")
+        else:
+            st.warning("No messages to save!")
+
+
+    if st.button("🆕 New Chat"):
+        if st.session_state.turn_job is not None:
+            st.session_state.turn_job.cancel()
+        st.session_state.messages = []
+        st.session_state.history_window = HISTORY_WINDOW
+        reset_chat()
+        st.rerun()
+
+
+    if st.button("📋 View Saved Chats"):
+        st.switch_page("pages/1_Saved_Chats.py")
+
+# Dataset selection and upload. Ingestion runs in the background; while a
+# dataset is being prepared this fragment polls the registry on its own.
+def dataset_picker(polling):
+    datasets = dataset_registry.datasets()
+    ready = [dataset for dataset in datasets if dataset["status"] == READY]
+    paths = [dataset["path"] for dataset in ready]
+    if st.session_state.dataset not in paths:
+        paths.insert(0, st.session_state.dataset)
+    labels = {dataset["path"]: f"{dataset['name']} ({dataset['rows']} rows x {dataset['columns']} columns)"
+              for dataset in ready}
+    chosen = st.selectbox(
+        "Dataset",
+        paths,
+        index=paths.index(st.session_state.dataset),
+        format_func=lambda path: labels.get(path, os.path.basename(path)),
+        help="Data the agents answer questions about"
+    )
+    if chosen != st.session_state.dataset:
+        st.session_state.dataset = chosen
+        st.rerun()
+
+    for dataset in datasets:
+        if dataset["status"] == READY:
+            continue
+        if dataset["error"]:
+            st.error(f"Error preparing {dataset['name']}: {dataset['error']}")
+        else:
+            st.caption(f"⏳ Preparing {dataset['name']}...")
+
+    uploaded_file = st.file_uploader("Upload a dataset", type=["csv", "parquet"])
+    if uploaded_file is not None and uploaded_file.file_id not in st.session_state.uploaded_files:
+        try:
+            dataset_registry.add_upload(uploaded_file.name, uploaded_file.getvalue())
+            st.session_state.uploaded_files.add(uploaded_file.file_id)
+            st.rerun()
+        except Exception as e:
+            st.error(f"Error uploading dataset: {str(e)}")
+
+    # Stop polling once everything is prepared
+    if polling and not dataset_registry.busy():
+        st.rerun()
+
 # Sidebar for API key configuration
 with st.sidebar:
     st.header("Configuration 🔧")
@@ -88,21 +248,15 @@ with st.sidebar:
     #    st.session_state.gemini_api_key = api_key
     #    st.success("API key configured!")
 
+    if not st.session_state.gemini_api_key:
+        st.warning("No API key found: answers come from the offline fake model.")
+
+    # Dataset selection
+    polling = dataset_registry.busy()
+    st.fragment(dataset_picker, run_every=2 if polling else None)(polling)
+
     # Model selection
-    if st.session_state.gemini_api_key:
-        try:
-            #To see all models, uncomment the line below
-            #models = [m.name for m in genai.list_models()]
-            selected_model = st.selectbox(
-                "Select Gemini Model",
-                models,
-                help="Choose which Gemini model to use"
-            )
-            st.success(f"Using model: {selected_model}")
-        except Exception as e:
-            st.error(f"Error loading models: {str(e)}")
-    else:
-        st.warning("Please enter your API key to use the full features.")
+    model_settings()
     
     
     ## ------ SIDEBAR CHAT OPTIONS ----- ##
@@ -125,79 +279,38 @@ with st.sidebar:
     
     #st.caption(f"Active agents: {len(st.session_state.agents)}")
     
-    if st.button("💾 Save Chat"):
-        if st.session_state.messages:
-            timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-            chat_name = f"Chat_{timestamp}"
-            
-            st.session_state.saved_chats[chat_name] = {
-                "messages": st.session_state.messages.copy(),
-                "timestamp": timestamp,
-                "title": chat_name
-            }
-            
-            # Save to file
-            try:
-                with open("saved_chats.json", "w") as f:
-                    json.dump(st.session_state.saved_chats, f, indent=2)
-                st.success(f"Chat saved as '{chat_name}'!")
-            except Exception as e:
-                st.error(f"Error saving chat: {str(e)}")
-        else:
-            st.warning("No messages to save!")
-
-
-    if st.button("🆕 New Chat"):
-        st.session_state.messages = []
-        st.rerun()
+    chat_options()
 
+    # Filled in at the end of the run, so it includes the turn just answered
+    latency_panel = st.empty()
 
-    if st.button("📋 View Saved Chats"):
-        st.switch_page("pages/1_Saved_Chats.py")
+selected_model = st.session_state.get("selected_model", models[0])
+stream_responses = st.session_state.get("stream_responses", True)
+use_response_cache = st.session_state.get("use_response_cache", True)
+multi_agent_mode = st.session_state.get("multi_agent_mode", False)
+model_routing = st.session_state.get("model_routing", False)
 
 # Main chat interface
 st.header("Data Chat Assistant 💬")
 
-# Check if agent config file has been modified - upload agents if so!
-config_file_path = "agent_config.json"
-current_modified_time = 0
-if os.path.exists(config_file_path):
-    current_modified_time = os.path.getmtime(config_file_path)
-
-# Reload agents if config file has been modified
-if current_modified_time > st.session_state.last_config_modified:
-    try:
-        with open(config_file_path, "r") as f:
-            st.session_state.agents = json.load(f)
-        st.session_state.last_config_modified = current_modified_time
-        st.rerun()  # Refresh the page to show updated agents
-    except Exception as e:
-        st.error(f"Error loading agent configuration: {str(e)}")
+# Pick up the agents of a newer configuration snapshot - upload agents if so!
+if config.version != st.session_state.config_version:
+    st.session_state.agents = copy.deepcopy(list(config.agents))
+    st.session_state.config_version = config.version
+for config_error in config.errors:
+    st.error(config_error)
 
 # Initialize default agent if no agents exist
 if not st.session_state.agents:
-    st.session_state.agents = [{
-        "name": "Default Agent",
-        "persona": DEFAULT_AGENT_PERSONA,
-        "response-schema":{
-                        'required': [
-                            'code',
-                            'explanation'
-                        ],
-                        'properties': {
-                            'code': {'type': 'STRING'},
-                            'explanation': {'type': 'STRING'}
-                        },
-                        'type': 'OBJECT',
-                    },
-        "active": True
-    }]
-
-# Let user select agent
+    st.session_state.agents = [default_agent()]
+
+# Let user select agent; switching resets the history, so not while a turn is running
 agent_names = [agent["name"] for agent in st.session_state.agents]
+turn_running = st.session_state.turn_job is not None and not st.session_state.turn_job.done()
 selected_agent = st.selectbox(
     "Select AI Agent",
     agent_names,
+    disabled=turn_running,
     help="Choose which AI persona to chat with"
 )
 
@@ -216,146 +329,324 @@ selected_schema = next(
 )
 
 
+# The model sees the persona followed by the cached dataset profile
+dataset_profile = get_profile(st.session_state.dataset)
+system_instruction = with_profile(selected_persona, dataset_profile)
+
+with st.expander(f"📊 Dataset profile sent to the agent (≈{dataset_profile['tokens']} tokens)"):
+    st.text(dataset_profile['text'])
+
 # Add system prompt if messages empty or if agent changed
 if not st.session_state.messages or (st.session_state.messages and st.session_state.messages[0].get("content") != selected_persona):
+    # A running turn would add its answer to the history being replaced (e.g.
+    # after the agent's persona changed in the configuration)
+    if st.session_state.turn_job is not None:
+        st.session_state.turn_job.cancel()
     st.session_state.messages = [
         {"role": "system", "content": selected_persona}
     ]
 
 
 
+# Function to display chart thumbnails, with the full-size chart loaded on demand.
+# Each message's charts are a fragment, so a "Full size" toggle only reruns them.
+# Charts missing from the blob store can be rebuilt from the message's code, in
+# the background like a turn, so it shows progress and can be stopped.
+@st.fragment
+def show_charts(content, key_prefix):
+    missing = False
+    for chart_index, chart_ref in enumerate(content.get('chart_refs', [])):
+        try:
+            thumbnail = get_thumbnail(chart_ref)
+            if thumbnail is None:
+                missing = True
+                continue
+            st.image(thumbnail)
+            if st.toggle("Full size", key=f"{key_prefix}_{chart_index}"):
+                chart = get_chart(chart_ref)
+                if chart is None:
+                    missing = True
+                else:
+                    st.image(chart, width=350)
+        except Exception as e:
+            st.error(f"Error displaying chart image: {str(e)}")
+    if missing:
+        st.warning("Chart image is no longer available")
+        turn_running = st.session_state.turn_job is not None and not st.session_state.turn_job.done()
+        if content.get('code') and st.button("🔄 Rebuild charts", key=f"{key_prefix}_rebuild",
+                                             disabled=turn_running):
+            dataset = st.session_state.dataset
+
+            def work(job):
+                job.update(status="Rebuilding the charts...")
+                executor_job = get_executor(dataset).submit(clean_code(content['code']), dataset=dataset)
+                result = wait_for_exec(executor_job, job.cancel_event)
+                if result['error']:
+                    return {"failed": f"the code failed while rebuilding the charts: {result['error']}"}
+                return {"chart_refs": [put_chart(chart) for chart in result['charts']]}
+
+            def on_done(job):
+                if isinstance(job.result, dict) and job.result.get('chart_refs') is not None:
+                    content['chart_refs'] = job.result['chart_refs']
+
+            st.session_state.turn_job = get_turn_queue().submit(st.session_state.session_id, "Rebuild charts",
+                                                                work, on_done)
+            st.rerun()
+
+# Function to display one agent's answer in multi-agent mode
+def show_agent_answer(answer, key_prefix, charts=None):
+    st.markdown(f"**🤖 {answer['name']}**")
+    st.markdown(answer.get('explanation', ''))
+    if answer.get('code'):
+        st.code(answer['code'])
+    if answer.get('error'):
+        st.error(answer['error'])
+    if charts is not None:
+        for chart in charts:
+            st.image(chart, width=350)
+    else:
+        show_charts(answer, key_prefix)
+    st.caption(f"⏱ {answer.get('latency', 0):.1f}s" + (" (cached answer)" if answer.get('cached') else ""))
+
+# Only the last history_window turns are rendered, so a rerun costs the same
+# however long the chat is; older turns are shown on demand
+def history_start(messages, window):
+    turn_starts = [index for index, message in enumerate(messages) if message["role"] == "user"]
+    if len(turn_starts) <= window:
+        return 0
+    return turn_starts[-window]
+
 # Display chat messages
-for message in st.session_state.messages:
+history_start_time = time.perf_counter()
+first_shown = history_start(st.session_state.messages, st.session_state.history_window)
+if first_shown:
+    hidden_turns = sum(1 for message in st.session_state.messages[:first_shown] if message["role"] == "user")
+    if st.button(f"⬆️ Show earlier messages ({hidden_turns} more turns)"):
+        st.session_state.history_window += HISTORY_WINDOW
+        st.rerun()
+for index, message in enumerate(st.session_state.messages[first_shown:], start=first_shown):
     with st.chat_message(message["role"]):
-        if message["role"] == "assistant" and isinstance(message["content"], dict):
-            # Handle new message format with chart image
+        if message["role"] == "assistant" and isinstance(message["content"], dict) and "agents" in message["content"]:
+            # Multi-agent turn: answers side by side
+            answers = message["content"]["agents"]
+            for column_index, (column, answer) in enumerate(zip(st.columns(len(answers)), answers)):
+                with column:
+                    show_agent_answer(answer, f"full_chart_{index}_{column_index}")
+        elif message["role"] == "assistant" and isinstance(message["content"], dict):
+            # Handle new message format with chart references
             content = message["content"]
+            if 'chart_refs' not in content:
+                # Move base64 charts of older messages into the blob store once
+                content = message["content"] = normalize_chart_content(content)
             st.markdown(content.get('explanation', ''))
             
             if content.get('code'):
                 st.code(content['code'])
+            if content.get('routing'):
+                routing = content['routing']
+                st.caption(f"🧭 Answered by {routing['model']} ({routing['reason']}"
+                           + (", hedged" if routing['hedged'] else "") + ")")
+            if content.get('cached'):
+                st.caption("Answer served from the response cache")
+            if content.get('exec_cached'):
+                st.caption("Result served from the execution cache")
+            if content.get('stdout'):
+                st.text(content['stdout'])
+            if content.get('error'):
+                st.error(f"Error running the generated code: {content['error']}")
             
-            # Display chart image if it exists
-            if content.get('chart_image'):
-                try:
-                    # Decode base64 image and display
-                    image_data = base64.b64decode(content['chart_image'])
-                    st.image(image_data, width=350)
-                except Exception as e:
-                    st.error(f"Error displaying chart image: {str(e)}")
+            show_charts(content, f"full_chart_{index}")
         else:
             # Handle old message format or user messages
             st.markdown(message["content"])
+history_render_time = time.perf_counter() - history_start_time
+observe_stage("history_render", history_render_time)
+
+# How the session's last background turn ended; its answer, if any, is
+# already part of the history above
+turn_job = st.session_state.turn_job
+if turn_job is not None and turn_job.done():
+    st.session_state.turn_job = None
+    answer = turn_job.result if isinstance(turn_job.result, dict) else {}
+    if turn_job.status == CANCELLED or answer.get('cancelled'):
+        st.info("⏹ Stopped")
+    elif turn_job.error or answer.get('failed'):
+        st.error(f"Error generating response: {turn_job.error or answer['failed']}")
+    turn_job = None
+
+# Progress of the running turn, polled until it finishes
+def turn_progress():
+    job = st.session_state.turn_job
+    if job is None:
+        return
+    if job.done():
+        # Rerun the page to show the answer in the history
+        st.rerun()
+    with st.chat_message("assistant"):
+        progress = job.progress
+        if "answers" in progress:
+            # Multi-agent turn: each answer as soon as it is ready
+            answers = progress["answers"]
+            for column, answer in zip(st.columns(len(answers)), answers):
+                with column:
+                    if answer is None:
+                        st.caption("Thinking...")
+                    else:
+                        show_agent_answer(answer, None, charts=answer['charts'])
+        elif progress.get("explanation"):
+            st.markdown(progress["explanation"])
+        if job.cancelled:
+            st.caption("Stopping...")
+        else:
+            st.caption(f"⏳ {progress.get('status', 'Thinking...')} ({job.elapsed():.0f}s)")
+            if st.button("⏹ Stop", key=f"stop_{job.id}"):
+                job.cancel()
 
-# Chat input
-if prompt := st.chat_input("Ask me about your data..."):
+st.fragment(turn_progress, run_every=TURN_POLL_INTERVAL if turn_job is not None else None)()
+
+# Chat input, disabled while a turn is running
+if prompt := st.chat_input("Ask me about your data...", disabled=turn_job is not None):
     # Add user message to chat history
     st.session_state.messages.append({"role": "user", "content": prompt})
-    
-    # Display user message
-    with st.chat_message("user"):
-        st.markdown(prompt)
 
-    if not st.session_state.gemini_api_key:
-        #If no API key, random gibberish response for testing purposes
-        messages = ''.join(random.choices('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789', k=random.randint(50, 200)))
-        
-        with st.chat_message("assistant"):
-            st.markdown(messages)
-            st.session_state.messages.append({"role": "assistant", "content": messages})
+    # The turn runs in the background and writes its answer and trace to this
+    # session's lists, even if the session has moved to another page by then
+    messages = st.session_state.messages
+    traces = st.session_state.turn_traces
+    history = messages[:-1]
+    dataset = st.session_state.dataset
+    dataset_hash = dataset_fingerprint(dataset)
+    session_id = st.session_state.session_id
+
+    if multi_agent_mode:
+        # Ask every active agent concurrently and show each answer as soon as it is ready
+        active_agents = [agent for agent in st.session_state.agents if agent.get("active", True)] or [
+            agent for agent in st.session_state.agents if agent["name"] == selected_agent
+        ]
+        instructions = [with_profile(agent["persona"], dataset_profile) for agent in active_agents]
+        context = build_context(client, selected_model, history)
+
+        def work(job):
+            job.update(answers=[None] * len(active_agents))
+
+            def on_answer(index, answer):
+                answers = list(job.progress["answers"])
+                answers[index] = answer
+                job.update(answers=answers)
+
+            return asyncio.run(run_agents(
+                client,
+                selected_model,
+                active_agents,
+                instructions,
+                prompt,
+                history,
+                dataset,
+                dataset_hash,
+                use_cache=use_response_cache,
+                session_id=session_id,
+                context=context.contents,
+                on_answer=on_answer,
+                cancel=job.cancel_event
+            ))
+
+        def on_done(job):
+            # Store charts once in the blob store; messages keep only the references
+            stored_answers = []
+            for answer in job.result or []:
+                traces.append(answer['trace'])
+                stored = {key: value for key, value in answer.items() if key not in ('charts', 'stdout', 'trace')}
+                stored['chart_refs'] = [put_chart(chart) for chart in answer['charts']]
+                stored_answers.append(stored)
+            if stored_answers:
+                messages.append({"role": "assistant", "content": {"agents": stored_answers}})
+                get_startup_report().mark("first_response")
     else:
-        try:
-            #initiate the chat
-            if selected_schema != {}:
-                chat = client.chats.create(
-                    model=selected_model,
-                    config=types.GenerateContentConfig(
-                        system_instruction=selected_persona,
-                        response_mime_type='application/json',
-                        response_schema=selected_schema
-                    )
-                )
-            else:
-                chat = client.chats.create(
-                    model=selected_model,
-                    config=types.GenerateContentConfig(
-                        system_instruction=selected_persona
-                    )
-                )
-            
-            # Generate response -- which is code and visualization
-            
+        trace = TurnTrace(session_id, selected_model, agent=selected_agent)
+        trace.add("history_render", history_render_time)
+
+        # Reuse the session's live chat; everything before this prompt is history
+        with trace.span("chat"):
+            chat_session = get_chat_session(client, selected_model, system_instruction, selected_schema, history)
+
+        def work(job):
+            return run_chat_turn(
+                client,
+                chat_session,
+                selected_agent,
+                system_instruction,
+                selected_schema,
+                prompt,
+                history,
+                dataset,
+                dataset_hash,
+                use_cache=use_response_cache,
+                stream=stream_responses,
+                session_id=session_id,
+                progress=job.update,
+                cancel=job.cancel_event,
+                trace=trace,
+                routing=model_routing
+            )
+
+        def on_done(job):
+            answer = job.result
+            if answer is None:
+                # Cancelled before it started
+                return
+            traces.append(answer['trace'])
+            if answer['failed'] or answer['cancelled']:
+                return
             if selected_schema != {}:
-                with st.chat_message("assistant"):
-                    with st.spinner("Thinking..."):
-                        response = chat.send_message(prompt)
-                        #convert response.text to dict
-                        response_dict = json.loads(response.text)
-                        if response_dict['code'] == "":
-                            st.markdown(response_dict['explanation'])
-                        else:
-                            st.markdown(response_dict['explanation'])
-                            #st.code(response_dict['code'])
-                        
-                        # Execute the code and display chart if code exists
-                        chart_image = None
-                        if response_dict['code']:
-                            try:
-                                # Execute the code in a safe environment
-                                exec_globals = {}
-                                
-                                # Remove any .show() calls from the code as they don't work in Streamlit
-                                cleaned_code = response_dict['code'].replace('.show()', '')
-                                
-                                exec(cleaned_code, exec_globals)
-                                
-                                # Check if a matplotlib figure was created
-                                if 'plt' in exec_globals and plt.get_fignums():
-                                    # Get the current figure
-                                    fig = plt.gcf()
-                                    
-                                    # Set figure size to max 300px width (convert to inches, 150 DPI)
-                                    # 300px / 100 DPI = 3 inches width
-                                    current_size = fig.get_size_inches()
-                                    max_width_inches = 3.0  # 300px / 100 DPI
-                                    
-                                    if current_size[0] > max_width_inches:
-                                        # Scale down proportionally
-                                        scale_factor = max_width_inches / current_size[0]
-                                        new_width = max_width_inches
-                                        new_height = current_size[1] * scale_factor
-                                        fig.set_size_inches(new_width, new_height)
-                                    
-                                    # Save the figure to a bytes buffer
-                                    img_buffer = io.BytesIO()
-                                    fig.savefig(img_buffer, format='png', bbox_inches='tight', dpi=150)
-                                    img_buffer.seek(0)
-                                    
-                                    # Convert to base64 for storage
-                                    chart_image = base64.b64encode(img_buffer.getvalue()).decode('utf-8')
-                                    
-                                    # Display the image in Streamlit with specific width
-                                    st.image(img_buffer, width=350)
-                                    
-                                    # Clear the figure to prevent memory issues
-                                    plt.close(fig)
-                                    
-                            except Exception as e:
-                                st.markdown(response_dict['explanation'])
-                                
-                        # Add assistant response to chat history with chart image
-                        message_content = {
-                            'explanation': response_dict['explanation'],
-                            'code': response_dict['code'],
-                            'chart_image': chart_image
-                        }
-                        st.session_state.messages.append({"role": "assistant", "content": message_content})
+                # Charts are in the blob store; the message keeps only their references
+                message_content = {
+                    'explanation': answer['explanation'],
+                    'code': answer['code'],
+                    'chart_refs': answer['chart_refs']
+                }
+                for key in ('stdout', 'error', 'cached', 'exec_cached', 'routing'):
+                    if answer[key]:
+                        message_content[key] = answer[key]
             else:
-                with st.chat_message("assistant"):
-                    with st.spinner("Thinking..."):
-                        response = chat.send_message(prompt)
-                        st.markdown(response.text)
-                        st.session_state.messages.append({"role": "assistant", "content": response.text})
-                        
-        except Exception as e:
-            st.error(f"Error generating response: {str(e)}")
+                message_content = answer['explanation']
+            messages.append({"role": "assistant", "content": message_content})
+            get_startup_report().mark("first_response")
+            if not answer['cached']:
+                mark_synced(messages, chat_session)
+
+    st.session_state.turn_job = get_turn_queue().submit(session_id, prompt, work, on_done)
+    st.rerun()
+
+if len(st.session_state.turn_traces) > SESSION_TRACE_LIMIT:
+    del st.session_state.turn_traces[:-SESSION_TRACE_LIMIT]
+
+# Per-session latency panel in the sidebar
+with latency_panel.container():
+    traces = st.session_state.turn_traces
+    if traces:
+        st.subheader("⏱ Latency")
+        last = traces[-1]
+        summary = f"Last turn: {last['total']:.2f}s"
+        if last['ttft'] is not None:
+            summary += f" · first token {last['ttft']:.2f}s"
+        if last['tokens']:
+            summary += f" · {last['tokens'].get('prompt', 0)} → {last['tokens'].get('output', 0)} tokens"
+        if last.get('retries'):
+            summary += f" · {last['retries']} retries"
+        if last.get('coalesced'):
+            summary += " · shared request"
+        if last.get('routing'):
+            summary += f" · routed to {last['routing']['model']}" + (" (hedged)" if last['routing']['hedged'] else "")
+        st.caption(summary)
+        st.caption(" · ".join(f"{stage} {seconds:.2f}s" for stage, seconds in last['stages'].items()))
+        if last['error']:
+            st.caption(f"Failed in {last['error']['stage']}: {last['error']['message']}")
+        totals = [trace['total'] for trace in traces]
+        st.caption(f"Session: {len(totals)} turns · p50 {percentile(totals, 50):.2f}s · p95 {percentile(totals, 95):.2f}s")
+        st.caption(f"History render: {history_render_time * 1000:.0f} ms")
+        cold_start = get_startup_report().snapshot()['events']
+        if 'ready' in cold_start:
+            st.caption(f"Server ready {cold_start['ready']:.1f}s after start"
+                       + (f" · first answer at {cold_start['first_response']:.1f}s" if 'first_response' in cold_start else ""))
+
+get_startup_report().mark("first_page")
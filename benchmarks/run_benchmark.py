@@ -0,0 +1,314 @@
+# End-to-end load and latency benchmark
+#
+# Drives DataChatApp.py and both pages through Streamlit's headless app-testing
+# API (streamlit.testing.v1.AppTest) against the offline fake model, so it runs
+# on a machine with no network access or API key. N sessions run concurrently
+# (one process each, since AppTest keeps global runtime state), each sending a
+# sequence of recorded questions, and the harness reports:
+#
+#   - turn latency (p50/p95): submitting a prompt until its answer is shown
+#   - rerun time: a plain rerun of the chat page with the accumulated history
+#   - exec time: running the recorded code in the sandbox pool
+#   - savefig/encode time: capturing and rendering the recorded charts to PNG
+#   - saved-chat load time: the Saved Chats page and loading one saved chat
+#   - cold start: first page and first answer of a fresh server process, with
+#     and without the prewarm of serve.py, and the prewarm's own step and
+#     import timings
+#   - peak RSS of the server process and its workers
+#
+# Usage:
+#   python benchmarks/run_benchmark.py --sessions 4 --turns 5 --latency 0.5
+import argparse
+import json
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+TURN_POLL_INTERVAL = 0.05  # seconds
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def percentile(values: list, pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(values: list) -> dict:
+    return {
+        "count": len(values),
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "mean": statistics.fmean(values) if values else 0.0,
+        "max": max(values) if values else 0.0,
+    }
+
+
+class RSSMonitor(threading.Thread):
+    # Samples the RSS of this process plus its children (the sandbox workers)
+    def __init__(self, interval: float = 0.1):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak_mb = 0.0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        if psutil is None:
+            return
+        process = psutil.Process()
+        while not self._stop_event.is_set():
+            try:
+                total = process.memory_info().rss
+                for child in process.children(recursive=True):
+                    try:
+                        total += child.memory_info().rss
+                    except psutil.Error:
+                        pass
+                self.peak_mb = max(self.peak_mb, total / (1024 * 1024))
+            except psutil.Error:
+                pass
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def run_session(session_id: int, prompts: list, turns: int, timeout: float, results):
+    # One user session; runs in its own process because AppTest keeps global runtime state
+    from streamlit.testing.v1 import AppTest
+
+    turn_times, rerun_times, errors = [], [], []
+    try:
+        at = AppTest.from_file(os.path.join(ROOT, "DataChatApp.py"), default_timeout=timeout).run()
+        for turn in range(turns):
+            prompt = prompts[(session_id + turn) % len(prompts)]
+            start_time = time.perf_counter()
+            at.chat_input[0].set_value(prompt).run()
+            # The turn runs in the background; poll like the progress fragment does
+            while at.session_state.turn_job is not None and time.perf_counter() - start_time < timeout:
+                time.sleep(TURN_POLL_INTERVAL)
+                at.run()
+            turn_times.append(time.perf_counter() - start_time)
+            errors += [e.value for e in at.error] + [e.message for e in at.exception]
+
+            start_time = time.perf_counter()
+            at.run()
+            rerun_times.append(time.perf_counter() - start_time)
+
+        # Save the chat so the Saved Chats page has something to load
+        next(button for button in at.button if button.label == "💾 Save Chat").click().run()
+    except Exception as e:
+        errors.append(f"session {session_id}: {type(e).__name__}: {e}")
+    results.put({"turn": turn_times, "rerun": rerun_times, "errors": errors})
+
+
+def run_cold_start(prompt: str, prewarmed: bool, timeout: float, results):
+    # A fresh server process in its own scratch directory, so no cache on disk
+    # is warm either: optionally prewarmed like serve.py, then one session's
+    # first page and first answer
+    workdir = tempfile.mkdtemp(prefix="datachat-cold-")
+    os.symlink(os.path.join(ROOT, "data"), os.path.join(workdir, "data"))
+    os.chdir(workdir)
+    from utils.startup import start_prewarm
+
+    process_start = time.perf_counter()
+    report = None
+    if prewarmed:
+        report = start_prewarm(from_settings=True)
+        report.ready.wait(timeout)
+    from streamlit.testing.v1 import AppTest
+
+    ready = time.perf_counter() - process_start if prewarmed else None
+    start_time = time.perf_counter()
+    at = AppTest.from_file(os.path.join(ROOT, "DataChatApp.py"), default_timeout=timeout).run()
+    first_page = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    at.chat_input[0].set_value(prompt).run()
+    while at.session_state.turn_job is not None and time.perf_counter() - start_time < timeout:
+        time.sleep(TURN_POLL_INTERVAL)
+        at.run()
+    first_turn = time.perf_counter() - start_time
+    results.put({"ready": ready, "first_page": first_page, "first_turn": first_turn,
+                 "prewarm": report.snapshot() if report else None,
+                 "errors": [e.value for e in at.error] + [e.message for e in at.exception]})
+
+
+def bench_cold_start(prompt: str, timeout: float) -> dict:
+    ctx = multiprocessing.get_context("spawn")
+    results = {}
+    for name, prewarmed in (("cold", False), ("prewarmed", True)):
+        queue = ctx.Queue()
+        process = ctx.Process(target=run_cold_start, args=(prompt, prewarmed, timeout, queue))
+        process.start()
+        results[name] = queue.get()
+        process.join()
+    return results
+
+
+def bench_app(sessions: int, turns: int, prompts: list, timeout: float) -> dict:
+    # Sessions are separate processes sharing the on-disk caches and stores
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    processes = [
+        ctx.Process(target=run_session, args=(i, prompts, turns, timeout, queue))
+        for i in range(sessions)
+    ]
+    start_time = time.perf_counter()
+    for process in processes:
+        process.start()
+    results = {"turn": [], "rerun": [], "errors": []}
+    for _ in processes:
+        session = queue.get()
+        for key in results:
+            results[key] += session[key]
+    for process in processes:
+        process.join()
+    results["wall"] = time.perf_counter() - start_time
+    return results
+
+
+def bench_pages(timeout: float, repeats: int = 3) -> dict:
+    from streamlit.testing.v1 import AppTest
+    from utils.chat_store import get_chat_store
+
+    saved_page, configure_page, load_times = [], [], []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        AppTest.from_file(os.path.join(ROOT, "pages", "1_Saved_Chats.py"), default_timeout=timeout).run()
+        saved_page.append(time.perf_counter() - start_time)
+
+        start_time = time.perf_counter()
+        AppTest.from_file(os.path.join(ROOT, "pages", "2_Configure_Agents.py"), default_timeout=timeout).run()
+        configure_page.append(time.perf_counter() - start_time)
+
+        store = get_chat_store()
+        for chat in store.list_chats(limit=5):
+            start_time = time.perf_counter()
+            store.load_messages(chat["name"])
+            load_times.append(time.perf_counter() - start_time)
+    return {"saved_chats_page": saved_page, "configure_page": configure_page, "load_chat": load_times}
+
+
+def bench_execution(recordings: list, dataset: str, repeats: int = 3) -> dict:
+    from utils.charts import capture_figures, render_figures
+    from utils.dataset import load_dataset
+    from utils.executor import get_executor
+
+    executor = get_executor(dataset)
+    codes = [r["response"]["code"].replace('.show()', '') for r in recordings if r["response"].get("code")]
+    exec_times, render_times = [], []
+    for _ in range(repeats):
+        for code in codes:
+            start_time = time.perf_counter()
+            executor.run(code, dataset=dataset)
+            exec_times.append(time.perf_counter() - start_time)
+
+            # Chart capture and PNG encoding, measured in-process
+            with capture_figures() as figures:
+                exec(code, {"df": load_dataset(dataset)})
+                start_time = time.perf_counter()
+                render_figures(figures)
+                render_times.append(time.perf_counter() - start_time)
+    return {"exec": exec_times, "savefig_encode": render_times}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DataChatApp load/latency benchmark (offline)")
+    parser.add_argument("--sessions", type=int, default=4, help="concurrent sessions")
+    parser.add_argument("--turns", type=int, default=5, help="questions per session")
+    parser.add_argument("--latency", type=float, default=0.5, help="fake model latency (s)")
+    parser.add_argument("--ttft", type=float, default=0.15, help="fake model time to first token (s)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fake model error rate")
+    parser.add_argument("--rpm", type=float, default=0, help="client-side requests per minute per model (0: no limit)")
+    parser.add_argument("--timeout", type=float, default=120, help="per-run timeout (s)")
+    parser.add_argument("--recordings", default=os.path.join(ROOT, "benchmarks", "recordings.jsonl"))
+    parser.add_argument("--json", help="also write the raw results to this file")
+    args = parser.parse_args()
+
+    os.environ.update({
+        "DATACHAT_FAKE_MODEL": "1",
+        "DATACHAT_FAKE_LATENCY": str(args.latency),
+        "DATACHAT_FAKE_TTFT": str(args.ttft),
+        "DATACHAT_FAKE_ERROR_RATE": str(args.error_rate),
+        "DATACHAT_FAKE_RECORDINGS": args.recordings,
+        "DATACHAT_MODEL_RPM": str(args.rpm),
+    })
+
+    from utils.fake_model import load_recordings
+    recordings = load_recordings(args.recordings)
+    prompts = [r["prompt"] for r in recordings if r["prompt"]]
+
+    json_path = os.path.abspath(args.json) if args.json else None
+
+    # Run in a scratch directory so caches, blobs and saved chats start empty
+    workdir = tempfile.mkdtemp(prefix="datachat-bench-")
+    os.symlink(os.path.join(ROOT, "data"), os.path.join(workdir, "data"))
+    os.chdir(workdir)
+    dataset = os.path.join("./data/", "titanic.csv")
+
+    monitor = RSSMonitor()
+    monitor.start()
+    raw = {}
+    raw["execution"] = bench_execution(recordings, dataset)
+    raw["app"] = bench_app(args.sessions, args.turns, prompts, args.timeout)
+    # Before bench_pages: AppTest replaces __main__, which spawn needs
+    raw["cold_start"] = bench_cold_start(prompts[0], args.timeout)
+    raw["pages"] = bench_pages(args.timeout)
+    monitor.stop()
+
+    report = {
+        "sessions": args.sessions,
+        "turns_per_session": args.turns,
+        "wall_time": raw["app"]["wall"],
+        "turn_latency": summarize(raw["app"]["turn"]),
+        "rerun_time": summarize(raw["app"]["rerun"]),
+        "exec_time": summarize(raw["execution"]["exec"]),
+        "savefig_encode_time": summarize(raw["execution"]["savefig_encode"]),
+        "saved_chats_page_time": summarize(raw["pages"]["saved_chats_page"]),
+        "configure_page_time": summarize(raw["pages"]["configure_page"]),
+        "saved_chat_load_time": summarize(raw["pages"]["load_chat"]),
+        "cold_start": raw["cold_start"],
+        "peak_rss_mb": monitor.peak_mb if psutil else None,
+        "errors": raw["app"]["errors"][:20],
+    }
+
+    print(f"{args.sessions} sessions x {args.turns} turns in {report['wall_time']:.2f}s (workdir {workdir})")
+    for name in ("turn_latency", "rerun_time", "exec_time", "savefig_encode_time",
+                 "saved_chats_page_time", "configure_page_time", "saved_chat_load_time"):
+        stats = report[name]
+        print(f"  {name:<24} p50 {stats['p50'] * 1000:8.1f} ms   p95 {stats['p95'] * 1000:8.1f} ms   (n={stats['count']})")
+    for name, run in report["cold_start"].items():
+        ready = f"{run['ready']:6.2f} s" if run["ready"] is not None else "     - "
+        print(f"  {'cold_start_' + name:<24} ready {ready}   first page {run['first_page']:6.2f} s   "
+              f"first answer {run['first_turn']:6.2f} s")
+        if run["errors"]:
+            print(f"    errors: {run['errors'][0]}")
+    prewarm = report["cold_start"]["prewarmed"]["prewarm"]
+    print("  prewarm steps            " + " · ".join(f"{step} {seconds:.2f}s" for step, seconds in prewarm["stages"].items()))
+    print("  import times             " + " · ".join(f"{module} {seconds:.2f}s" for module, seconds in prewarm["imports"].items()))
+    if report["peak_rss_mb"] is not None:
+        print(f"  {'peak_rss':<24} {report['peak_rss_mb']:8.1f} MB")
+    if report["errors"]:
+        print(f"  errors: {len(raw['app']['errors'])} (first: {report['errors'][0]})")
+
+    if json_path:
+        with open(json_path, "w") as f:
+            json.dump({"report": report, "raw": raw}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
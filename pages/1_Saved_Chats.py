@@ -1,80 +1,92 @@
 import streamlit as st
-import json
-import os
 from datetime import datetime
+from utils.chat_store import get_chat_store, new_chat_name
+
+PAGE_SIZE = 20
 
 st.title("Saved Chats 💾")
 
-# Initialize saved chats in session state if not exists
-if "saved_chats" not in st.session_state:
-    st.session_state.saved_chats = {}
+# A turn started on the chat page keeps running while this page is open
+if st.session_state.get("turn_job") is not None and not st.session_state.turn_job.done():
+    st.info("⏳ An answer is still being generated; it will be added to the current chat.")
+
+store = get_chat_store()
+
+if "saved_chats_page" not in st.session_state:
+    st.session_state.saved_chats_page = 0
 
 # Function to save current chat
 def save_current_chat():
     if st.session_state.messages:
         timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-        chat_name = f"Chat_{timestamp}"
-        
-        # Save to session state
-        st.session_state.saved_chats[chat_name] = {
-            "messages": st.session_state.messages.copy(),
-            "timestamp": timestamp,
-            "title": chat_name
-        }
-        
-        # Save to file
-        save_chats_to_file()
+        chat_name = new_chat_name(timestamp)
+
+        # Save to the chat store
+        try:
+            store.save_chat(chat_name, st.session_state.messages, timestamp=timestamp)
+        except Exception as e:
+            st.error(f"Error saving chats: {str(e)}")
+            return None
         return chat_name
     return None
 
-# Function to save chats to file
-def save_chats_to_file():
-    try:
-        with open("saved_chats.json", "w") as f:
-            json.dump(st.session_state.saved_chats, f, indent=2)
-    except Exception as e:
-        st.error(f"Error saving chats: {str(e)}")
-
-# Function to load chats from file
-def load_chats_from_file():
-    try:
-        if os.path.exists("saved_chats.json"):
-            with open("saved_chats.json", "r") as f:
-                st.session_state.saved_chats = json.load(f)
-    except Exception as e:
-        st.error(f"Error loading chats: {str(e)}")
-
-
-# Load existing chats
-load_chats_from_file()
-
-# Display saved chats
-if st.session_state.saved_chats and len(st.session_state.saved_chats) > 0:
+# Function to preview a message as text
+def preview_message(msg):
+    content = msg['content']
+    if isinstance(content, dict):
+        content = content.get('explanation', '')
+    return f"{msg['role']}: {str(content)[:100]}..."
+
+
+# Display saved chats, one page of metadata at a time
+chat_count = store.count_chats()
+if chat_count > 0:
     st.markdown("### Your Saved Chats")
-    st.write(len(st.session_state.saved_chats))
-    
-    for chat_name, chat_data in st.session_state.saved_chats.items():
+    st.write(chat_count)
+
+    page_count = (chat_count + PAGE_SIZE - 1) // PAGE_SIZE
+    page = min(st.session_state.saved_chats_page, page_count - 1)
+
+    for chat in store.list_chats(limit=PAGE_SIZE, offset=page * PAGE_SIZE):
+        chat_name = chat['name']
         with st.expander(f"📄 {chat_name}"):
-            st.write(f"**Saved on:** {chat_data.get('timestamp', 'Unknown')}")
-            st.write(f"**Messages:** {len(chat_data['messages'])}")
-            
+            st.write(f"**Saved on:** {chat.get('timestamp', 'Unknown')}")
+            st.write(f"**Messages:** {chat['message_count']}")
+
             col1, col2 = st.columns(2)
             with col1:
                 if st.button(f"Load {chat_name}", key=f"load_{chat_name}"):
-                    st.session_state.messages = chat_data['messages'].copy()
+                    if st.session_state.get("turn_job") is not None:
+                        st.session_state.turn_job.cancel()
+                    st.session_state.messages = store.load_messages(chat_name)
+                    # Start the chat view at the most recent turns again
+                    st.session_state.pop("history_window", None)
                     st.success(f"Loaded {chat_name}!")
                     st.rerun()
-            
+
             with col2:
                 if st.button(f"Delete {chat_name}", key=f"delete_{chat_name}"):
-                    del st.session_state.saved_chats[chat_name]
-                    save_chats_to_file()
+                    store.delete_chat(chat_name)
                     st.success(f"Deleted {chat_name}!")
                     st.rerun()
-            
-            # Show preview of messages
-            st.markdown("**Preview:**")
-            for i, msg in enumerate(chat_data['messages'][:3]):  # Show first 3 messages
-                st.write(f"{msg['role']}: {msg['content'][:100]}...")
+
+            # Message bodies are only read from the store when asked for
+            if st.toggle("Show preview", key=f"preview_{chat_name}"):
+                st.markdown("**Preview:**")
+                for msg in store.load_messages(chat_name, limit=3):  # Show first 3 messages
+                    st.write(preview_message(msg))
+
+    if page_count > 1:
+        col1, col2, col3 = st.columns([1, 2, 1])
+        with col1:
+            if st.button("⬅️ Previous", disabled=page == 0):
+                st.session_state.saved_chats_page = page - 1
+                st.rerun()
+        with col2:
+            st.caption(f"Page {page + 1} of {page_count}")
+        with col3:
+            if st.button("Next ➡️", disabled=page >= page_count - 1):
+                st.session_state.saved_chats_page = page + 1
+                st.rerun()
 else:
-    st.info("No saved chats yet. Start a conversation and save it!") 
\ No newline at end of file
+    st.info("No saved chats yet. Start a conversation and save it!")
@@ -1,7 +1,11 @@
 import streamlit as st
+import copy
 import json
 import os
 from datetime import datetime
+from utils.config_service import ConfigError, compile_schema, default_agent, get_config_service, read_agents
+from utils.dataset_registry import get_dataset_registry
+from utils.profiler import get_profile
 
 # Page configuration
 st.set_page_config(
@@ -10,32 +14,28 @@ st.set_page_config(
     layout="wide"
 )
 
+config_service = get_config_service()
+
 # Initialize agents in session state if not exists
 if "agents" not in st.session_state:
-    # Try to load agents from config file first
-    if os.path.exists("agent_config.json"):
-        with open("agent_config.json", "r") as f:
-            st.session_state.agents = json.load(f)
+    # Try to load agents from the shared configuration first
+    config = config_service.snapshot
+    if config.agents:
+        st.session_state.agents = copy.deepcopy(list(config.agents))
+        st.session_state.config_version = config.version
     else:
-        st.session_state.agents = [{
-            "name": "Default Agent",
-            "persona": "You are a helpful AI assistant focused on data analysis and insights. You communicate clearly and professionally while maintaining a friendly tone. You ask clarifying questions when needed and provide detailed explanations for your analysis. To answer questions use the following data: TEST. Whenever possible, show a data visualization with an explanation. Use the MATPLOTLIB library to create the visualizations. If you cannot answer the question with the dataset, say so, and provide only a short explanation, with no code.",
-            "response-schema":{
-                        'required': [
-                            'code',
-                            'explanation'
-                        ],
-                        'properties': {
-                            'code': {'type': 'STRING'},
-                            'explanation': {'type': 'STRING'}
-                        },
-                        'type': 'OBJECT',
-                    },
-            "active": True
-        }]
+        st.session_state.agents = [default_agent()]
 
 st.title("Configure AI Agents 🤖")
 
+# Dataset profile appended to every agent's persona
+try:
+    dataset_profile = get_profile(st.session_state.get("dataset", get_dataset_registry().default_path()))
+    with st.expander(f"📊 Dataset profile added to every agent (≈{dataset_profile['tokens']} tokens)"):
+        st.text(dataset_profile['text'])
+except Exception as e:
+    st.error(f"Error profiling dataset: {str(e)}")
+
 # Add new agent button
 if st.button("➕ Add New Agent"):
     st.session_state.agents.append({
@@ -88,19 +88,23 @@ for i, agent in enumerate(st.session_state.agents):
             try:
                 parsed_schema = json.loads(new_schema)
                 st.session_state.agents[i]["response-schema"] = parsed_schema
+                compile_schema(parsed_schema)
             except json.JSONDecodeError:
                 st.error("Invalid JSON format in schema")
+            except ConfigError as e:
+                st.error(f"Invalid response schema: {str(e)}")
                 
         except Exception as e:
             st.error(f"Error handling response schema: {str(e)}")
         
-       # Use only in the multi-agent mode
-       #active = st.toggle(
-        #    "Active",
-        #    value=agent["active"],
-        #    key=f"active_{i}"
-        #)
-        #st.session_state.agents[i]["active"] = active
+        # Used in the multi-agent mode
+        active = st.toggle(
+            "Active",
+            value=agent.get("active", True),
+            key=f"active_{i}",
+            help="Active agents answer together in multi-agent mode"
+        )
+        st.session_state.agents[i]["active"] = active
         
         # Delete agent button (prevent deleting last agent)
         if len(st.session_state.agents) > 1:
@@ -112,21 +116,27 @@ for i, agent in enumerate(st.session_state.agents):
 if st.button("💾 Save Configuration"):
 
     try:
-        with open("agent_config.json", "w") as f:
-            json.dump(st.session_state.agents, f, indent=2)
+        # Validated and written atomically; every session picks up the new version
+        config = config_service.save_agents(st.session_state.agents)
+        st.session_state.config_version = config.version
         st.success("Agent configuration saved successfully!")
     
     except Exception as e:
         st.error(f"Error saving configuration: {str(e)}")
 
 # Load saved configuration
-if os.path.exists("agent_config.json"):
+if os.path.exists(config_service.agent_path):
     if st.button("📂 Load Saved Configuration"):
         try:
-            config_file = st.text_input("Configuration file name", value="agent_config.json")
+            config_file = st.text_input("Configuration file name", value=config_service.agent_path)
         
-            with open(config_file, "r") as f:
-                st.session_state.agents = json.load(f)
+            if os.path.abspath(config_file) == os.path.abspath(config_service.agent_path):
+                config_service.refresh()
+                config = config_service.snapshot
+                st.session_state.agents = copy.deepcopy(list(config.agents))
+                st.session_state.config_version = config.version
+            else:
+                st.session_state.agents = read_agents(config_file)
             st.success("Configuration loaded successfully!")
             st.rerun()
         except Exception as e:
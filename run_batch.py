@@ -0,0 +1,170 @@
+# Headless batch mode
+#
+# Runs a file of questions against one or more agents from agent_config.json,
+# without Streamlit, through the same turn pipeline as the chat
+# (utils.turn_engine). Questions are asked with bounded concurrency, the
+# generated code runs in the sandbox pool, and one JSON line per
+# (question, agent) is written as soon as it is ready, with the answer, stdout,
+# errors, the paths of the rendered charts and the stage timings.
+#
+# The questions file is plain text (one question per line) or JSONL with a
+# "question" or "prompt" field. Without an API key in variables.env (or with
+# --fake) answers come from the offline fake model.
+#
+# Usage:
+#   python run_batch.py questions.txt --agents "Default Agent" --concurrency 8 --out results.jsonl
+import argparse
+import asyncio
+import json
+import os
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.config_service import AGENT_CONFIG_PATH, default_agent, get_config_service, read_agents
+from utils.dataset import dataset_fingerprint
+from utils.dataset_registry import get_dataset_registry
+from utils.executor import DEFAULT_WORKERS, get_executor
+from utils.fake_model import use_fake_model
+from utils.metrics import percentile
+from utils.profiler import get_profile, with_profile
+from utils.turn_engine import run_turn
+
+DEFAULT_MODEL = "models/gemini-2.0-flash"
+DEFAULT_CONCURRENCY = 8
+
+
+def load_questions(path: str) -> list:
+    questions = []
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if line.startswith("{"):
+                record = json.loads(line)
+                line = record.get("question") or record.get("prompt") or ""
+            if line:
+                questions.append(line)
+    return questions
+
+
+def load_agents(path: str, names: list) -> list:
+    agents = read_agents(path) if os.path.exists(path) else [default_agent()]
+    if not names:
+        return [agent for agent in agents if agent.get("active", True)] or agents[:1]
+    by_name = {agent["name"]: agent for agent in agents}
+    missing = [name for name in names if name not in by_name]
+    if missing:
+        raise SystemExit(f"Unknown agent(s): {', '.join(missing)} (known: {', '.join(by_name)})")
+    return [by_name[name] for name in names]
+
+
+def slug(text: str) -> str:
+    return re.sub(r"[^A-Za-z0-9]+", "_", text).strip("_").lower() or "agent"
+
+
+def make_client(fake: bool):
+    api_key = get_config_service().snapshot.api_key
+    if fake or use_fake_model(api_key):
+        from utils.fake_model import FakeClient
+        return FakeClient()
+    from utils.chat_manager import make_client as make_gemini_client
+    return make_gemini_client(api_key)
+
+
+async def run_batch(args, questions: list, agents: list) -> list:
+    client = make_client(args.fake)
+    dataset_hash = dataset_fingerprint(args.dataset)
+    profile = get_profile(args.dataset)
+    instructions = {agent["name"]: with_profile(agent["persona"], profile) for agent in agents}
+    semaphore = asyncio.Semaphore(args.concurrency)
+    # Each turn in flight runs on a thread of the loop's default executor
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=args.concurrency))
+    os.makedirs(args.charts_dir, exist_ok=True)
+    total = len(questions) * len(agents)
+    summaries = []
+
+    async def ask(index: int, question: str, agent: dict):
+        async with semaphore:
+            return index, question, agent, await run_turn(
+                client, args.model, agent, instructions[agent["name"]], question, [],
+                args.dataset, dataset_hash, use_cache=not args.no_cache,
+                session_id="batch", mode="batch"
+            )
+
+    tasks = [ask(index, question, agent) for index, question in enumerate(questions) for agent in agents]
+    with open(args.out, "w") as out:
+        for done, next_result in enumerate(asyncio.as_completed(tasks), start=1):
+            index, question, agent, answer = await next_result
+            chart_paths = []
+            for chart_index, chart in enumerate(answer["charts"]):
+                chart_path = os.path.join(args.charts_dir, f"{index:05d}_{slug(agent['name'])}_{chart_index}.png")
+                with open(chart_path, "wb") as f:
+                    f.write(chart)
+                chart_paths.append(chart_path)
+            trace = answer["trace"]
+            record = {
+                "index": index,
+                "question": question,
+                "agent": agent["name"],
+                "model": args.model,
+                "explanation": answer["explanation"],
+                "code": answer["code"],
+                "stdout": answer["stdout"],
+                "error": answer["error"],
+                "charts": chart_paths,
+                "cached": answer["cached"],
+                "exec_cached": answer["exec_cached"],
+                "latency": answer["latency"],
+                "timings": trace["stages"],
+                "tokens": trace["tokens"],
+            }
+            out.write(json.dumps(record) + "\n")
+            out.flush()
+            summaries.append(record)
+            status = "error" if record["error"] else "ok"
+            print(f"[{done}/{total}] {agent['name']}: {question[:60]!r} {status} {record['latency']:.1f}s",
+                  file=sys.stderr)
+    return summaries
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a file of questions against DataChatApp agents")
+    parser.add_argument("questions", help="text file (one question per line) or JSONL")
+    parser.add_argument("--agents", nargs="*", default=[], help="agent names (default: all active agents)")
+    parser.add_argument("--agent-config", default=AGENT_CONFIG_PATH)
+    parser.add_argument("--dataset", default=None, help="dataset file (default: the app's default dataset)")
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="questions in flight")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="code execution processes")
+    parser.add_argument("--out", default="batch_results.jsonl")
+    parser.add_argument("--charts-dir", default=None, help="where chart PNGs go (default: <out>_charts)")
+    parser.add_argument("--no-cache", action="store_true", help="bypass the response and execution caches")
+    parser.add_argument("--fake", action="store_true", help="use the offline fake model")
+    args = parser.parse_args()
+
+    args.dataset = args.dataset or get_dataset_registry().default_path()
+    args.charts_dir = args.charts_dir or f"{os.path.splitext(args.out)[0]}_charts"
+    questions = load_questions(args.questions)
+    agents = load_agents(args.agent_config, args.agents)
+
+    # Start the sandbox pool with enough workers for the requested concurrency
+    executor = get_executor(args.dataset, workers=args.workers)
+    start_time = time.perf_counter()
+    try:
+        records = asyncio.run(run_batch(args, questions, agents))
+    finally:
+        executor.shutdown()
+    wall = time.perf_counter() - start_time
+
+    latencies = [record["latency"] for record in records]
+    errors = sum(1 for record in records if record["error"])
+    print(f"{len(records)} answers ({len(questions)} questions x {len(agents)} agents) in {wall:.1f}s; "
+          f"{errors} errors; latency p50 {percentile(latencies, 50):.2f}s p95 {percentile(latencies, 95):.2f}s; "
+          f"results in {args.out}")
+
+
+if __name__ == "__main__":
+    main()
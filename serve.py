@@ -0,0 +1,35 @@
+# Start the app in a prewarmed server process
+#
+# `streamlit run DataChatApp.py` only imports the heavy modules, spawns the
+# sandbox workers, loads the dataset and connects to the API once the first
+# page is opened, so the first user after a (re)start waits for all of it. This
+# launcher starts the prewarm (see utils.startup) and the metrics server as
+# soon as the process starts and then hands over to Streamlit in the same
+# process, so the first session finds everything loaded. /ready on the metrics
+# port answers 200 once the prewarm is done, for readiness probes.
+#
+# Usage:
+#   python serve.py [streamlit options, e.g. --server.port 8501]
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+APP = os.path.join(ROOT, "DataChatApp.py")
+
+
+def main():
+    from utils.metrics import start_metrics_server
+    from utils.startup import start_prewarm
+
+    # Bound to all interfaces, so that probes and scrapers from outside the
+    # container or host reach /ready and /metrics
+    start_metrics_server(host=os.environ.get("DATACHAT_METRICS_HOST", "0.0.0.0"))
+    start_prewarm(from_settings=True)
+
+    from streamlit.web import cli
+    sys.argv = ["streamlit", "run", APP] + sys.argv[1:]
+    sys.exit(cli.main())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,21 @@
+# Shared fixtures: the repository on sys.path (also for the sandbox's spawned
+# workers) and a scratch working directory for the caches, blobs and stores,
+# which all live under relative paths
+import os
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # Fresh .cache/, chart_blobs/ and process-wide caches for one test
+    import utils.exec_cache
+    import utils.response_cache
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(utils.exec_cache, "_cache", None)
+    monkeypatch.setattr(utils.response_cache, "_cache", None)
+    return tmp_path
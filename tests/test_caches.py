@@ -0,0 +1,163 @@
+# Response and execution caches, and what the turn pipeline puts in them:
+# only answers that parse are cached
+import asyncio
+import json
+import shutil
+import threading
+import time
+import pytest
+from utils.blob_store import BLOB_DIR, put_chart
+from utils.chat_manager import build_config
+from utils.config_service import DEFAULT_RESPONSE_SCHEMA
+from utils.exec_cache import ExecCache
+from utils.fake_model import FakeClient, FakeModelConfig
+from utils.metrics import TurnTrace
+from utils.response_cache import ResponseCache, get_response_cache, make_key, normalize_prompt
+from utils.turn_engine import run_chat_turn, run_turn
+
+MODEL = "models/test"
+PERSONA = "You are a data analyst."
+PROMPT = "How many passengers were there?"
+ANSWER = {"code": "", "explanation": "There were 891 passengers."}
+AGENT = {"name": "Analyst", "response-schema": DEFAULT_RESPONSE_SCHEMA}
+PNG = b"\x89PNG\r\n\x1a\n" + b"chart" * 20
+
+
+def response_key(prompt: str = PROMPT, history=()) -> str:
+    return make_key(MODEL, PERSONA, DEFAULT_RESPONSE_SCHEMA, "hash", prompt, list(history))
+
+
+@pytest.fixture
+def client(workdir):
+    recordings = workdir / "recordings.jsonl"
+    recordings.write_text(json.dumps({"prompt": PROMPT, "response": ANSWER}) + "\n")
+    return FakeClient(FakeModelConfig(latency=0.0, jitter=0.0, ttft=0.0, recordings=str(recordings), seed=1))
+
+
+def chat_session(client) -> dict:
+    # What chat_manager.get_chat_session returns, without Streamlit
+    config = build_config(PERSONA, DEFAULT_RESPONSE_SCHEMA)
+    return {"model": MODEL, "chat": client.chats.create(model=MODEL, config=config), "config": config}
+
+
+def ask(client, prompt: str = PROMPT) -> dict:
+    return asyncio.run(run_turn(client, MODEL, AGENT, PERSONA, prompt, [], dataset="", dataset_hash="hash"))
+
+
+def test_prompt_normalisation_keeps_case():
+    assert normalize_prompt("  How many\n passengers?  ") == "How many passengers?"
+    assert response_key("Count sex == 'Male'") != response_key("Count sex == 'male'")
+    assert response_key("Count  rows") == response_key("Count rows")
+
+
+def test_key_depends_on_history():
+    history = [{"role": "user", "content": "Only first class"},
+               {"role": "assistant", "content": {"code": "", "explanation": "Filtered."}}]
+    assert response_key(history=history) != response_key()
+    # The system persona is part of the key already, not of the history
+    assert response_key(history=[{"role": "system", "content": PERSONA}]) == response_key()
+
+
+def test_response_cache_survives_restart(workdir):
+    path = str(workdir / "responses.sqlite")
+    ResponseCache(path).put("key", "text", model=MODEL, prompt=PROMPT)
+    cache = ResponseCache(path)
+    assert cache.get("key") == "text"
+    assert cache.get("other") is None
+    assert cache.stats() == {"hits": 1, "misses": 1, "entries": 1}
+
+
+def test_response_cache_expires_entries(workdir):
+    cache = ResponseCache(str(workdir / "responses.sqlite"), ttl=0.2)
+    cache.put("key", "text")
+    assert cache.get("key") == "text"
+    time.sleep(0.3)
+    assert cache.get("key") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_response_cache_trims_least_recently_used(workdir):
+    cache = ResponseCache(str(workdir / "responses.sqlite"), memory_entries=1, max_disk_bytes=25)
+    cache.put("old", "x" * 10)
+    cache.put("used", "y" * 10)
+    cache.get("old")
+    cache.put("new", "z" * 10)
+    assert cache.get("used") is None
+    assert cache.get("old") == "x" * 10
+    assert cache.get("new") == "z" * 10
+
+
+def test_exec_cache_round_trip_with_charts(workdir):
+    cache = ExecCache(str(workdir / "executions.sqlite"))
+    cache.put("key", {"stdout": "891\n", "error": None, "charts": [PNG], "duration": 0.5})
+    assert cache.get("key") == {"stdout": "891\n", "error": None, "charts": [PNG],
+                                "chart_refs": [put_chart(PNG)], "duration": 0.5}
+
+
+def test_exec_cache_skips_errors_and_missing_charts(workdir):
+    cache = ExecCache(str(workdir / "executions.sqlite"))
+    cache.put("failed", {"stdout": "", "error": "KeyError: 'x'", "charts": []})
+    assert cache.get("failed") is None
+    cache.put("chart", {"stdout": "", "error": None, "charts": [PNG]})
+    shutil.rmtree(BLOB_DIR)
+    assert cache.get("chart") is None
+
+
+def test_exec_cache_evicts_beyond_max_entries(workdir):
+    cache = ExecCache(str(workdir / "executions.sqlite"), max_entries=2)
+    for key in ("a", "b", "c"):
+        cache.put(key, {"stdout": key, "error": None, "charts": []})
+        time.sleep(0.01)
+    assert cache.get("a") is None
+    assert cache.stats()["entries"] == 2
+
+
+def test_turn_answer_is_cached(client):
+    first = ask(client)
+    second = ask(client)
+    assert first["explanation"] == second["explanation"] == ANSWER["explanation"]
+    assert not first["cached"] and second["cached"]
+    assert client.calls == 1
+    # A prompt that differs in case is a different question
+    assert not ask(client, PROMPT.upper())["cached"]
+
+
+def test_unparseable_answer_is_not_cached(client):
+    client._backend.answer = lambda prompt, config: '{"code": "", "explanation": "There were 8'
+    failed = ask(client)
+    assert failed["error"].startswith("Error generating response:")
+    assert get_response_cache().stats()["entries"] == 0
+
+    # Asked again rather than replayed from the cache
+    del client._backend.answer
+    answer = ask(client)
+    assert answer["error"] is None and not answer["cached"]
+    assert answer["explanation"] == ANSWER["explanation"]
+    assert client.calls == 2
+
+
+def test_chat_turn_caches_only_parsed_answers(client):
+    session = chat_session(client)
+    client._backend.answer = lambda prompt, config: "not json"
+    turn = dict(agent_name="Analyst", system_instruction=PERSONA, schema=DEFAULT_RESPONSE_SCHEMA, prompt=PROMPT,
+                history=[], dataset="", dataset_hash="hash", stream=True)
+    failed = run_chat_turn(client, session, **turn)
+    assert failed["failed"] and not failed["cancelled"]
+    assert get_response_cache().stats()["entries"] == 0
+
+    del client._backend.answer
+    answer = run_chat_turn(client, session, **turn)
+    assert answer["failed"] is None and answer["explanation"] == ANSWER["explanation"]
+    assert get_response_cache().stats()["entries"] == 1
+    assert run_chat_turn(client, session, **turn)["cached"]
+
+
+def test_cancelled_turn_is_not_cached(client):
+    client.config.latency = 2.0
+    cancel = threading.Event()
+    threading.Timer(0.2, cancel.set).start()
+    trace = TurnTrace("session", MODEL)
+    answer = run_chat_turn(client, chat_session(client), "Analyst", PERSONA, DEFAULT_RESPONSE_SCHEMA, PROMPT, [],
+                           dataset="", dataset_hash="hash", stream=False, cancel=cancel, trace=trace)
+    assert answer["cancelled"]
+    assert get_response_cache().stats()["entries"] == 0
@@ -0,0 +1,109 @@
+# SQLite chat store: saving, listing, loading, deleting and the one-time
+# import of the legacy saved_chats.json
+import base64
+import json
+import os
+import pytest
+from utils.blob_store import get_chart
+from utils.chat_store import ChatStore, new_chat_name
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"chart" * 20
+
+
+def messages(question: str, answer: str, charts=None) -> list:
+    content = {"explanation": answer, "code": "print(1)"}
+    if charts is not None:
+        content["chart_images"] = charts
+    return [
+        {"role": "system", "content": "You are a data analyst."},
+        {"role": "user", "content": question},
+        {"role": "assistant", "content": content},
+    ]
+
+
+@pytest.fixture
+def store(workdir):
+    return ChatStore(str(workdir / "chats.db"))
+
+
+def test_save_and_load_round_trip(store):
+    store.save_chat("a", messages("How many rows?", "891 rows."), timestamp="2024-01-01_10-00-00",
+                    title="Rows")
+    assert store.count_chats() == 1
+    assert store.list_chats() == [
+        {"name": "a", "title": "Rows", "timestamp": "2024-01-01_10-00-00", "message_count": 3}
+    ]
+    loaded = store.load_messages("a")
+    assert [message["role"] for message in loaded] == ["system", "user", "assistant"]
+    assert loaded[2]["content"]["explanation"] == "891 rows."
+    assert store.load_messages("a", limit=2) == loaded[:2]
+
+
+def test_saving_again_replaces_the_chat(store):
+    store.save_chat("a", messages("First?", "one"))
+    store.save_chat("a", messages("Second?", "two")[:2])
+    assert store.count_chats() == 1
+    assert store.list_chats()[0]["message_count"] == 2
+    assert store.load_messages("a")[-1]["content"] == "Second?"
+
+
+def test_list_is_newest_first_and_paged(store):
+    for day in range(1, 6):
+        store.save_chat(f"chat{day}", messages("q", "a"), timestamp=f"2024-01-0{day}_00-00-00")
+    names = [chat["name"] for chat in store.list_chats(limit=2)]
+    assert names == ["chat5", "chat4"]
+    assert [chat["name"] for chat in store.list_chats(limit=2, offset=4)] == ["chat1"]
+
+
+def test_delete_removes_messages(store):
+    store.save_chat("a", messages("q", "a"))
+    store.save_chat("b", messages("q", "b"))
+    store.delete_chat("a")
+    assert [chat["name"] for chat in store.list_chats()] == ["b"]
+    assert store.load_messages("a") == []
+
+
+def test_failed_save_leaves_the_previous_version(store):
+    store.save_chat("a", messages("q", "kept"))
+    with pytest.raises(TypeError):
+        store.save_chat("a", [{"role": "user", "content": object()}])
+    assert store.load_messages("a")[-1]["content"]["explanation"] == "kept"
+
+
+def test_charts_are_stored_as_blob_references(store):
+    store.save_chat("a", messages("Plot it", "A chart.", charts=[base64.b64encode(PNG).decode()]))
+    content = store.load_messages("a")[-1]["content"]
+    assert "chart_images" not in content
+    assert [get_chart(ref) for ref in content["chart_refs"]] == [PNG]
+
+
+def test_chat_names_are_unique_within_a_second():
+    assert new_chat_name("2024-01-01_10-00-00") != new_chat_name("2024-01-01_10-00-00")
+
+
+def test_migrates_legacy_json_once(store, workdir):
+    legacy = workdir / "saved_chats.json"
+    legacy.write_text(json.dumps({
+        "Chat_1": {"timestamp": "2024-01-01_10-00-00", "messages": messages("q1", "a1")},
+        "Chat_2": {"timestamp": "2024-01-02_10-00-00", "title": "Second",
+                   "messages": messages("q2", "a2", charts=[base64.b64encode(PNG).decode()])},
+    }))
+    assert store.migrate_from_json(str(legacy)) == 2
+    assert not legacy.exists()
+    assert os.path.exists(f"{legacy}.migrated")
+    assert [chat["title"] for chat in store.list_chats()] == ["Second", "Chat_1"]
+    assert get_chart(store.load_messages("Chat_2")[-1]["content"]["chart_refs"][0]) == PNG
+    # Nothing left to import on the next start
+    assert store.migrate_from_json(str(legacy)) == 0
+
+
+@pytest.mark.parametrize("text", ['{"Chat_1": {"messages": [', "not json", "[1, 2, 3]"])
+def test_corrupt_legacy_json_is_moved_aside(store, workdir, text):
+    legacy = workdir / "saved_chats.json"
+    legacy.write_text(text)
+    assert store.migrate_from_json(str(legacy)) == 0
+    assert not legacy.exists()
+    assert (workdir / "saved_chats.json.corrupt").read_text() == text
+    # The store still works
+    store.save_chat("a", messages("q", "a"))
+    assert store.count_chats() == 1
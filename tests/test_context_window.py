@@ -0,0 +1,96 @@
+# Token-aware context window: which turns are sent in full, the notes for
+# dropped turns and the rolling summary written in the background
+import pytest
+import utils.context_window
+from utils.context_window import build_context, reset_context
+from utils.fake_model import FakeClient, FakeModelConfig
+from utils.scheduler import RequestScheduler
+
+MODEL = "models/test"
+BUDGET = 500         # tokens; each turn below is about 110
+SUMMARY = "The user looked at survival by class and age."
+
+
+def conversation(turns: int, offset: int = 0) -> list:
+    messages = [{"role": "system", "content": "You are a data analyst."}]
+    for index in range(offset, offset + turns):
+        messages.append({"role": "user", "content": f"Question {index}"})
+        messages.append({"role": "assistant", "content": {"code": "", "explanation": f"Answer {index}. " + "x" * 400}})
+    return messages
+
+
+def texts(context) -> list:
+    return [content.parts[0].text for content in context.contents]
+
+
+@pytest.fixture
+def client(workdir, monkeypatch):
+    monkeypatch.setattr(utils.context_window, "DEFAULT_HISTORY_BUDGET", BUDGET)
+    monkeypatch.setattr(utils.context_window, "get_scheduler", lambda: RequestScheduler(requests_per_minute=0))
+    reset_context()
+    client = FakeClient(FakeModelConfig(latency=0.0, jitter=0.0, ttft=0.0, seed=1))
+    client._backend.answer = lambda prompt, config: SUMMARY
+    return client
+
+
+def finish_summary():
+    pending = utils.context_window._state()["pending"]
+    if pending is not None:
+        pending.result(timeout=5)
+
+
+def test_short_history_is_sent_in_full(client):
+    context = build_context(client, MODEL, conversation(3))
+    assert context.summarized_turns == 0
+    assert len(context.contents) == 6
+    assert [content.role for content in context.contents] == ["user", "model"] * 3
+    assert texts(context)[0] == "Question 0"
+    assert context.tokens <= BUDGET
+    assert client.calls == 0
+
+
+def test_system_prompt_and_unanswered_questions_are_not_sent(client):
+    messages = conversation(2) + [{"role": "user", "content": "A question that failed"}]
+    context = build_context(client, MODEL, messages)
+    assert "A question that failed" not in texts(context)
+    assert "You are a data analyst." not in texts(context)
+
+
+def test_long_history_is_trimmed_and_summarised(client):
+    messages = conversation(10)
+    context = build_context(client, MODEL, messages)
+    assert context.summarized_turns > 0
+    assert context.tokens <= BUDGET
+    # Until the summary arrives, the dropped turns are represented by their questions
+    recap = texts(context)[0]
+    assert recap.startswith("Summary of our earlier conversation:")
+    assert "- Question 0" in recap
+    assert texts(context)[2] == f"Question {context.summarized_turns}"
+    assert texts(context)[-1].startswith('{"code": "", "explanation": "Answer 9.')
+
+    finish_summary()
+    summarised = build_context(client, MODEL, messages)
+    assert SUMMARY in texts(summarised)[0]
+    assert "- Question 0" not in texts(summarised)[0]
+    assert summarised.key != context.key
+    assert client.calls == 1
+
+
+def test_window_stays_put_while_it_fits(client):
+    messages = conversation(10)
+    first = build_context(client, MODEL, messages)
+    finish_summary()
+    build_context(client, MODEL, messages)
+    # The window was trimmed below the budget, so the next turn still fits
+    messages += conversation(1, offset=10)[1:]
+    grown = build_context(client, MODEL, messages)
+    assert grown.summarized_turns == first.summarized_turns
+    assert grown.tokens <= BUDGET
+
+
+def test_different_conversation_resets_the_window(client):
+    build_context(client, MODEL, conversation(10))
+    finish_summary()
+    context = build_context(client, MODEL, conversation(2, offset=50))
+    assert context.summarized_turns == 0
+    assert SUMMARY not in " ".join(texts(context))
@@ -0,0 +1,118 @@
+# Sandboxed executor: results, timeout, memory cap, cancellation, global state
+# between jobs on a shared worker, and the read-only query engine
+import os
+import threading
+import time
+import pytest
+from utils.executor import CodeExecutor, psutil
+from utils.turn_engine import TurnCancelled, wait_for_exec
+
+TITANIC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "titanic.csv")
+
+
+@pytest.fixture(scope="module")
+def executor(tmp_path_factory):
+    # One worker, so consecutive jobs share it; workers (and their replacements)
+    # keep their dataset caches in a scratch directory
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.chdir(tmp_path_factory.mktemp("executor"))
+        executor = CodeExecutor(workers=1, timeout=20, memory_limit_mb=1024, dataset=TITANIC)
+        assert executor.wait_ready(60)
+        yield executor
+        executor.shutdown()
+
+
+def run(executor, code: str, **kwargs) -> dict:
+    return executor.run(code, dataset=TITANIC, use_cache=False, **kwargs)
+
+
+def test_runs_code_with_the_dataset(executor):
+    result = run(executor, "print(len(df), db.count())")
+    assert result["error"] is None
+    assert result["stdout"].strip() == "891 891"
+
+
+def test_captures_charts(executor):
+    result = run(executor, "import matplotlib.pyplot as plt\nplt.plot([1, 2, 3])")
+    assert result["error"] is None
+    assert len(result["charts"]) == 1
+    assert result["charts"][0].startswith(b"\x89PNG")
+
+
+def test_error_is_returned_not_raised(executor):
+    result = run(executor, "print('before')\nraise ValueError('bad column')")
+    assert result["error"] == "ValueError: bad column"
+    assert result["stdout"] == "before\n"
+    assert run(executor, "print('next')")["stdout"] == "next\n"
+
+
+def test_timeout_kills_the_worker(executor):
+    start = time.perf_counter()
+    result = run(executor, "import time\ntime.sleep(30)", timeout=1)
+    assert result["error"] == "Execution timed out after 1s"
+    assert time.perf_counter() - start < 5
+    # The replacement worker serves the next job
+    assert run(executor, "print(1 + 1)")["stdout"] == "2\n"
+
+
+@pytest.mark.skipif(psutil is None, reason="the memory cap needs psutil")
+def test_memory_cap_kills_the_worker(executor):
+    code = "import time\nblocks = []\nfor _ in range(40):\n    blocks.append(bytearray(64 * 1024 * 1024))\n" \
+           "    time.sleep(0.05)"
+    result = run(executor, code)
+    assert result["error"] == "Execution exceeded the 1024 MB memory limit"
+    assert run(executor, "print('alive')")["stdout"] == "alive\n"
+
+
+def test_cancel_kills_the_job(executor):
+    job = executor.submit("import time\ntime.sleep(30)", dataset=TITANIC, use_cache=False)
+    cancel = threading.Event()
+    threading.Timer(0.5, cancel.set).start()
+    start = time.perf_counter()
+    with pytest.raises(TurnCancelled):
+        wait_for_exec(job, cancel)
+    assert job.result(timeout=5)["error"] == "Execution cancelled"
+    assert time.perf_counter() - start < 5
+    assert run(executor, "print('alive')")["stdout"] == "alive\n"
+
+
+def test_global_state_does_not_leak_between_jobs(executor):
+    changed = run(executor, "import matplotlib\nimport pandas as pd\n"
+                            "matplotlib.rcParams['lines.linewidth'] = 9\npd.set_option('display.max_rows', 3)")
+    assert changed["error"] is None
+    result = run(executor, "import matplotlib\nimport pandas as pd\n"
+                           "print(matplotlib.rcParams['lines.linewidth'], pd.get_option('display.max_rows'))")
+    assert result["stdout"] == "1.5 60\n"
+
+
+def test_globals_of_a_job_are_not_seen_by_the_next(executor):
+    run(executor, "leaked = 1\ndf.drop(columns=['Age'], inplace=True)")
+    result = run(executor, "print('leaked' in globals(), 'Age' in df.columns)")
+    assert result["stdout"] == "False True\n"
+
+
+@pytest.mark.parametrize("statement", [
+    "CREATE TABLE t AS SELECT 1",
+    "DROP VIEW data",
+    "INSERT INTO data SELECT * FROM data",
+    "SET memory_limit = '64GB'",
+])
+def test_db_only_runs_read_only_queries(executor, statement):
+    result = run(executor, f"db.sql({statement!r})")
+    assert result["error"].startswith("ValueError: db.sql only runs read-only queries")
+    assert run(executor, "print(db.count())")["stdout"] == "891\n"
+
+
+def test_results_are_cached(workdir):
+    executor = CodeExecutor(workers=1, timeout=20, dataset=TITANIC)
+    try:
+        first = executor.run("print(df['Age'].max())", dataset=TITANIC)
+        second = executor.run("print(df['Age'].max())", dataset=TITANIC)
+        failed = executor.run("raise KeyError('x')", dataset=TITANIC)
+        again = executor.run("raise KeyError('x')", dataset=TITANIC)
+    finally:
+        executor.shutdown()
+    assert not first.get("cached") and second["cached"]
+    assert second["stdout"] == first["stdout"] == "80.0\n"
+    # Errors are not cached
+    assert failed["error"] and not again.get("cached")
@@ -0,0 +1,127 @@
+# Model routing: question classification, ranking by recent health, and
+# hedged requests to the runner-up model
+import threading
+import time
+from concurrent.futures import CancelledError
+import pytest
+from google.genai import errors
+import utils.model_router
+from utils.fake_model import FakeClient, FakeModelConfig
+from utils.model_router import (FAST_MODELS, MIN_SAMPLES, STRONG_MODELS, Route, choose_route, generate_hedged,
+                                is_simple)
+from utils.scheduler import RequestScheduler
+
+PROMPT = "How many passengers were there?"
+
+
+class ModelsClient:
+    # One fake backend per model name, so models can differ in speed and errors
+    def __init__(self, **configs):
+        self.clients = {model: FakeClient(FakeModelConfig(**dict({"jitter": 0.0, "seed": 1}, **config)))
+                        for model, config in configs.items()}
+        self.models = self
+
+    def generate_content(self, *, model: str, contents, config=None):
+        return self.clients[model].models.generate_content(model=model, contents=contents, config=config)
+
+    def calls(self, model: str) -> int:
+        return self.clients[model].calls
+
+
+@pytest.fixture
+def scheduler(monkeypatch):
+    scheduler = RequestScheduler(requests_per_minute=0, max_retries=0)
+    monkeypatch.setattr(utils.model_router, "get_scheduler", lambda: scheduler)
+    monkeypatch.setattr(utils.model_router, "DEFAULT_HEDGE_DELAY", 0.3)
+    return scheduler
+
+
+@pytest.mark.parametrize("prompt, simple", [
+    ("How many passengers were there?", True),
+    ("Plot the age distribution", True),
+    ("Why did more women survive than men?", False),
+    ("Is fare correlated with survival?", False),
+    ("Show the fare by class? And by port?", False),
+    ("List " + "the passengers " * 15, False),
+])
+def test_is_simple(prompt, simple):
+    assert is_simple(prompt) is simple
+
+
+def test_simple_questions_go_to_the_fast_tier(scheduler):
+    route = choose_route(PROMPT)
+    assert (route.model, route.backup, route.tier) == (FAST_MODELS[0], FAST_MODELS[1], "fast")
+
+
+def test_complex_questions_go_to_the_strong_tier(scheduler):
+    route = choose_route("Explain what drives survival")
+    assert (route.model, route.tier, route.reason) == (STRONG_MODELS[0], "strong", "complex question")
+
+
+def test_escalation_skips_models_already_tried(scheduler):
+    route = choose_route(PROMPT, escalate=True, exclude=[STRONG_MODELS[0]])
+    assert (route.model, route.tier, route.reason) == (STRONG_MODELS[1], "strong", "escalated")
+
+
+def test_slow_or_failing_model_is_ranked_down(scheduler):
+    for _ in range(MIN_SAMPLES):
+        scheduler._record_attempt(FAST_MODELS[0], 3.0, True)
+        scheduler._record_attempt(FAST_MODELS[1], 1.0, True)
+    assert choose_route(PROMPT).model == FAST_MODELS[1]
+    for _ in range(MIN_SAMPLES * 4):
+        scheduler._record_attempt(FAST_MODELS[1], 1.0, False)
+    assert choose_route(PROMPT).model == FAST_MODELS[0]
+
+
+def test_fast_answer_is_not_hedged(scheduler):
+    client = ModelsClient(a={"latency": 0.05}, b={"latency": 0.05})
+    route = Route("a", "b", "fast", "test")
+    model, response, hedged = generate_hedged(client, route, PROMPT)
+    assert (model, hedged) == ("a", False)
+    assert response.text
+    assert client.calls("b") == 0
+
+
+def test_slow_model_is_hedged(scheduler):
+    client = ModelsClient(a={"latency": 3.0}, b={"latency": 0.05})
+    route = Route("a", "b", "fast", "test")
+    start = time.perf_counter()
+    model, response, hedged = generate_hedged(client, route, PROMPT)
+    assert (model, hedged) == ("b", True)
+    assert time.perf_counter() - start < 1.5
+
+
+def test_failed_model_falls_back_without_waiting(scheduler):
+    client = ModelsClient(a={"latency": 0.0, "error_rate": 1.0}, b={"latency": 0.05})
+    route = Route("a", "b", "fast", "test")
+    start = time.perf_counter()
+    assert generate_hedged(client, route, PROMPT)[0] == "b"
+    assert time.perf_counter() - start < 0.3
+
+
+def test_invalid_answer_falls_back(scheduler):
+    client = ModelsClient(a={"latency": 0.0}, b={"latency": 0.05})
+    route = Route("a", "b", "fast", "test")
+    responses = []
+
+    def validate(response):
+        responses.append(response)
+        return len(responses) > 1
+
+    assert generate_hedged(client, route, PROMPT, validate=validate)[0] == "b"
+
+
+def test_error_is_raised_when_every_model_fails(scheduler):
+    client = ModelsClient(a={"latency": 0.0, "error_rate": 1.0}, b={"latency": 0.0, "error_rate": 1.0})
+    route = Route("a", "b", "fast", "test")
+    with pytest.raises(errors.ServerError):
+        generate_hedged(client, route, PROMPT)
+
+
+def test_cancel_stops_a_hedged_request(scheduler):
+    client = ModelsClient(a={"latency": 2.0}, b={"latency": 2.0})
+    route = Route("a", "b", "fast", "test")
+    cancel = threading.Event()
+    threading.Timer(0.2, cancel.set).start()
+    with pytest.raises(CancelledError):
+        generate_hedged(client, route, PROMPT, cancel=cancel)
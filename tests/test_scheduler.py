@@ -0,0 +1,168 @@
+# RequestScheduler against the offline fake model: rate limiting, coalescing,
+# retries of transient errors and cancellation
+import threading
+import time
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+import httpx
+import pytest
+from google.genai import errors
+import utils.scheduler
+from utils.fake_model import FakeClient, FakeModelConfig
+from utils.scheduler import RequestScheduler, TokenBucket, is_transient
+
+MODEL = "models/test"
+PROMPT = "What was the survival rate by passenger class?"
+
+
+def fake_client(**config) -> FakeClient:
+    return FakeClient(FakeModelConfig(**dict({"latency": 0.0, "jitter": 0.0, "ttft": 0.0, "seed": 1}, **config)))
+
+
+def api_error(code: int) -> errors.APIError:
+    error_class = errors.ClientError if code < 500 else errors.ServerError
+    return error_class(code, {"error": {"code": code, "status": "TEST", "message": f"simulated {code}"}})
+
+
+class FlakyModels:
+    # generate_content fails with the given errors first, then answers
+    def __init__(self, client: FakeClient, failures: list):
+        self._models = client.models
+        self.failures = list(failures)
+        self.calls = 0
+
+    def generate_content(self, **kwargs):
+        self.calls += 1
+        if self.failures:
+            raise self.failures.pop(0)
+        return self._models.generate_content(**kwargs)
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(utils.scheduler, "backoff_delay", lambda attempt: 0.0)
+
+
+def test_token_bucket_allows_burst_then_spaces_requests():
+    bucket = TokenBucket(requests_per_minute=60, burst=2)
+    assert bucket.reserve() == 0.0
+    assert bucket.reserve() == 0.0
+    # Out of tokens: one request per second, in arrival order
+    assert bucket.reserve() == pytest.approx(1.0, abs=0.05)
+    assert bucket.reserve() == pytest.approx(2.0, abs=0.05)
+
+
+def test_rate_limit_delays_requests_over_the_burst():
+    scheduler = RequestScheduler(requests_per_minute=600, max_concurrent=4)
+    scheduler._buckets[MODEL] = TokenBucket(600, burst=1)
+    client = fake_client()
+    start = time.perf_counter()
+    for index in range(3):
+        scheduler.generate(client, MODEL, f"{PROMPT} {index}")
+    # 10 requests per second after the first one
+    assert time.perf_counter() - start >= 0.18
+
+
+def test_identical_concurrent_requests_are_coalesced():
+    scheduler = RequestScheduler(requests_per_minute=0)
+    client = fake_client(latency=0.3)
+    with ThreadPoolExecutor(4) as pool:
+        responses = list(pool.map(lambda _: scheduler.generate(client, MODEL, PROMPT), range(4)))
+    assert client.calls == 1
+    assert scheduler.stats()["coalesced"] == 3
+    assert len({response.text for response in responses}) == 1
+
+
+def test_streams_are_replayed_to_late_subscribers():
+    scheduler = RequestScheduler(requests_per_minute=0)
+    client = fake_client(latency=0.3, chunk_size=8)
+    first = scheduler.generate_stream(client, MODEL, PROMPT)
+    first_chunk = next(first)
+    second = "".join(chunk.text for chunk in scheduler.generate_stream(client, MODEL, PROMPT))
+    assert first_chunk.text + "".join(chunk.text for chunk in first) == second
+    assert client.calls == 1
+
+
+def test_different_requests_are_not_coalesced():
+    scheduler = RequestScheduler(requests_per_minute=0)
+    client = fake_client()
+    scheduler.generate(client, MODEL, PROMPT)
+    scheduler.generate(client, MODEL, PROMPT + " in percent")
+    scheduler.generate(client, "models/other", PROMPT)
+    assert client.calls == 3
+
+
+@pytest.mark.parametrize("code", [429, 500, 503])
+def test_transient_errors_are_retried(code):
+    scheduler = RequestScheduler(requests_per_minute=0)
+    client = fake_client()
+    client.models = FlakyModels(client, [api_error(code), api_error(code)])
+    response = scheduler.generate(client, MODEL, PROMPT)
+    assert response.text
+    assert client.models.calls == 3
+    assert scheduler.stats()["retries"] == 2
+
+
+def test_dropped_connections_are_retried():
+    scheduler = RequestScheduler(requests_per_minute=0)
+    client = fake_client()
+    client.models = FlakyModels(client, [httpx.ConnectError("connection reset")])
+    assert scheduler.generate(client, MODEL, PROMPT).text
+    assert client.models.calls == 2
+
+
+@pytest.mark.parametrize("code", [400, 403, 404])
+def test_client_errors_are_not_retried(code):
+    scheduler = RequestScheduler(requests_per_minute=0)
+    client = fake_client()
+    client.models = FlakyModels(client, [api_error(code)])
+    assert not is_transient(api_error(code))
+    with pytest.raises(errors.ClientError):
+        scheduler.generate(client, MODEL, PROMPT)
+    assert client.models.calls == 1
+
+
+def test_retries_give_up_after_max_retries():
+    scheduler = RequestScheduler(requests_per_minute=0, max_retries=2)
+    client = fake_client(error_rate=1.0)
+    with pytest.raises(errors.ServerError):
+        scheduler.generate(client, MODEL, PROMPT)
+    assert client.calls == 3
+    assert scheduler.model_health(MODEL)["error_rate"] == 1.0
+
+
+def test_cancel_stops_waiting_and_drops_the_request():
+    scheduler = RequestScheduler(requests_per_minute=0)
+    client = fake_client(latency=5.0)
+    cancel = threading.Event()
+    threading.Timer(0.2, cancel.set).start()
+    start = time.perf_counter()
+    with pytest.raises(CancelledError):
+        scheduler.generate(client, MODEL, PROMPT, cancel=cancel)
+    assert time.perf_counter() - start < 1.0
+
+
+def test_queued_request_is_dropped_when_every_caller_left():
+    # One thread: the second request waits in the queue behind the first
+    scheduler = RequestScheduler(requests_per_minute=0, max_concurrent=1)
+    client = fake_client(latency=0.3)
+    busy = scheduler.submit(client, MODEL, PROMPT)
+    queued = scheduler.submit(client, MODEL, PROMPT + " again")
+    scheduler.release(queued)
+    assert busy.result().text
+    with pytest.raises(CancelledError):
+        queued.result()
+    assert client.calls == 1
+
+
+def test_cancelled_stream_is_closed():
+    scheduler = RequestScheduler(requests_per_minute=0)
+    client = fake_client(latency=2.0, chunk_size=4)
+    cancel = threading.Event()
+    stream = scheduler.generate_stream(client, MODEL, PROMPT, cancel=cancel)
+    next(stream)
+    cancel.set()
+    with pytest.raises(CancelledError):
+        next(stream)
+    stream.close()
+    time.sleep(0.3)
+    assert scheduler.stats()["running"] == 0
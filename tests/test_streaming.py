@@ -0,0 +1,89 @@
+# StreamingJSONParser against json.loads on chunked input
+import json
+import random
+import pytest
+from utils.streaming import StreamingJSONParser
+
+DOCUMENTS = [
+    {"code": "print(df.head())", "explanation": "The first rows."},
+    {"explanation": "Line one\nLine \"two\"\t/ \\ done", "code": ""},
+    {"explanation": "Café über 中文", "code": "x = 1"},
+    {"explanation": "Survival \U0001F600 rate \U0001F4CA by class", "code": "df.plot()"},
+    {"meta": {"nested": ["a", {"b": "c}"}], "n": 3}, "explanation": "after nested", "count": 12,
+     "flag": True, "empty": None, "code": "y = [1, {'a': 2}]"},
+]
+
+
+def string_fields(text: str) -> dict:
+    return {key: value for key, value in json.loads(text).items() if isinstance(value, str)}
+
+
+def parse_chunks(chunks) -> StreamingJSONParser:
+    parser = StreamingJSONParser()
+    for chunk in chunks:
+        parser.feed(chunk)
+    return parser
+
+
+def split_every(text: str, size: int) -> list:
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+@pytest.mark.parametrize("ensure_ascii", [True, False])
+@pytest.mark.parametrize("document", DOCUMENTS)
+def test_matches_json_loads_for_every_chunk_size(document, ensure_ascii):
+    text = json.dumps(document, ensure_ascii=ensure_ascii)
+    for size in (1, 2, 3, 5, 7, len(text)):
+        parser = parse_chunks(split_every(text, size))
+        assert parser.done
+        assert parser.fields == string_fields(text)
+
+
+@pytest.mark.parametrize("document", DOCUMENTS)
+def test_matches_json_loads_for_random_splits(document):
+    text = json.dumps(document)
+    rng = random.Random(0)
+    for _ in range(50):
+        cuts = sorted(rng.sample(range(1, len(text)), min(8, len(text) - 1)))
+        chunks = [text[start:end] for start, end in zip([0] + cuts, cuts + [len(text)])]
+        assert parse_chunks(chunks).fields == string_fields(text)
+
+
+def test_escapes_split_across_chunks():
+    # The backslash, the "u" and the hex digits of each escape arrive separately
+    text = json.dumps({"explanation": "a\né\U0001F600z"})
+    parser = parse_chunks(list(text))
+    assert parser.get("explanation") == "a\né\U0001F600z"
+
+
+def test_surrogate_pair_is_combined():
+    text = '{"explanation": "\\ud83d\\ude00"}'
+    parser = parse_chunks(split_every(text, 1))
+    assert parser.get("explanation") == json.loads(text)["explanation"] == "\U0001F600"
+    parser.get("explanation").encode("utf-8")
+
+
+def test_partial_value_never_holds_a_lone_surrogate():
+    text = '{"explanation": "ok \\ud83d\\ude00 end"}'
+    parser = StreamingJSONParser()
+    for char in text:
+        parser.feed(char)
+        # Every partial value must be encodable, as Streamlit sends it to the browser
+        parser.get("explanation").encode("utf-8")
+    assert parser.get("explanation") == "ok \U0001F600 end"
+
+
+def test_lone_surrogates_are_replaced():
+    parser = parse_chunks(['{"explanation": "a\\ud83db \\ude00c\\ud83d"}'])
+    assert parser.get("explanation") == "a�b �c�"
+
+
+def test_changed_fields_and_partial_values():
+    parser = StreamingJSONParser()
+    assert parser.feed('{"code": "x = 1", "expla') == {"code"}
+    assert parser.feed('nation": "Hel') == {"explanation"}
+    assert parser.get("explanation") == "Hel"
+    assert not parser.done
+    parser.feed('lo"}')
+    assert parser.done
+    assert parser.fields == {"code": "x = 1", "explanation": "Hello"}
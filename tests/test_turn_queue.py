@@ -0,0 +1,93 @@
+# Background turn queue: results, failures, progress and cancellation
+import threading
+import pytest
+from utils.turn_queue import CANCELLED, DONE, FAILED, TurnQueue
+
+
+@pytest.fixture
+def turn_queue():
+    return TurnQueue(workers=1)
+
+
+def test_result_and_on_done(turn_queue):
+    finished = []
+
+    def work(job):
+        job.update(status="Working...")
+        job.update(explanation="partial")
+        return {"explanation": "done"}
+
+    job = turn_queue.submit("session", "prompt", work, on_done=finished.append)
+    assert job.future.result(timeout=5) is job
+    assert job.status == DONE
+    assert job.result == {"explanation": "done"}
+    assert job.progress == {"status": "Working...", "explanation": "partial"}
+    assert finished == [job]
+    assert turn_queue.jobs() == []
+
+
+def test_failure_is_recorded_not_raised(turn_queue):
+    finished = []
+    job = turn_queue.submit("session", "prompt", lambda job: 1 / 0, on_done=finished.append)
+    job.future.result(timeout=5)
+    assert job.status == FAILED
+    assert job.error == "ZeroDivisionError: division by zero"
+    assert finished == [job]
+
+
+def test_failing_on_done_marks_the_job_failed(turn_queue):
+    def on_done(job):
+        raise KeyError("messages")
+
+    job = turn_queue.submit("session", "prompt", lambda job: "answer", on_done=on_done)
+    job.future.result(timeout=5)
+    assert job.status == FAILED
+    assert job.result == "answer"
+    assert "KeyError" in job.error
+
+
+def test_cancel_running_job(turn_queue):
+    started = threading.Event()
+    finished = []
+
+    def work(job):
+        started.set()
+        if job.cancel_event.wait(timeout=5):
+            raise RuntimeError("stopped")
+        return "too late"
+
+    job = turn_queue.submit("session", "prompt", work, on_done=finished.append)
+    assert started.wait(timeout=5)
+    assert turn_queue.jobs("session") == [job]
+    job.cancel()
+    job.future.result(timeout=5)
+    assert job.status == CANCELLED
+    assert job.error is None and job.result is None
+    # on_done still runs, e.g. to show "Stopped" in the chat
+    assert finished == [job]
+
+
+def test_cancel_queued_job_never_runs_it(turn_queue):
+    started, release = threading.Event(), threading.Event()
+    ran = []
+    blocker = turn_queue.submit("other", "slow", lambda job: started.set() or release.wait(timeout=5))
+    queued = turn_queue.submit("session", "prompt", lambda job: ran.append(job))
+    assert started.wait(timeout=5)
+    assert turn_queue.stats() == {"queued": 1, "running": 1}
+    queued.cancel()
+    release.set()
+    blocker.future.result(timeout=5)
+    queued.future.result(timeout=5)
+    assert queued.status == CANCELLED
+    assert ran == []
+
+
+def test_jobs_are_listed_per_session(turn_queue):
+    release = threading.Event()
+    first = turn_queue.submit("a", "one", lambda job: release.wait(timeout=5))
+    second = turn_queue.submit("b", "two", lambda job: None)
+    assert turn_queue.jobs("a") == [first]
+    assert turn_queue.jobs("b") == [second]
+    release.set()
+    second.future.result(timeout=5)
+    assert turn_queue.jobs() == []
@@ -0,0 +1,99 @@
+# Content-addressed storage for chart images
+#
+# Charts are written once to disk under the SHA-256 of their PNG bytes, and
+# messages (in the session and in saved chats) only keep that hash. Identical
+# charts from different sessions or saved chats are stored once. The history
+# view shows small thumbnails, which are generated once per chart and width and
+# kept both on disk and in a small in-memory LRU.
+import base64
+import functools
+import hashlib
+import io
+import os
+import uuid
+from typing import Optional
+
+BLOB_DIR = "chart_blobs"
+THUMBNAIL_WIDTH = 200
+
+
+def _blob_path(ref: str, suffix: str = "") -> str:
+    return os.path.join(BLOB_DIR, ref[:2], f"{ref}{suffix}.png")
+
+
+def _write_atomic(path: str, data: bytes):
+    # Blobs are content-addressed: a file that exists already holds the same bytes
+    if os.path.exists(path):
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Unique per write, as sessions are threads of one process
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def put_chart(data: bytes) -> str:
+    # Store PNG bytes and return their reference; existing charts are not rewritten
+    ref = hashlib.sha256(data).hexdigest()
+    path = _blob_path(ref)
+    if not os.path.exists(path):
+        _write_atomic(path, data)
+    return ref
+
+
+def get_chart(ref: str) -> Optional[bytes]:
+    path = _blob_path(ref)
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def has_chart(ref: str) -> bool:
+    return os.path.exists(_blob_path(ref))
+
+
+def get_thumbnail(ref: str, width: int = THUMBNAIL_WIDTH) -> Optional[bytes]:
+    # Small PNG preview of a chart, generated on first use. A missing chart is
+    # not remembered, so it shows up once it has been rebuilt. Without the
+    # original there is no full-size view either, so a leftover thumbnail is
+    # not shown.
+    if not has_chart(ref):
+        return None
+    return _thumbnail(ref, width)
+
+
+@functools.lru_cache(maxsize=256)
+def _thumbnail(ref: str, width: int) -> Optional[bytes]:
+    path = _blob_path(ref, f"_w{width}")
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    data = get_chart(ref)
+    if data is None:
+        return None
+
+    from PIL import Image
+    image = Image.open(io.BytesIO(data))
+    if image.width > width:
+        image.thumbnail((width, image.height * width // image.width + 1))
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG", optimize=True)
+    thumbnail = buffer.getvalue()
+    _write_atomic(path, thumbnail)
+    return thumbnail
+
+
+def normalize_chart_content(content: dict) -> dict:
+    # Replace base64 charts of older messages (chart_image / chart_images) with references
+    legacy = content.get("chart_images") or [content.get("chart_image")]
+    legacy = [chart for chart in legacy if chart]
+    if not legacy and "chart_refs" in content:
+        return content
+    refs = list(content.get("chart_refs", []))
+    refs += [put_chart(base64.b64decode(chart)) for chart in legacy]
+    content = {k: v for k, v in content.items() if k not in ("chart_images", "chart_image")}
+    content["chart_refs"] = refs
+    return content
@@ -0,0 +1,74 @@
+# Figure-scoped chart capture
+#
+# pyplot keeps a single, process-global registry of figures, so reading
+# plt.gcf() after running generated code picks up whatever figure happens to be
+# current, possibly one created by another session, and misses any additional
+# figures. capture_figures() instead records every Figure constructed by the
+# current thread while the block runs (through pyplot or the object-oriented
+# API) and always closes them on exit, even when the code raises.
+import contextlib
+import io
+import threading
+from typing import List
+
+import matplotlib
+matplotlib.use('Agg')  # Use non-interactive backend
+import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+
+# Maximum chart width: 300px at 100 DPI
+MAX_CHART_WIDTH_INCHES = 3.0
+CHART_DPI = 150
+
+_local = threading.local()
+_hook_lock = threading.Lock()
+_hook_installed = False
+
+
+def _install_hook():
+    # Wrap Figure.__init__ once so new figures register with the active capture
+    global _hook_installed
+    with _hook_lock:
+        if _hook_installed:
+            return
+        original_init = Figure.__init__
+
+        def __init__(self, *args, **kwargs):
+            original_init(self, *args, **kwargs)
+            captured = getattr(_local, "captured", None)
+            if captured is not None:
+                captured.append(self)
+
+        Figure.__init__ = __init__
+        _hook_installed = True
+
+
+@contextlib.contextmanager
+def capture_figures():
+    # Collect the figures created in this thread inside the block, then close them
+    _install_hook()
+    previous = getattr(_local, "captured", None)
+    captured: List[Figure] = []
+    _local.captured = captured
+    try:
+        yield captured
+    finally:
+        _local.captured = previous
+        for fig in captured:
+            plt.close(fig)
+
+
+def render_png(fig: Figure, max_width_inches: float = MAX_CHART_WIDTH_INCHES, dpi: int = CHART_DPI) -> bytes:
+    current_size = fig.get_size_inches()
+    if current_size[0] > max_width_inches:
+        # Scale down proportionally
+        scale_factor = max_width_inches / current_size[0]
+        fig.set_size_inches(max_width_inches, current_size[1] * scale_factor)
+    img_buffer = io.BytesIO()
+    fig.savefig(img_buffer, format='png', bbox_inches='tight', dpi=dpi)
+    return img_buffer.getvalue()
+
+
+def render_figures(figures: List[Figure]) -> List[bytes]:
+    # Render the figures that actually contain something, in creation order
+    return [render_png(fig) for fig in figures if fig.get_axes()]
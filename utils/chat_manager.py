@@ -0,0 +1,180 @@
+# Session-scoped Gemini chat manager
+#
+# A single genai.Client is shared by every session in the process, so the HTTP
+# connection pool (and its TLS sessions) is reused across turns and users. Each
+# session keeps one live chat object keyed by (model, persona, response-schema);
+# the chat is only rebuilt when that key changes or when the message history no
+# longer matches what the chat has seen (new chat, loaded saved chat, ...).
+import json
+from typing import Optional
+import streamlit as st
+import httpx
+from google import genai
+from google.genai import types
+from utils.config_service import compile_schema
+
+# Connection pool shared by all sessions of the process
+POOL_LIMITS = httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=120)
+
+
+def make_client(api_key: str) -> genai.Client:
+    return genai.Client(
+        api_key=api_key,
+        http_options=types.HttpOptions(client_args={"limits": POOL_LIMITS})
+    )
+
+
+@st.cache_resource(show_spinner=False)
+def get_client(api_key: str) -> genai.Client:
+    # One client per API key and process
+    return make_client(api_key)
+
+
+@st.cache_resource(show_spinner=False)
+def get_fake_client():
+    # Offline stand-in with the same interface, configured from the environment
+    from utils.fake_model import FakeClient
+    return FakeClient()
+
+
+def build_config(persona: str, schema: dict) -> types.GenerateContentConfig:
+    # Structured output only when the agent defines a response schema; the
+    # schema is validated and converted once per process
+    if schema:
+        return types.GenerateContentConfig(
+            system_instruction=persona,
+            response_mime_type='application/json',
+            response_schema=compile_schema(schema)
+        )
+    return types.GenerateContentConfig(system_instruction=persona)
+
+
+def message_to_text(message: dict) -> str:
+    # Text sent back to the model for a stored message (charts are never sent)
+    content = message["content"]
+    if isinstance(content, dict) and "agents" in content:
+        # Multi-agent turn: every agent's explanation
+        return "\n\n".join(f"{answer['name']}: {answer.get('explanation', '')}" for answer in content["agents"])
+    if isinstance(content, dict):
+        return json.dumps({
+            "code": content.get("code", ""),
+            "explanation": content.get("explanation", "")
+        })
+    return str(content)
+
+
+def history_turns(messages: list) -> list:
+    # (user, assistant) message pairs of st.session_state.messages. The system
+    # persona is passed as the system instruction, and a user message without an
+    # answer (e.g. a failed turn) is dropped so roles keep alternating.
+    turns = []
+    pending_user = None
+    for message in messages:
+        if message["role"] == "user":
+            pending_user = message
+        elif message["role"] == "assistant" and pending_user is not None:
+            turns.append((pending_user, message))
+            pending_user = None
+    return turns
+
+
+def build_history(messages: list) -> list:
+    # Convert st.session_state.messages into the full chat history
+    history = []
+    for user_message, model_message in history_turns(messages):
+        history.append(types.Content(role="user", parts=[types.Part(text=message_to_text(user_message))]))
+        history.append(types.Content(role="model", parts=[types.Part(text=message_to_text(model_message))]))
+    return history
+
+
+def chat_key(model: str, persona: str, schema: dict) -> tuple:
+    return (model, persona, json.dumps(schema, sort_keys=True))
+
+
+def get_chat(client: genai.Client, model: str, persona: str, schema: dict, history_messages: list):
+    # Return the session's live chat, rebuilding it only when needed.
+    # history_messages are the messages the model should already know about,
+    # i.e. everything before the prompt being sent; only the part that fits the
+    # context window is sent (see utils.context_window).
+    from utils.context_window import build_context
+    context = build_context(client, model, history_messages)
+    key = chat_key(model, persona, schema) + context.key
+    session = st.session_state.get("chat_session")
+    if session is None or session["key"] != key or session["synced"] != len(history_messages):
+        config = build_config(persona, schema)
+        chat = client.chats.create(
+            model=model,
+            config=config,
+            history=context.contents
+        )
+        session = {"key": key, "chat": chat, "synced": len(history_messages), "model": model, "config": config}
+        st.session_state.chat_session = session
+    return session["chat"]
+
+
+def record_turn(chat, user_content: types.Content, model_contents: list, is_valid: bool = True):
+    # Add a turn sent outside the chat object to its history
+    chat.record_history(
+        user_input=user_content,
+        model_output=model_contents,
+        automatic_function_calling_history=[],
+        is_valid=is_valid
+    )
+
+
+def send_message(client: genai.Client, prompt: str, trace=None, session: Optional[dict] = None,
+                 cancel=None) -> types.GenerateContentResponse:
+    # Send prompt on the session's live chat. The request goes through the shared
+    # scheduler (rate limits, retries, coalescing; see utils.scheduler) and the
+    # turn is then recorded in the chat's history, as chat.send_message would.
+    # Pass the chat_session dict returned by get_chat_session when calling from
+    # outside the script thread.
+    from utils.scheduler import get_scheduler
+    session = session or st.session_state.chat_session
+    chat = session["chat"]
+    user_content = types.Content(role="user", parts=[types.Part(text=prompt)])
+    response = get_scheduler().generate(client, session["model"], chat.get_history(curated=True) + [user_content],
+                                        session["config"], trace=trace, cancel=cancel)
+    content = response.candidates[0].content if response.candidates else None
+    record_turn(chat, user_content, [content] if content else [])
+    return response
+
+
+def send_message_stream(client: genai.Client, prompt: str, trace=None, session: Optional[dict] = None,
+                        cancel=None):
+    # Streaming version of send_message; the turn is only recorded if the
+    # stream is read to the end
+    from utils.scheduler import get_scheduler
+    session = session or st.session_state.chat_session
+    chat = session["chat"]
+    user_content = types.Content(role="user", parts=[types.Part(text=prompt)])
+    model_contents = []
+    finished = False
+    for chunk in get_scheduler().generate_stream(client, session["model"],
+                                                 chat.get_history(curated=True) + [user_content],
+                                                 session["config"], trace=trace, cancel=cancel):
+        if chunk.candidates and chunk.candidates[0].content:
+            model_contents.append(chunk.candidates[0].content)
+        finished = finished or bool(chunk.candidates and chunk.candidates[0].finish_reason)
+        yield chunk
+    record_turn(chat, user_content, model_contents, is_valid=finished)
+
+
+def get_chat_session(client: genai.Client, model: str, persona: str, schema: dict, history_messages: list) -> dict:
+    # The session's live chat together with its model and config, as a plain
+    # dict that a background turn can use without st.session_state
+    get_chat(client, model, persona, schema, history_messages)
+    return st.session_state.chat_session
+
+
+def mark_synced(messages: list, session: Optional[dict] = None):
+    # Record that the live chat has seen every message in messages
+    if session is None:
+        session = st.session_state.get("chat_session")
+    if session is not None:
+        session["synced"] = len(messages)
+
+
+def reset_chat():
+    st.session_state.pop("chat_session", None)
+    st.session_state.pop("context_window", None)
@@ -0,0 +1,150 @@
+# Transactional store for saved chats
+#
+# Saved chats used to live in a single saved_chats.json that was rewritten in
+# full (base64 charts included) on every save and parsed in full on every rerun
+# of the Saved Chats page. The store keeps chat metadata and message bodies in
+# separate SQLite tables, so the list view only reads metadata, messages are
+# read when a chat is opened, and each save is a single atomic transaction that
+# does not touch the other chats. Chart images live in the blob store and
+# messages only hold their references.
+import json
+import os
+import sqlite3
+import threading
+import uuid
+from datetime import datetime
+from typing import Optional
+from utils.blob_store import normalize_chart_content
+from utils.metrics import log_record
+
+STORE_PATH = "saved_chats.db"
+LEGACY_JSON_PATH = "saved_chats.json"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS chats (
+    name TEXT PRIMARY KEY,
+    title TEXT,
+    timestamp TEXT,
+    message_count INTEGER
+);
+CREATE TABLE IF NOT EXISTS messages (
+    chat_name TEXT REFERENCES chats(name) ON DELETE CASCADE,
+    position INTEGER,
+    role TEXT,
+    content TEXT,
+    PRIMARY KEY (chat_name, position)
+);
+"""
+
+
+def new_chat_name(timestamp: str) -> str:
+    # The store is shared by every session; the suffix keeps two chats saved in
+    # the same second from replacing each other
+    return f"Chat_{timestamp}_{uuid.uuid4().hex[:6]}"
+
+
+class ChatStore:
+    def __init__(self, path: str = STORE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA foreign_keys=ON")
+        self._db.executescript(_SCHEMA)
+
+    def save_chat(self, name: str, messages: list, timestamp: Optional[str] = None, title: Optional[str] = None):
+        # Write (or replace) one chat in a single transaction
+        timestamp = timestamp or datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.execute("DELETE FROM chats WHERE name = ?", (name,))
+                self._db.execute(
+                    "INSERT INTO chats (name, title, timestamp, message_count) VALUES (?, ?, ?, ?)",
+                    (name, title or name, timestamp, len(messages))
+                )
+                for position, message in enumerate(messages):
+                    content = message["content"]
+                    if isinstance(content, dict):
+                        content = normalize_chart_content(content)
+                    self._db.execute(
+                        "INSERT INTO messages (chat_name, position, role, content) VALUES (?, ?, ?, ?)",
+                        (name, position, message["role"], json.dumps(content))
+                    )
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def count_chats(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM chats").fetchone()[0]
+
+    def list_chats(self, limit: int = 20, offset: int = 0) -> list:
+        # Metadata only, newest first
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT name, title, timestamp, message_count FROM chats "
+                "ORDER BY timestamp DESC, name DESC LIMIT ? OFFSET ?",
+                (limit, offset)
+            ).fetchall()
+        return [
+            {"name": name, "title": title, "timestamp": timestamp, "message_count": count}
+            for name, title, timestamp, count in rows
+        ]
+
+    def load_messages(self, name: str, limit: Optional[int] = None) -> list:
+        # Message bodies of one chat, in the format used by st.session_state.messages
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT position, role, content FROM messages WHERE chat_name = ? "
+                "ORDER BY position LIMIT ?",
+                (name, -1 if limit is None else limit)
+            ).fetchall()
+        return [{"role": role, "content": json.loads(content)} for _, role, content in rows]
+
+    def delete_chat(self, name: str):
+        with self._lock:
+            self._db.execute("DELETE FROM chats WHERE name = ?", (name,))
+
+    def migrate_from_json(self, json_path: str = LEGACY_JSON_PATH) -> int:
+        # One-time import of the old saved_chats.json; the file is renamed afterwards
+        if not os.path.exists(json_path):
+            return 0
+        try:
+            with open(json_path, "r") as f:
+                saved_chats = json.load(f)
+            for chat_name, chat_data in saved_chats.items():
+                self.save_chat(
+                    chat_name,
+                    chat_data.get("messages", []),
+                    timestamp=chat_data.get("timestamp"),
+                    title=chat_data.get("title")
+                )
+        except Exception as e:
+            # A corrupt or half-written file must not break saving and loading
+            # chats; it is moved aside (chats imported before the error are kept)
+            bad_path = f"{json_path}.corrupt"
+            log_record({"event": "chat_migration_failed", "path": json_path, "moved_to": bad_path,
+                        "error": f"{type(e).__name__}: {e}"})
+            try:
+                os.replace(json_path, bad_path)
+            except OSError:
+                pass
+            return 0
+        os.replace(json_path, f"{json_path}.migrated")
+        return len(saved_chats)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_chat_store() -> ChatStore:
+    # Process-wide store; migrates the legacy JSON file on first use
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = ChatStore()
+            _store.migrate_from_json()
+        return _store
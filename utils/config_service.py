@@ -0,0 +1,235 @@
+# Process-wide configuration service
+#
+# agent_config.json and variables.env used to be read by every session on
+# every rerun. Here one watcher thread per process polls their modification
+# times; when either changes, the agents are validated and their response
+# schemas compiled to types.Schema once (compile_schema keeps them for
+# chat_manager.build_config), and the result is published as an immutable,
+# numbered ConfigSnapshot. A session only compares the version it
+# last saw with the current one. Saving from the configure page writes a
+# temporary file and renames it over agent_config.json, so a reader never
+# sees half-written JSON.
+import copy
+import json
+import os
+import tempfile
+import threading
+import time
+import warnings
+from dataclasses import dataclass
+from typing import List, Optional
+from google.genai import types
+from utils.load_env import parse_env_file
+
+AGENT_CONFIG_PATH = "agent_config.json"
+ENV_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "variables.env")
+POLL_INTERVAL = 1.0  # seconds
+
+
+class ConfigError(Exception):
+    pass
+
+
+DEFAULT_AGENT_PERSONA = """You are a helpful AI assistant focused on data analysis and insights. You communicate clearly and professionally while maintaining a friendly tone. You ask clarifying questions when needed and provide detailed explanations for your analysis. To answer questions use the dataset, which is already loaded for you as described below; do not read the file yourself. Whenever possible, show a data visualization with an explanation. Use the MATPLOTLIB library to create the visualizations. If you cannot answer the question with the dataset, say so, and provide only a short explanation, with no code."""
+
+DEFAULT_RESPONSE_SCHEMA = {
+    'required': [
+        'code',
+        'explanation'
+    ],
+    'properties': {
+        'code': {'type': 'STRING'},
+        'explanation': {'type': 'STRING'}
+    },
+    'type': 'OBJECT',
+}
+
+
+def default_agent() -> dict:
+    # Used when no agents are configured
+    return {
+        "name": "Default Agent",
+        "persona": DEFAULT_AGENT_PERSONA,
+        "response-schema": copy.deepcopy(DEFAULT_RESPONSE_SCHEMA),
+        "active": True
+    }
+
+
+@dataclass(frozen=True)
+class ConfigSnapshot:
+    version: int = 0
+    agents: tuple = ()              # validated agent dicts; copy before editing
+    api_key: Optional[str] = None
+    errors: tuple = ()              # problems found in the files on disk
+
+
+_compiled = {}
+_compiled_lock = threading.Lock()
+
+
+def compile_schema(schema: dict) -> Optional[types.Schema]:
+    # Validate a response schema and convert it once per distinct schema
+    if not schema:
+        return None
+    key = json.dumps(schema, sort_keys=True)
+    with _compiled_lock:
+        if key in _compiled:
+            return _compiled[key]
+    try:
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            compiled = types.Schema.model_validate(schema)
+    except Exception as e:
+        raise ConfigError(f"invalid response schema: {e}") from e
+    if caught:
+        # The SDK only warns about unknown enum values such as a misspelled type
+        raise ConfigError(f"invalid response schema: {caught[0].message}")
+    with _compiled_lock:
+        _compiled[key] = compiled
+    return compiled
+
+
+def validate_agents(agents) -> List[dict]:
+    # Normalised copy of an agent list; raises ConfigError listing every problem
+    if not isinstance(agents, list):
+        raise ConfigError("the agent configuration must be a list of agents")
+    problems, validated, names = [], [], set()
+    for index, agent in enumerate(agents):
+        label = f"agent {index + 1}"
+        if not isinstance(agent, dict):
+            problems.append(f"{label} is not an object")
+            continue
+        name = agent.get("name")
+        if not isinstance(name, str) or not name.strip():
+            problems.append(f"{label} has no name")
+            continue
+        if name in names:
+            problems.append(f"{label}: duplicate name '{name}'")
+        names.add(name)
+        if not isinstance(agent.get("persona", ""), str):
+            problems.append(f"'{name}': persona must be text")
+        schema = agent.get("response-schema") or {}
+        if not isinstance(schema, dict):
+            problems.append(f"'{name}': response-schema must be an object")
+        else:
+            try:
+                compile_schema(schema)
+            except ConfigError as e:
+                problems.append(f"'{name}': {e}")
+        validated.append(dict(copy.deepcopy(agent), **{
+            "persona": agent.get("persona", ""),
+            "response-schema": copy.deepcopy(schema),
+            "active": bool(agent.get("active", True)),
+        }))
+    if problems:
+        raise ConfigError("; ".join(problems))
+    return validated
+
+
+def read_agents(path: str) -> List[dict]:
+    with open(path, "r") as f:
+        try:
+            agents = json.load(f)
+        except json.JSONDecodeError as e:
+            raise ConfigError(f"{path} is not valid JSON: {e}") from e
+    return validate_agents(agents)
+
+
+def _mtime(path: str) -> Optional[float]:
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class ConfigService:
+    def __init__(self, agent_path: str = AGENT_CONFIG_PATH, env_path: str = ENV_PATH,
+                 poll_interval: float = POLL_INTERVAL, watch: bool = True):
+        self.agent_path = agent_path
+        self.env_path = env_path
+        self.poll_interval = poll_interval
+        self._snapshot = ConfigSnapshot()
+        self._mtimes = (None, None)
+        self._lock = threading.Lock()
+        self.refresh()
+        if watch:
+            threading.Thread(target=self._watch, name="config-watcher", daemon=True).start()
+
+    @property
+    def snapshot(self) -> ConfigSnapshot:
+        return self._snapshot
+
+    def _watch(self):
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                self.refresh()
+            except Exception:
+                # A transient filesystem error; try again on the next poll
+                pass
+
+    def refresh(self) -> bool:
+        # Reload if either file changed since the last snapshot
+        mtimes = (_mtime(self.agent_path), _mtime(self.env_path))
+        with self._lock:
+            if mtimes == self._mtimes and self._snapshot.version:
+                return False
+            agents, errors = list(self._snapshot.agents), []
+            if mtimes[0] is not None:
+                try:
+                    agents = read_agents(self.agent_path)
+                except (OSError, ConfigError) as e:
+                    # Keep serving the last good agents
+                    errors.append(f"Error loading agent configuration: {str(e)}")
+            else:
+                agents = []
+            api_key = None
+            try:
+                api_key = parse_env_file(self.env_path).get("API_KEY") or None
+            except OSError as e:
+                errors.append(f"Error loading API key from variables.env: {str(e)}")
+            self._mtimes = mtimes
+            self._publish(agents, api_key, errors)
+            return True
+
+    def _publish(self, agents: List[dict], api_key: Optional[str], errors: List[str]):
+        # Called with the lock held
+        self._snapshot = ConfigSnapshot(
+            version=self._snapshot.version + 1,
+            agents=tuple(agents),
+            api_key=api_key,
+            errors=tuple(errors),
+        )
+
+    def save_agents(self, agents: list) -> ConfigSnapshot:
+        # Validate, write atomically and publish without waiting for the watcher
+        validated = validate_agents(agents)
+        directory = os.path.dirname(os.path.abspath(self.agent_path))
+        fd, temp_path = tempfile.mkstemp(prefix=".agent_config.", suffix=".tmp", dir=directory)
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(validated, f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.agent_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        with self._lock:
+            self._mtimes = (_mtime(self.agent_path), self._mtimes[1])
+            self._publish(validated, self._snapshot.api_key, [])
+            return self._snapshot
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_config_service() -> ConfigService:
+    # Process-wide service, started on first use
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = ConfigService()
+        return _service
@@ -0,0 +1,178 @@
+# Token-aware context window for long conversations
+#
+# Sits between st.session_state.messages and the Gemini call. The system
+# persona always goes in as the system instruction; of the earlier turns only
+# the most recent ones that fit the model's history budget are sent, and the
+# turns before them are replaced by a rolling summary. Chart images are never
+# part of the context (messages are converted with message_to_text).
+#
+# Token counts are estimated once per distinct message text. When the window
+# has to move, it is trimmed well below the budget so it stays put for the next
+# several turns (the live chat is only rebuilt when it moves). The summary is
+# written by the model in a background thread; until it has caught up, the
+# newly dropped turns are represented by their questions.
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import List, NamedTuple
+import streamlit as st
+from google.genai import types
+from utils.chat_manager import history_turns, message_to_text
+from utils.profiler import estimate_tokens
+from utils.response_cache import history_digest
+from utils.scheduler import get_scheduler
+
+DEFAULT_HISTORY_BUDGET = 8000  # tokens of earlier turns sent with a prompt
+MODEL_HISTORY_BUDGETS = {
+    "models/gemini-1.5-pro-latest": 16000,
+    "models/gemini-2.0-pro-exp": 16000,
+}
+TRIM_TARGET = 0.6              # fraction of the budget kept when the window moves
+SUMMARY_MODEL = "models/gemini-2.0-flash"
+SUMMARY_WORDS = 200
+NOTE_CHARS = 200               # per dropped question, until the summary catches up
+
+SUMMARY_PROMPT = """Summarise the earlier part of a data analysis conversation in at most {words} words.
+Keep the facts, numbers, column names, filters and conclusions the user may refer back to.
+Do not include code.
+
+Previous summary:
+{summary}
+
+Conversation to add:
+{conversation}"""
+
+
+class Context(NamedTuple):
+    contents: List[types.Content]  # history to send before the prompt
+    key: tuple                     # changes whenever the window moves or the summary changes
+    tokens: int                    # estimated tokens of contents
+    summarized_turns: int          # earlier turns replaced by the summary
+
+
+@lru_cache(maxsize=8192)
+def count_tokens(text: str) -> int:
+    return estimate_tokens(text)
+
+
+def turn_tokens(turn: tuple) -> int:
+    return sum(count_tokens(message_to_text(message)) for message in turn)
+
+
+def history_budget(model: str) -> int:
+    return MODEL_HISTORY_BUDGETS.get(model, DEFAULT_HISTORY_BUDGET)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool() -> ThreadPoolExecutor:
+    # Summaries of all sessions are written by a small shared pool
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="summary")
+        return _pool
+
+
+def _summarize(client, summary: str, turns: list) -> str:
+    conversation = "\n".join(
+        f"{'User' if message['role'] == 'user' else 'Assistant'}: {message_to_text(message)}"
+        for turn in turns for message in turn
+    )
+    response = get_scheduler().generate(
+        client,
+        SUMMARY_MODEL,
+        SUMMARY_PROMPT.format(words=SUMMARY_WORDS, summary=summary or "(none)", conversation=conversation),
+        types.GenerateContentConfig(temperature=0)
+    )
+    return (response.text or "").strip()
+
+
+def _state() -> dict:
+    if "context_window" not in st.session_state:
+        reset_context()
+    return st.session_state.context_window
+
+
+def reset_context():
+    st.session_state.context_window = {
+        "start": 0,            # first turn sent in full
+        "summary": "",
+        "summary_turns": 0,    # turns covered by the summary
+        "summary_digest": history_digest([]),
+        "pending": None,       # future of the summary being written
+        "pending_turns": 0,
+    }
+
+
+def _window_start(counts: list, start: int, budget: int, summary_tokens: int) -> int:
+    # Keep the current start while it fits, otherwise drop turns down to the trim target
+    if sum(counts[start:]) + summary_tokens <= budget:
+        return start
+    target = budget * TRIM_TARGET - summary_tokens
+    start, used = len(counts), 0
+    while start > 0 and (used + counts[start - 1] <= target or start == len(counts)):
+        start -= 1
+        used += counts[start]
+    return start
+
+
+def build_context(client, model: str, messages: list) -> Context:
+    # The context to send before the next prompt, given everything said so far
+    turns = history_turns(messages)
+    state = _state()
+
+    # A different conversation (new or loaded chat) invalidates the window
+    covered = [message for turn in turns[:state["summary_turns"]] for message in turn]
+    if state["summary_turns"] > len(turns) or history_digest(covered) != state["summary_digest"] \
+            or state["start"] > len(turns):
+        reset_context()
+        state = _state()
+
+    # Adopt a finished background summary
+    pending = state["pending"]
+    if pending is not None and pending.done():
+        state["pending"] = None
+        try:
+            state["summary"] = pending.result()
+            state["summary_turns"] = state["pending_turns"]
+            covered = [message for turn in turns[:state["summary_turns"]] for message in turn]
+            state["summary_digest"] = history_digest(covered)
+        except Exception:
+            # Retried below with the turns still to summarise
+            pass
+
+    counts = [turn_tokens(turn) for turn in turns]
+    state["start"] = _window_start(counts, state["start"], history_budget(model),
+                                   count_tokens(state["summary"]))
+    start = state["start"]
+
+    # Older turns not yet in the summary are summarised off the critical path
+    if start > state["summary_turns"] and state["pending"] is None:
+        state["pending_turns"] = start
+        state["pending"] = _get_pool().submit(_summarize, client, state["summary"],
+                                              turns[state["summary_turns"]:start])
+
+    contents = []
+    if start:
+        notes = [
+            f"- {message_to_text(turn[0])[:NOTE_CHARS]}"
+            for turn in turns[min(state["summary_turns"], start):start]
+        ]
+        recap = state["summary"]
+        if notes:
+            recap += ("\n\n" if recap else "") + "Earlier questions:\n" + "\n".join(notes)
+        contents.append(types.Content(role="user", parts=[types.Part(
+            text=f"Summary of our earlier conversation:\n{recap}")]))
+        contents.append(types.Content(role="model", parts=[types.Part(text="Understood.")]))
+    for user_message, model_message in turns[start:]:
+        contents.append(types.Content(role="user", parts=[types.Part(text=message_to_text(user_message))]))
+        contents.append(types.Content(role="model", parts=[types.Part(text=message_to_text(model_message))]))
+
+    recap_text = contents[0].parts[0].text if start else ""
+    tokens = sum(counts[start:]) + count_tokens(recap_text)
+    key = (start, hashlib.sha256(recap_text.encode("utf-8")).hexdigest()[:16])
+    return Context(contents, key, tokens, start)
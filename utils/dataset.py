@@ -0,0 +1,155 @@
+# Process-wide dataset cache
+#
+# The dataset is parsed once per process and shared by every session. An entry
+# is revalidated with a cheap stat() on each access; the file is only re-hashed
+# when its mtime or size changes, and only re-parsed when the content hash
+# differs. Hashing and parsing hold only a lock for that file, so a large
+# upload being ingested does not block sessions using another dataset. When
+# pyarrow is installed, a ZSTD-compressed Parquet copy of the parsed frame (with
+# inferred types) is kept under CACHE_DIR so that a restarted process skips CSV
+# parsing as well.
+#
+# Copy-on-write is enabled so that frames handed to generated code share memory
+# with the cached frame, but any modification made by that code only affects
+# the session's own copy.
+import hashlib
+import os
+import threading
+import uuid
+from typing import Optional
+import pandas as pd
+
+pd.options.mode.copy_on_write = True
+
+CACHE_DIR = os.path.join('.cache', 'datasets')
+
+try:
+    import pyarrow  # noqa: F401
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
+_cache = {}
+_lock = threading.Lock()    # guards _cache and _path_locks; only held briefly
+_path_locks = {}            # path -> lock held while that file is hashed or parsed
+
+ISO_DATE_PATTERN = r"^\d{4}-\d{2}-\d{2}"
+TYPE_SAMPLE_ROWS = 1000
+
+
+def file_hash(path: str) -> str:
+    # Content hash of a file, read in chunks to keep memory flat
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def infer_types(frame: pd.DataFrame) -> pd.DataFrame:
+    # read_csv leaves dates as text; convert text columns that hold ISO dates
+    for column in frame.select_dtypes(include="object").columns:
+        sample = frame[column].dropna().head(TYPE_SAMPLE_ROWS)
+        if sample.empty or not sample.map(lambda value: isinstance(value, str)).all():
+            continue
+        if not sample.str.match(ISO_DATE_PATTERN).all():
+            continue
+        try:
+            frame[column] = pd.to_datetime(frame[column], format="ISO8601")
+        except (ValueError, TypeError):
+            pass
+    return frame
+
+
+def _read_file(path: str, content_hash: str) -> pd.DataFrame:
+    # Prefer the columnar copy; fall back to parsing the raw file
+    columnar_path = os.path.join(CACHE_DIR, f"{content_hash}.parquet")
+    if HAS_PYARROW and os.path.exists(columnar_path):
+        return pd.read_parquet(columnar_path)
+
+    if path.endswith('.parquet'):
+        frame = pd.read_parquet(path)
+    else:
+        frame = infer_types(pd.read_csv(path))
+
+    if HAS_PYARROW and not path.endswith('.parquet'):
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            tmp_path = f"{columnar_path}.{uuid.uuid4().hex}.tmp"
+            frame.to_parquet(tmp_path, index=False, compression='zstd')
+            os.replace(tmp_path, columnar_path)
+        except Exception:
+            # The columnar copy is only an optimisation
+            pass
+    return frame
+
+
+def _path_lock(path: str) -> threading.Lock:
+    with _lock:
+        return _path_locks.setdefault(path, threading.Lock())
+
+
+def _cached_entry(path: str, stat: os.stat_result) -> Optional[dict]:
+    # The entry if it is still current, else None
+    with _lock:
+        entry = _cache.get(path)
+    if entry and entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size:
+        return entry
+    return None
+
+
+def _get_entry(path: str) -> dict:
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    entry = _cached_entry(path, stat)
+    if entry:
+        return entry
+
+    with _path_lock(path):
+        # Another thread may have hashed the file while this one waited
+        entry = _cached_entry(path, stat)
+        if entry:
+            return entry
+        content_hash = file_hash(path)
+        with _lock:
+            entry = _cache.get(path)
+            if entry and entry["hash"] == content_hash:
+                # Touched but unchanged
+                entry.update(mtime=stat.st_mtime, size=stat.st_size)
+                return entry
+
+            # The frame itself is parsed on first use by load_dataset
+            entry = {
+                "path": path,
+                "mtime": stat.st_mtime,
+                "size": stat.st_size,
+                "hash": content_hash,
+                "frame": None,
+            }
+            _cache[path] = entry
+            return entry
+
+
+def load_dataset(path: str) -> pd.DataFrame:
+    # Return a copy-on-write view of the cached frame, safe to hand to user code
+    entry = _get_entry(path)
+    if entry["frame"] is None:
+        with _path_lock(entry["path"]):
+            if entry["frame"] is None:
+                frame = _read_file(entry["path"], entry["hash"])
+                with _lock:
+                    entry["frame"] = frame
+    return entry["frame"].copy(deep=False)
+
+
+def dataset_fingerprint(path: str) -> str:
+    # Content hash of the dataset, used as a cache key by other layers
+    return _get_entry(path)["hash"]
+
+
+def clear_cache(path: Optional[str] = None):
+    with _lock:
+        if path is None:
+            _cache.clear()
+        else:
+            _cache.pop(os.path.abspath(path), None)
@@ -0,0 +1,193 @@
+# Dataset registry with background ingestion
+#
+# Every CSV or Parquet file in DATA_DIR (including uploads, which are saved
+# there) is a dataset. A new or changed file is ingested once, in a background
+# thread, so the session that uploaded it is never blocked: the file is hashed,
+# parsed with type inference, converted to a compressed columnar copy (see
+# utils.dataset and utils.query_engine) and profiled (utils.profiler). Those
+# artifacts are keyed by the content hash, so later sessions, other users and
+# restarted processes load the prepared copy instead of parsing the raw file.
+# Row and column counts are kept in a small manifest next to the columnar copy.
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Optional
+from utils.dataset import CACHE_DIR, dataset_fingerprint, load_dataset
+
+DATA_DIR = './data/'
+DEFAULT_DATASET = 'titanic.csv'
+SUPPORTED_EXTENSIONS = ('.csv', '.parquet')
+INGEST_WORKERS = 1
+
+# Dataset states
+PENDING = "pending"
+INGESTING = "ingesting"
+READY = "ready"
+FAILED = "failed"
+
+
+def _manifest_path(fingerprint: str) -> str:
+    return os.path.join(CACHE_DIR, f"{fingerprint}.json")
+
+
+def safe_filename(name: str) -> str:
+    # Keep uploaded names inside DATA_DIR and readable
+    base = re.sub(r"[^A-Za-z0-9._-]+", "_", os.path.basename(name)).strip("._")
+    return base or "dataset.csv"
+
+
+class DatasetRegistry:
+    def __init__(self, data_dir: str = DATA_DIR, workers: int = INGEST_WORKERS):
+        self.data_dir = data_dir
+        self._entries = {}     # path -> entry dict
+        self._futures = {}     # path -> Future of the running ingestion
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ingest")
+        self.scan()
+
+    def path_for(self, name: str) -> str:
+        return os.path.join(self.data_dir, name)
+
+    def default_path(self) -> str:
+        return self.path_for(DEFAULT_DATASET)
+
+    def scan(self) -> List[dict]:
+        # Register new or changed files in DATA_DIR and start their ingestion
+        try:
+            names = sorted(
+                entry.name for entry in os.scandir(self.data_dir)
+                if entry.is_file() and entry.name.lower().endswith(SUPPORTED_EXTENSIONS)
+            )
+        except FileNotFoundError:
+            names = []
+        for name in names:
+            self.ingest(self.path_for(name))
+        with self._lock:
+            for path in [path for path in self._entries if not os.path.exists(path)]:
+                del self._entries[path]
+        return self.datasets()
+
+    def datasets(self) -> List[dict]:
+        with self._lock:
+            return [dict(entry) for _, entry in sorted(self._entries.items())]
+
+    def get(self, path: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(path)
+            return dict(entry) if entry else None
+
+    def busy(self) -> bool:
+        with self._lock:
+            return any(entry["status"] in (PENDING, INGESTING) for entry in self._entries.values())
+
+    def add_upload(self, name: str, data: bytes) -> dict:
+        # Save an uploaded file under DATA_DIR and ingest it in the background
+        name = safe_filename(name)
+        if not name.lower().endswith(SUPPORTED_EXTENSIONS):
+            raise ValueError(f"Unsupported file type: {name}")
+        os.makedirs(self.data_dir, exist_ok=True)
+        path = self.path_for(name)
+        stem, extension = os.path.splitext(name)
+        counter = 1
+        while os.path.exists(path):
+            with open(path, "rb") as f:
+                if f.read() == data:
+                    # Same file uploaded again: reuse it
+                    break
+            counter += 1
+            path = self.path_for(f"{stem}_{counter}{extension}")
+        else:
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        self.ingest(path)
+        return self.get(path)
+
+    def ingest(self, path: str) -> Future:
+        # Start ingesting path unless it is already being ingested or is up to date
+        stat = os.stat(path)
+        with self._lock:
+            entry = self._entries.get(path)
+            future = self._futures.get(path)
+            if entry and entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size \
+                    and entry["status"] != FAILED:
+                if future is None:
+                    future = Future()
+                    future.set_result(entry)
+                return future
+            self._entries[path] = {
+                "name": os.path.basename(path),
+                "path": path,
+                "status": PENDING,
+                "mtime": stat.st_mtime,
+                "size": stat.st_size,
+                "fingerprint": None,
+                "rows": None,
+                "columns": None,
+                "seconds": None,
+                "error": None,
+            }
+            future = self._pool.submit(self._ingest, path)
+            self._futures[path] = future
+            return future
+
+    def _update(self, path: str, **values):
+        with self._lock:
+            if path in self._entries:
+                self._entries[path].update(values)
+
+    def _ingest(self, path: str) -> Optional[dict]:
+        from utils.profiler import get_profile
+        from utils.query_engine import get_engine, is_large
+        start_time = time.perf_counter()
+        self._update(path, status=INGESTING)
+        try:
+            fingerprint = dataset_fingerprint(path)
+            manifest_path = _manifest_path(fingerprint)
+            if os.path.exists(manifest_path):
+                # Prepared before, by this or another process
+                with open(manifest_path, "r") as f:
+                    manifest = json.load(f)
+            else:
+                if is_large(path):
+                    # DuckDB converts it to compressed Parquet without loading it into memory
+                    engine = get_engine(path)
+                    rows, columns = engine.count(), len(engine.columns)
+                else:
+                    frame = load_dataset(path)
+                    rows, columns = len(frame), len(frame.columns)
+                manifest = {"fingerprint": fingerprint, "rows": rows, "columns": columns}
+                os.makedirs(CACHE_DIR, exist_ok=True)
+                tmp_path = f"{manifest_path}.{uuid.uuid4().hex}.tmp"
+                with open(tmp_path, "w") as f:
+                    json.dump(manifest, f)
+                os.replace(tmp_path, manifest_path)
+            # Summary statistics for the agents, cached by content hash
+            get_profile(path)
+            self._update(path, status=READY, fingerprint=fingerprint, rows=manifest["rows"],
+                         columns=manifest["columns"], seconds=time.perf_counter() - start_time)
+        except Exception as e:
+            self._update(path, status=FAILED, error=f"{type(e).__name__}: {e}",
+                         seconds=time.perf_counter() - start_time)
+        finally:
+            with self._lock:
+                self._futures.pop(path, None)
+        return self.get(path)
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_dataset_registry() -> DatasetRegistry:
+    # Process-wide registry, scanned on first use
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = DatasetRegistry()
+        return _registry
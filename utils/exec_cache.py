@@ -0,0 +1,130 @@
+# Cache of code execution results
+#
+# Running the same analysis code on the same data with the same libraries
+# gives the same output, so results are keyed by the SHA-256 of the cleaned
+# code, the dataset fingerprint and the versions of the analysis libraries.
+# An entry keeps stdout and the references of the chart images, which live in
+# the content-addressed blob store; an entry whose charts have disappeared
+# counts as a miss. Only runs without an error are cached. Entries expire after
+# a TTL and the least recently used ones are dropped beyond a maximum count.
+import hashlib
+import json
+import os
+import platform
+import sqlite3
+import threading
+import time
+from importlib import metadata
+from typing import Optional
+from utils.blob_store import get_chart, put_chart
+
+CACHE_PATH = os.path.join('.cache', 'executions.sqlite')
+DEFAULT_TTL = 30 * 24 * 3600   # seconds
+DEFAULT_MAX_ENTRIES = 5000
+LIBRARIES = ("pandas", "numpy", "matplotlib", "seaborn", "duckdb", "pyarrow")
+
+
+def library_versions() -> str:
+    # Versions of the libraries generated code may use; part of every key
+    versions = [f"python={platform.python_version()}"]
+    for name in LIBRARIES:
+        try:
+            versions.append(f"{name}={metadata.version(name)}")
+        except metadata.PackageNotFoundError:
+            pass
+    return ",".join(versions)
+
+
+_versions = library_versions()
+
+
+def make_key(code: str, dataset_hash: str) -> str:
+    code_hash = hashlib.sha256(code.encode("utf-8")).hexdigest()
+    return hashlib.sha256(json.dumps([code_hash, dataset_hash, _versions]).encode("utf-8")).hexdigest()
+
+
+class ExecCache:
+    def __init__(self, path: str = CACHE_PATH, ttl: float = DEFAULT_TTL, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS executions ("
+            "key TEXT PRIMARY KEY, stdout TEXT, chart_refs TEXT, duration REAL, "
+            "created REAL, accessed REAL)"
+        )
+        self._db.commit()
+
+    def get(self, key: str) -> Optional[dict]:
+        # Cached result with the chart bytes loaded, or None
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT stdout, chart_refs, duration, created FROM executions WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and now - row[3] <= self.ttl:
+                self._db.execute("UPDATE executions SET accessed = ? WHERE key = ?", (now, key))
+                self._db.commit()
+        if row is None or now - row[3] > self.ttl:
+            self.misses += 1
+            return None
+        chart_refs = json.loads(row[1])
+        charts = [get_chart(ref) for ref in chart_refs]
+        if any(chart is None for chart in charts):
+            # Charts were removed from the blob store
+            self.misses += 1
+            return None
+        self.hits += 1
+        return {"stdout": row[0], "error": None, "charts": charts, "chart_refs": chart_refs, "duration": row[2]}
+
+    def put(self, key: str, result: dict):
+        if result.get("error"):
+            return
+        chart_refs = [put_chart(chart) for chart in result.get("charts", [])]
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO executions (key, stdout, chart_refs, duration, created, accessed) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, result.get("stdout", ""), json.dumps(chart_refs), result.get("duration", 0.0), now, now)
+            )
+            self._evict(now)
+            self._db.commit()
+
+    def _evict(self, now: float):
+        # Drop expired entries, then the least recently used beyond max_entries
+        self._db.execute("DELETE FROM executions WHERE created < ?", (now - self.ttl,))
+        self._db.execute(
+            "DELETE FROM executions WHERE key IN ("
+            "SELECT key FROM executions ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,)
+        )
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._db.execute("SELECT COUNT(*) FROM executions").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "entries": entries}
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM executions")
+            self._db.commit()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_exec_cache() -> ExecCache:
+    # Process-wide cache, opened on first use
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ExecCache()
+        return _cache
@@ -0,0 +1,361 @@
+# Sandboxed execution of LLM-generated analysis code
+#
+# Generated code runs in a pool of pre-warmed worker processes instead of the
+# Streamlit script thread. Workers import pandas and matplotlib and load the
+# dataset (and its query engine) once at start-up, so a job only pays for the
+# code itself. Each job
+# has a wall-clock timeout, a resident memory cap and can be cancelled; in all
+# three cases the worker is killed and replaced, so a runaway query never takes
+# down the server or other sessions. Results of code that already ran on the
+# same data are served from the execution cache (see utils.exec_cache).
+#
+# Workers are shared by all sessions, so a job must not leave process-global
+# state behind for the next one: matplotlib rcParams and pandas options are
+# restored after every job, a worker whose job changed them is replaced anyway
+# (the job may have touched other globals too), and every worker is replaced
+# after MAX_JOBS_PER_WORKER jobs.
+import contextlib
+import io
+import multiprocessing
+import queue
+import threading
+import time
+import traceback
+import warnings
+from concurrent.futures import Future
+from typing import Optional
+
+try:
+    import psutil
+except ImportError:
+    # Without psutil the memory cap is not enforced
+    psutil = None
+
+DEFAULT_WORKERS = 2
+DEFAULT_TIMEOUT = 60            # seconds
+DEFAULT_MEMORY_LIMIT_MB = 2048  # resident set size per worker
+POLL_INTERVAL = 0.05            # seconds
+MAX_JOBS_PER_WORKER = 50
+
+
+class ExecutionError(Exception):
+    pass
+
+
+def _pandas_options(options=None, prefix: str = "") -> dict:
+    # Current value of every pandas option, e.g. {"display.max_rows": 60}
+    import pandas as pd
+    options = pd.options if options is None else options
+    values = {}
+    with warnings.catch_warnings():
+        # Reading a deprecated option warns
+        warnings.simplefilter("ignore")
+        for name in dir(options):
+            value = getattr(options, name)
+            if isinstance(value, type(pd.options)):
+                values.update(_pandas_options(value, f"{prefix}{name}."))
+            else:
+                values[f"{prefix}{name}"] = value
+    return values
+
+
+def _restore_pandas_options(saved: dict) -> bool:
+    # Put back the options a job changed; True if there were any
+    import pandas as pd
+    changed = False
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        for key, value in saved.items():
+            if pd.get_option(key) is not value and pd.get_option(key) != value:
+                pd.set_option(key, value)
+                changed = True
+    return changed
+
+
+def _run_job(job: dict) -> dict:
+    # Execute one job inside a worker process
+    import matplotlib
+    from utils.charts import capture_figures, render_figures
+    from utils.dataset import load_dataset
+    from utils.query_engine import is_large, open_engine
+
+    result = {"explanation": job.get("explanation", ""), "stdout": "", "error": None, "charts": [],
+              "timings": {}}
+    stdout = io.StringIO()
+    start_time = time.perf_counter()
+    engine = None
+    pandas_options = _pandas_options()
+    rc_params = matplotlib.rcParams.copy()
+    rc_changed = False
+    try:
+        exec_globals = {}
+        if job.get("dataset"):
+            # Large datasets are only reachable through the out-of-core engine;
+            # each job gets its own connection
+            engine = exec_globals["db"] = open_engine(job["dataset"])
+            if not is_large(job["dataset"]):
+                exec_globals["df"] = load_dataset(job["dataset"])
+        # Charts are rendered with the job's own rcParams, restored on exit
+        with matplotlib.rc_context(), capture_figures() as figures:
+            try:
+                with contextlib.redirect_stdout(stdout):
+                    exec(job["code"], exec_globals)
+                exec_done = time.perf_counter()
+                result["timings"]["exec"] = exec_done - start_time
+                result["charts"] = render_figures(figures)
+                result["timings"]["render"] = time.perf_counter() - exec_done
+            finally:
+                rc_changed = matplotlib.rcParams != rc_params
+    except BaseException as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+        result["traceback"] = traceback.format_exc()
+    finally:
+        if engine is not None:
+            engine.close()
+    if _restore_pandas_options(pandas_options) or rc_changed:
+        result["retire_worker"] = True
+    result["stdout"] = stdout.getvalue()
+    result["duration"] = time.perf_counter() - start_time
+    return result
+
+
+def _worker_main(conn, dataset: Optional[str]):
+    # Worker process: warm up, then serve jobs until told to stop
+    import pandas  # noqa: F401
+    import utils.charts  # noqa: F401  (imports matplotlib with the Agg backend)
+    from utils.dataset import load_dataset
+    from utils.query_engine import get_engine, is_large
+    if dataset:
+        try:
+            get_engine(dataset)
+            if not is_large(dataset):
+                load_dataset(dataset)
+        except Exception:
+            # Reported when a job actually needs the dataset
+            pass
+    conn.send("ready")
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+        conn.send(_run_job(job))
+
+
+class _Worker:
+    def __init__(self, ctx, dataset: Optional[str]):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, args=(child_conn, dataset), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.ready = False
+        self.failed = False     # died before it was ready
+        self.jobs = 0
+        self._ready_lock = threading.Lock()
+
+    def wait_ready(self, timeout: float) -> bool:
+        # Also called by CodeExecutor.wait_ready while the worker may be taken by a job
+        with self._ready_lock:
+            if not self.ready and not self.failed:
+                try:
+                    if self.conn.poll(timeout):
+                        self.ready = self.conn.recv() == "ready"
+                except (EOFError, OSError):
+                    # The process exited during start-up
+                    self.failed = True
+            return self.ready
+
+    def rss_mb(self) -> float:
+        if psutil is None:
+            return 0.0
+        try:
+            return psutil.Process(self.process.pid).memory_info().rss / (1024 * 1024)
+        except psutil.Error:
+            return 0.0
+
+    def kill(self):
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join(timeout=5)
+        self.conn.close()
+
+
+class Job:
+    # Handle to a submitted job
+    def __init__(self):
+        self.future = Future()
+        self._cancel = threading.Event()
+
+    def cancel(self):
+        self._cancel.set()
+
+    @property
+    def cancelled(self) -> bool:
+        # Cancelling the future (e.g. an asyncio task awaiting it) also cancels the job
+        return self._cancel.is_set() or self.future.cancelled()
+
+    def done(self) -> bool:
+        return self.future.done()
+
+    def result(self, timeout: Optional[float] = None) -> dict:
+        return self.future.result(timeout)
+
+
+class CodeExecutor:
+    def __init__(self, workers: int = DEFAULT_WORKERS, timeout: float = DEFAULT_TIMEOUT,
+                 memory_limit_mb: float = DEFAULT_MEMORY_LIMIT_MB, dataset: Optional[str] = None):
+        self.timeout = timeout
+        self.memory_limit_mb = memory_limit_mb
+        self.dataset = dataset
+        # spawn avoids forking the Streamlit server with its threads
+        self._ctx = multiprocessing.get_context("spawn")
+        self._idle = queue.Queue()
+        for _ in range(workers):
+            self._idle.put(_Worker(self._ctx, dataset))
+
+    def submit(self, code: str, dataset: Optional[str] = None, explanation: str = "",
+               timeout: Optional[float] = None, use_cache: bool = True) -> Job:
+        job = Job()
+        payload = {"code": code, "dataset": dataset or self.dataset, "explanation": explanation}
+        cache_key = None
+        if use_cache:
+            from utils.dataset import dataset_fingerprint
+            from utils.exec_cache import get_exec_cache, make_key
+            start_time = time.perf_counter()
+            cache_key = make_key(code, dataset_fingerprint(payload["dataset"]) if payload["dataset"] else "")
+            cached = get_exec_cache().get(cache_key)
+            if cached is not None:
+                job.future.set_result(dict(cached, explanation=explanation, cached=True,
+                                           timings={"cache": time.perf_counter() - start_time}))
+                return job
+        thread = threading.Thread(
+            target=self._run, args=(job, payload, timeout or self.timeout, cache_key), daemon=True
+        )
+        thread.start()
+        return job
+
+    def run(self, code: str, dataset: Optional[str] = None, explanation: str = "",
+            timeout: Optional[float] = None, use_cache: bool = True) -> dict:
+        # Submit a job and wait for its result
+        return self.submit(code, dataset, explanation, timeout, use_cache).result()
+
+    def _run(self, job: Job, payload: dict, timeout: float, cache_key: Optional[str] = None):
+        queued_at = time.perf_counter()
+        worker = self._idle.get()
+        queue_wait = time.perf_counter() - queued_at
+        try:
+            result = self._execute(worker, job, payload, timeout)
+        except Exception as e:
+            result = {"explanation": payload["explanation"], "stdout": "", "charts": [],
+                      "error": f"{type(e).__name__}: {e}", "duration": 0.0}
+        retire = result.pop("retire_worker", False) or worker.jobs >= MAX_JOBS_PER_WORKER
+        if worker.process.is_alive() and not worker.failed and not retire:
+            self._idle.put(worker)
+        else:
+            self._retire(worker)
+            self._idle.put(_Worker(self._ctx, self.dataset))
+        result.setdefault("timings", {})["queue"] = queue_wait
+        if cache_key and not job.cancelled:
+            try:
+                from utils.exec_cache import get_exec_cache
+                get_exec_cache().put(cache_key, result)
+            except Exception:
+                # The result is still returned; it is just not cached
+                pass
+        if not job.future.cancelled():
+            job.future.set_result(result)
+
+    def _execute(self, worker: _Worker, job: Job, payload: dict, timeout: float) -> dict:
+        # A freshly started worker may still be warming up
+        while not worker.wait_ready(POLL_INTERVAL):
+            if worker.failed or not worker.process.is_alive():
+                raise ExecutionError("worker failed to start")
+            if job.cancelled:
+                raise ExecutionError("cancelled")
+        if job.cancelled:
+            # Cancelled while queued: the worker goes back to the pool untouched
+            raise ExecutionError("cancelled")
+
+        start_time = time.perf_counter()
+        deadline = start_time + timeout
+        worker.jobs += 1
+        worker.conn.send(payload)
+        error = None
+        while not worker.conn.poll(POLL_INTERVAL):
+            if job.cancelled:
+                error = "Execution cancelled"
+            elif time.perf_counter() > deadline:
+                error = f"Execution timed out after {timeout:.0f}s"
+            elif self.memory_limit_mb and worker.rss_mb() > self.memory_limit_mb:
+                error = f"Execution exceeded the {self.memory_limit_mb:.0f} MB memory limit"
+            elif not worker.process.is_alive():
+                error = "Execution worker crashed"
+            if error:
+                worker.kill()
+                return {"explanation": payload["explanation"], "stdout": "", "charts": [],
+                        "error": error, "duration": time.perf_counter() - start_time}
+        return worker.conn.recv()
+
+    def wait_ready(self, timeout: float) -> bool:
+        # Wait until the idle workers have warmed up, e.g. during the server's
+        # prewarm. A worker that died during start-up is replaced once and its
+        # replacement waited for; False if that one fails too or on timeout.
+        deadline = time.perf_counter() + timeout
+        for worker in list(self._idle.queue):
+            restarted = False
+            while not worker.wait_ready(POLL_INTERVAL):
+                if worker.failed or not worker.process.is_alive():
+                    if restarted:
+                        return False
+                    worker = self._restart(worker)
+                    if worker is None:
+                        # Taken by a job in the meantime, which replaces it
+                        break
+                    restarted = True
+                elif time.perf_counter() > deadline:
+                    return False
+        return True
+
+    def _restart(self, worker: _Worker) -> Optional[_Worker]:
+        # Replace an idle worker that died; None if a job has taken it since
+        with self._idle.mutex:
+            try:
+                self._idle.queue.remove(worker)
+            except ValueError:
+                return None
+        worker.kill()
+        replacement = _Worker(self._ctx, self.dataset)
+        self._idle.put(replacement)
+        return replacement
+
+    @staticmethod
+    def _retire(worker: _Worker):
+        # Ask the worker to exit, then make sure it has
+        try:
+            worker.conn.send(None)
+        except Exception:
+            pass
+        worker.kill()
+
+    def shutdown(self):
+        while True:
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._retire(worker)
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor(dataset: Optional[str] = None, workers: int = DEFAULT_WORKERS) -> CodeExecutor:
+    # Process-wide executor, started on first use
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = CodeExecutor(workers=workers, dataset=dataset)
+        return _executor
@@ -0,0 +1,220 @@
+# Offline stand-in for the Gemini API
+#
+# FakeClient implements the part of genai.Client the app uses (chats with
+# send_message / send_message_stream / record_history, and
+# models.generate_content / generate_content_stream) and answers by replaying
+# recorded structured responses (`code` + `explanation`). Latency, time to
+# first token, stream chunking and the error rate are configurable, so the whole
+# turn pipeline can be exercised and measured without network access or an API
+# key.
+#
+# Configuration comes from environment variables (see FakeModelConfig.from_env)
+# so it also applies to Streamlit sessions started by the benchmark harness.
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from dataclasses import dataclass
+from typing import Iterator, List, Optional
+from google.genai import errors, types
+from utils.response_cache import normalize_prompt
+
+DEFAULT_RECORDINGS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                  'benchmarks', 'recordings.jsonl')
+
+
+@dataclass
+class FakeModelConfig:
+    latency: float = 1.0        # seconds until the full response is available
+    jitter: float = 0.2         # +/- fraction of latency
+    ttft: float = 0.3           # seconds until the first streamed chunk
+    chunk_size: int = 24        # characters per streamed chunk
+    error_rate: float = 0.0     # probability that a call fails with a 503
+    recordings: str = DEFAULT_RECORDINGS
+    seed: Optional[int] = None
+
+    @classmethod
+    def from_env(cls) -> "FakeModelConfig":
+        env = os.environ
+        return cls(
+            latency=float(env.get("DATACHAT_FAKE_LATENCY", cls.latency)),
+            jitter=float(env.get("DATACHAT_FAKE_JITTER", cls.jitter)),
+            ttft=float(env.get("DATACHAT_FAKE_TTFT", cls.ttft)),
+            chunk_size=int(env.get("DATACHAT_FAKE_CHUNK_SIZE", cls.chunk_size)),
+            error_rate=float(env.get("DATACHAT_FAKE_ERROR_RATE", cls.error_rate)),
+            recordings=env.get("DATACHAT_FAKE_RECORDINGS", cls.recordings),
+            seed=int(env["DATACHAT_FAKE_SEED"]) if "DATACHAT_FAKE_SEED" in env else None,
+        )
+
+
+def use_fake_model(api_key: Optional[str]) -> bool:
+    # The fake backend is used without an API key, or when forced for benchmarks
+    return not api_key or os.environ.get("DATACHAT_FAKE_MODEL", "") not in ("", "0")
+
+
+def load_recordings(path: str) -> List[dict]:
+    # One JSON object per line: {"prompt": ..., "response": {"code": ..., "explanation": ...}}
+    recordings = []
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            for line in f:
+                if line.strip():
+                    recordings.append(json.loads(line))
+    if not recordings:
+        recordings.append({"prompt": "", "response": {
+            "code": "",
+            "explanation": "This is the offline fake model. Add recorded responses to answer with data."
+        }})
+    return recordings
+
+
+def _message_text(message) -> str:
+    if isinstance(message, str):
+        return message
+    if isinstance(message, types.Content):
+        return "".join(part.text or "" for part in message.parts or [])
+    if isinstance(message, list) and message:
+        return _message_text(message[-1])
+    return str(message)
+
+
+class _Backend:
+    # Shared by the chats and models interfaces of one client
+    def __init__(self, config: FakeModelConfig):
+        self.config = config
+        self.recordings = load_recordings(config.recordings)
+        self._by_prompt = {normalize_prompt(r["prompt"]): r for r in self.recordings if r["prompt"]}
+        self._random = random.Random(config.seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+
+    def _delay(self, seconds: float) -> float:
+        with self._lock:
+            factor = 1 + self._random.uniform(-self.config.jitter, self.config.jitter)
+        return max(0.0, seconds * factor)
+
+    def _maybe_fail(self):
+        with self._lock:
+            self.calls += 1
+            failed = self._random.random() < self.config.error_rate
+        if failed:
+            raise errors.ServerError(503, {"error": {
+                "code": 503, "status": "UNAVAILABLE", "message": "The model is overloaded (simulated)."
+            }})
+
+    def answer(self, prompt: str, config) -> str:
+        # Recorded response for the prompt, or a deterministic pick among the recordings
+        recording = self._by_prompt.get(normalize_prompt(prompt))
+        if recording is None:
+            index = int(hashlib.sha256(prompt.encode("utf-8")).hexdigest(), 16) % len(self.recordings)
+            recording = self.recordings[index]
+        response = recording["response"]
+        if config is not None and getattr(config, "response_schema", None):
+            return json.dumps(response)
+        return response.get("explanation", "")
+
+    def response(self, text: str, prompt: str, final: bool = True) -> types.GenerateContentResponse:
+        prompt_tokens = max(1, len(prompt) // 4)
+        output_tokens = max(1, len(text) // 4)
+        return types.GenerateContentResponse(
+            candidates=[types.Candidate(content=types.Content(role="model", parts=[types.Part(text=text)]),
+                                        finish_reason=types.FinishReason.STOP if final else None)],
+            usage_metadata=types.GenerateContentResponseUsageMetadata(
+                prompt_token_count=prompt_tokens,
+                candidates_token_count=output_tokens,
+                total_token_count=prompt_tokens + output_tokens
+            )
+        )
+
+    def generate(self, prompt: str, config) -> types.GenerateContentResponse:
+        self._maybe_fail()
+        time.sleep(self._delay(self.config.latency))
+        return self.response(self.answer(prompt, config), prompt)
+
+    def chunks(self, prompt: str, config) -> List[str]:
+        text = self.answer(prompt, config)
+        size = max(1, self.config.chunk_size)
+        return [text[i:i + size] for i in range(0, len(text), size)] or [""]
+
+    def stream_delays(self, chunk_count: int):
+        # Delay before the first chunk, then an even share of the remaining latency
+        first = self._delay(self.config.ttft)
+        rest = max(0.0, self._delay(self.config.latency) - first) / max(1, chunk_count - 1)
+        return first, rest
+
+    def generate_stream(self, prompt: str, config) -> Iterator[types.GenerateContentResponse]:
+        self._maybe_fail()
+        chunks = self.chunks(prompt, config)
+        first, rest = self.stream_delays(len(chunks))
+        time.sleep(first)
+        for index, chunk in enumerate(chunks):
+            if index:
+                time.sleep(rest)
+            yield self.response(chunk, prompt, final=index == len(chunks) - 1)
+
+
+class FakeChat:
+    def __init__(self, backend: _Backend, model: str, config=None, history=None):
+        self._backend = backend
+        self.model = model
+        self.config = config
+        self._history = list(history or [])
+
+    def _record(self, prompt: str, text: str):
+        self._history.append(types.Content(role="user", parts=[types.Part(text=prompt)]))
+        self._history.append(types.Content(role="model", parts=[types.Part(text=text)]))
+
+    def record_history(self, user_input, model_output, automatic_function_calling_history, is_valid):
+        if is_valid:
+            self._history.append(user_input)
+            self._history.extend(model_output or [types.Content(role="model", parts=[])])
+
+    def send_message(self, message, config=None):
+        prompt = _message_text(message)
+        response = self._backend.generate(prompt, config or self.config)
+        self._record(prompt, response.text)
+        return response
+
+    def send_message_stream(self, message, config=None):
+        prompt = _message_text(message)
+        text = ""
+        for chunk in self._backend.generate_stream(prompt, config or self.config):
+            text += chunk.text
+            yield chunk
+        self._record(prompt, text)
+
+    def get_history(self, curated: bool = False) -> list:
+        return list(self._history)
+
+
+class _Chats:
+    def __init__(self, backend: _Backend):
+        self._backend = backend
+
+    def create(self, *, model: str, config=None, history=None) -> FakeChat:
+        return FakeChat(self._backend, model, config, history)
+
+
+class _Models:
+    def __init__(self, backend: _Backend):
+        self._backend = backend
+
+    def generate_content(self, *, model: str, contents, config=None):
+        return self._backend.generate(_message_text(contents), config)
+
+    def generate_content_stream(self, *, model: str, contents, config=None):
+        return self._backend.generate_stream(_message_text(contents), config)
+
+
+class FakeClient:
+    def __init__(self, config: Optional[FakeModelConfig] = None):
+        self.config = config or FakeModelConfig.from_env()
+        self._backend = _Backend(self.config)
+        self.chats = _Chats(self._backend)
+        self.models = _Models(self._backend)
+
+    @property
+    def calls(self) -> int:
+        return self._backend.calls
@@ -0,0 +1,298 @@
+# Per-turn tracing and metrics
+#
+# A TurnTrace times the stages of one chat turn (chat creation, the model call,
+# JSON parsing, code execution, figure capture and PNG encoding, ...) and keeps
+# the token counts reported in the response's usage metadata. Finished traces
+# are appended as JSON lines to a rotating log under logs/ and folded into
+# process-wide histograms and counters, which are served in the Prometheus text
+# format on http://localhost:<DATACHAT_METRICS_PORT>/metrics (default 9464,
+# "0" disables the endpoint), bound to DATACHAT_METRICS_HOST (default
+# 127.0.0.1, all interfaces under serve.py). /ready on the same port answers 503
+# until the server's prewarm is done (see utils.startup).
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging.handlers import RotatingFileHandler
+from typing import Optional
+
+METRICS_LOG_PATH = os.path.join('logs', 'metrics.jsonl')
+METRICS_LOG_MAX_BYTES = 5 * 1024 * 1024
+METRICS_LOG_BACKUPS = 5
+DEFAULT_METRICS_PORT = 9464
+DEFAULT_METRICS_HOST = "127.0.0.1"
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# name -> (type, help)
+METRICS = {
+    "datachat_turn_seconds": ("histogram", "Wall time of a chat turn"),
+    "datachat_stage_seconds": ("histogram", "Wall time of each stage of a chat turn"),
+    "datachat_ttft_seconds": ("histogram", "Time to the first streamed token"),
+    "datachat_turns_total": ("counter", "Chat turns by outcome"),
+    "datachat_errors_total": ("counter", "Failed turns by stage"),
+    "datachat_tokens_total": ("counter", "Tokens reported by the model"),
+    "datachat_model_requests_total": ("counter", "Upstream model requests by outcome"),
+    "datachat_model_retries_total": ("counter", "Model requests retried after a transient error"),
+    "datachat_model_coalesced_total": ("counter", "Model requests served by an identical in-flight request"),
+    "datachat_model_wait_seconds": ("histogram", "Time a model request waited for the rate limiter and a free slot"),
+    "datachat_model_queue_depth": ("gauge", "Model requests waiting to be sent"),
+    "datachat_model_in_flight": ("gauge", "Model requests being sent"),
+    "datachat_startup_seconds": ("gauge", "Wall time of each prewarm step at server start"),
+    "datachat_import_seconds": ("gauge", "Import time of each heavy module at server start"),
+    "datachat_cold_start_seconds": ("gauge", "Time from process start to the first page, answer and readiness"),
+}
+
+
+def percentile(values: list, pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def _labels(labels: dict) -> tuple:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: tuple, extra: Optional[tuple] = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + "}"
+
+
+class MetricsRegistry:
+    # Thread-safe histograms, counters and gauges with Prometheus text exposition
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._histograms = {}   # (name, labels) -> [bucket counts..., count, sum]
+        self._counters = {}     # (name, labels) -> value
+        self._gauges = {}       # (name, labels) -> value
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            series = self._histograms.setdefault(key, [0] * len(self.buckets) + [0, 0.0])
+            for index, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    series[index] += 1
+            series[-2] += 1
+            series[-1] += seconds
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        with self._lock:
+            self._gauges[(name, _labels(labels))] = value
+
+    def render(self) -> str:
+        with self._lock:
+            histograms = {key: list(series) for key, series in self._histograms.items()}
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+        lines = []
+        for name, (kind, description) in METRICS.items():
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} {kind}"]
+            if kind == "histogram":
+                for (series_name, labels), series in sorted(histograms.items()):
+                    if series_name != name:
+                        continue
+                    for bound, count in zip(self.buckets, series):
+                        lines.append(f"{name}_bucket{_format_labels(labels, ('le', repr(float(bound))))} {count}")
+                    lines.append(f"{name}_bucket{_format_labels(labels, ('le', '+Inf'))} {series[-2]}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {series[-2]}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {series[-1]:.6f}")
+            else:
+                values = counters if kind == "counter" else gauges
+                for (series_name, labels), value in sorted(values.items()):
+                    if series_name == name:
+                        lines.append(f"{name}{_format_labels(labels)} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+_registry = MetricsRegistry()
+_logger = None
+_logger_lock = threading.Lock()
+
+
+def get_registry() -> MetricsRegistry:
+    return _registry
+
+
+def _get_logger() -> logging.Logger:
+    # JSON-lines log of finished traces, rotated by size
+    global _logger
+    with _logger_lock:
+        if _logger is None:
+            os.makedirs(os.path.dirname(METRICS_LOG_PATH), exist_ok=True)
+            handler = RotatingFileHandler(METRICS_LOG_PATH, maxBytes=METRICS_LOG_MAX_BYTES,
+                                          backupCount=METRICS_LOG_BACKUPS)
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            logger = logging.getLogger("datachat.metrics")
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+            logger.addHandler(handler)
+            _logger = logger
+        return _logger
+
+
+def log_record(record: dict):
+    # Append a record to the metrics log; metrics must never break the caller
+    try:
+        _get_logger().info(json.dumps(record))
+    except Exception:
+        pass
+
+
+def observe_stage(stage: str, seconds: float, model: str = ""):
+    # For timings that are not part of a turn, e.g. rendering the history on a rerun
+    _registry.observe("datachat_stage_seconds", seconds, stage=stage, model=model)
+
+
+class TurnTrace:
+    def __init__(self, session_id: str, model: str, agent: str = "", mode: str = "single"):
+        self.record = {
+            "turn_id": uuid.uuid4().hex[:12],
+            "session_id": session_id,
+            "model": model,
+            "agent": agent,
+            "mode": mode,
+            "started": time.time(),
+            "stages": {},
+            "tokens": {},
+            "ttft": None,
+            "cached": False,
+            "error": None,
+            "retries": 0,
+            "coalesced": False,
+            "routing": None,
+        }
+        self._start = time.perf_counter()
+        self._span_starts = {}
+
+    @contextlib.contextmanager
+    def span(self, stage: str):
+        # Time a stage; an exception escaping it is recorded as the turn's error
+        start_time = self._span_starts[stage] = time.perf_counter()
+        try:
+            yield self
+        except Exception as e:
+            self.fail(stage, e)
+            raise
+        finally:
+            self.add(stage, time.perf_counter() - start_time)
+
+    def add(self, stage: str, seconds: float):
+        stages = self.record["stages"]
+        stages[stage] = stages.get(stage, 0.0) + seconds
+
+    def first_token(self, stage: str = "model"):
+        # Called when the first streamed chunk of the model span arrives
+        if self.record["ttft"] is None and stage in self._span_starts:
+            self.record["ttft"] = time.perf_counter() - self._span_starts[stage]
+
+    def add_usage(self, usage_metadata):
+        # Streamed chunks report running totals, so the last report wins
+        if usage_metadata is None:
+            return
+        for name, field in (("prompt", "prompt_token_count"), ("output", "candidates_token_count"),
+                            ("cached", "cached_content_token_count"), ("thoughts", "thoughts_token_count"),
+                            ("total", "total_token_count")):
+            value = getattr(usage_metadata, field, None)
+            if value:
+                self.record["tokens"][name] = value
+
+    def fail(self, stage: str, error):
+        # Keep the first error of the turn
+        if self.record["error"] is None:
+            message = str(error) if isinstance(error, str) else f"{type(error).__name__}: {error}"
+            self.record["error"] = {"stage": stage, "message": message[:500]}
+
+    def finish(self) -> dict:
+        record = self.record
+        record["total"] = time.perf_counter() - self._start
+        model = record["model"]
+        _registry.observe("datachat_turn_seconds", record["total"], model=model, mode=record["mode"])
+        for stage, seconds in record["stages"].items():
+            _registry.observe("datachat_stage_seconds", seconds, stage=stage, model=model)
+        if record["ttft"] is not None:
+            _registry.observe("datachat_ttft_seconds", record["ttft"], model=model)
+        outcome = "error" if record["error"] else "cached" if record["cached"] else "ok"
+        _registry.inc("datachat_turns_total", model=model, outcome=outcome)
+        if record["error"]:
+            _registry.inc("datachat_errors_total", model=model, stage=record["error"]["stage"])
+        for kind in ("prompt", "output", "cached", "thoughts"):
+            if kind in record["tokens"]:
+                _registry.inc("datachat_tokens_total", record["tokens"][kind], model=model, kind=kind)
+        log_record(record)
+        return record
+
+
+def add_exec_timings(trace: TurnTrace, result: dict):
+    # Break an executor result down into the cache lookup, queueing, running the
+    # code and chart capture + PNG encoding, as measured by the pool and the worker
+    timings = result.get("timings", {})
+    for stage, key in (("exec_cache", "cache"), ("exec_queue", "queue"), ("exec_code", "exec"),
+                       ("render", "render")):
+        if key in timings:
+            trace.add(stage, timings[key])
+    if result.get("error"):
+        trace.fail("exec", result["error"])
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path == "/metrics":
+            status, body = 200, _registry.render().encode("utf-8")
+        elif path == "/ready":
+            # For readiness probes: the first user should not pay for a cold start
+            from utils.startup import get_startup_report
+            ready = get_startup_report().ready.is_set()
+            status, body = (200, b"ready\n") if ready else (503, b"warming up\n")
+        else:
+            self.send_error(404)
+            return
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def start_metrics_server(port: Optional[int] = None, host: Optional[str] = None):
+    # Serve /metrics from a daemon thread, once per process
+    global _server
+    if port is None:
+        port = int(os.environ.get("DATACHAT_METRICS_PORT", DEFAULT_METRICS_PORT))
+    if host is None:
+        host = os.environ.get("DATACHAT_METRICS_HOST", DEFAULT_METRICS_HOST)
+    with _server_lock:
+        if _server is not None or port == 0:
+            return _server
+        try:
+            _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+        except OSError:
+            # Port taken, e.g. by another server process; metrics are still logged
+            _server = False
+            return _server
+        _server.daemon_threads = True
+        threading.Thread(target=_server.serve_forever, name="metrics-server", daemon=True).start()
+        return _server
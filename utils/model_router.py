@@ -0,0 +1,112 @@
+# Latency-aware model routing and hedged requests
+#
+# In routing mode the chat picks the model for each turn instead of using the
+# one selected in the sidebar. Simple questions (short lookups, a single chart)
+# go to a fast model and anything that needs more reasoning to a strong one; a
+# turn whose answer cannot be parsed or whose code fails is asked again, once,
+# on the strong tier. Within a tier, models are ranked by their recent p95
+# latency and error rate as seen by the request scheduler. If the chosen model
+# has not answered after its own recent p95 latency, the request is also sent to
+# the runner-up (a hedged request) and the first valid response is used.
+import time
+from concurrent.futures import FIRST_COMPLETED, CancelledError, wait
+from typing import Callable, List, NamedTuple, Optional
+from utils.scheduler import get_scheduler
+
+ROUTED_MODEL = "auto"   # model name used for routed turns in the response cache
+FAST_MODELS = ("models/gemini-2.0-flash", "models/gemini-1.5-flash")
+STRONG_MODELS = ("models/gemini-2.5-flash", "models/gemini-1.5-pro-latest")
+COMPLEX_WORDS = ("why", "explain", "correlat", "relationship", "predict", "regress", "forecast", "cluster",
+                 "significan", "hypothes", "model", "trend", "compare", "versus", " vs", "impact", "cause",
+                 "segment", "outlier", "anomal", "factor")
+MAX_SIMPLE_WORDS = 25
+MIN_SAMPLES = 5               # successful attempts before a model's p95 is trusted
+PRIOR_LATENCY = 5.0           # seconds, assumed p95 of a model without enough history
+ERROR_WEIGHT = 4.0            # how much recent errors count against a model
+DEFAULT_HEDGE_DELAY = 8.0     # seconds, until the model has enough history
+MIN_HEDGE_DELAY = 1.0
+POLL_INTERVAL = 0.1
+
+
+class Route(NamedTuple):
+    model: str
+    backup: Optional[str]     # for a hedged request
+    tier: str                 # "fast" or "strong"
+    reason: str
+
+
+def is_simple(prompt: str) -> bool:
+    text = f" {prompt.lower()}"
+    if len(text.split()) > MAX_SIMPLE_WORDS or text.count("?") > 1:
+        return False
+    return not any(word in text for word in COMPLEX_WORDS)
+
+
+def model_score(model: str) -> float:
+    # Expected p95 latency, inflated by the recent error rate; lower is better
+    health = get_scheduler().model_health(model)
+    latency = health["p95"] if health["samples"] >= MIN_SAMPLES else PRIOR_LATENCY
+    return latency * (1 + ERROR_WEIGHT * health["error_rate"])
+
+
+def rank(models) -> List[str]:
+    # Stable, so models without history keep the order of the tier
+    return sorted(models, key=model_score)
+
+
+def choose_route(prompt: str, escalate: bool = False, exclude=()) -> Route:
+    if escalate:
+        tier, reason = "strong", "escalated"
+    elif is_simple(prompt):
+        tier, reason = "fast", "simple question"
+    else:
+        tier, reason = "strong", "complex question"
+    preferred, others = (STRONG_MODELS, FAST_MODELS) if tier == "strong" else (FAST_MODELS, STRONG_MODELS)
+    candidates = [model for model in rank(preferred) + rank(others) if model not in exclude]
+    if not candidates:
+        candidates = list(preferred)
+    return Route(candidates[0], candidates[1] if len(candidates) > 1 else None, tier, reason)
+
+
+def hedge_delay(model: str) -> float:
+    health = get_scheduler().model_health(model)
+    if health["samples"] < MIN_SAMPLES:
+        return DEFAULT_HEDGE_DELAY
+    return max(MIN_HEDGE_DELAY, health["p95"])
+
+
+def generate_hedged(client, route: Route, contents, config=None, validate: Optional[Callable] = None,
+                    trace=None, cancel=None):
+    # (model, response, hedged) for the first valid response of route.model or,
+    # once that is slower than its p95 or has failed, of route.backup
+    scheduler = get_scheduler()
+    calls = [(route.model, scheduler.submit(client, route.model, contents, config))]
+    hedge_at = time.perf_counter() + hedge_delay(route.model)
+    hedged = False
+    last_error = None
+    try:
+        while True:
+            if cancel is not None and cancel.is_set():
+                raise CancelledError("model request cancelled")
+            for model, call in list(calls):
+                if not call.future.done():
+                    continue
+                calls.remove((model, call))
+                scheduler.release(call, trace)
+                try:
+                    response = call.future.result()
+                    if validate is None or validate(response):
+                        return model, response, hedged
+                    last_error = ValueError(f"{model} returned an answer that does not match the response schema")
+                except Exception as e:
+                    last_error = e
+            if not hedged and route.backup and (not calls or time.perf_counter() >= hedge_at):
+                hedged = True
+                calls.append((route.backup, scheduler.submit(client, route.backup, contents, config)))
+            if not calls:
+                raise last_error
+            wait([call.future for _, call in calls], timeout=POLL_INTERVAL, return_when=FIRST_COMPLETED)
+    finally:
+        # The slower request is abandoned
+        for _, call in calls:
+            scheduler.release(call)
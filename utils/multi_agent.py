@@ -0,0 +1,46 @@
+# Multi-agent mode: ask every active agent at once
+#
+# Each agent's turn runs through utils.turn_engine.run_turn on its own thread,
+# and the code of each structured answer is submitted to the sandbox pool as
+# soon as that answer arrives, so model calls and code execution of different
+# agents overlap. The total wall time is close to the slowest agent
+# rather than the sum of all of them.
+#
+# The agents deliberately do not use the async genai client (client.aio): every
+# model call goes through the shared, thread-based request scheduler (rate
+# limits, retries, coalescing with other sessions; see utils.scheduler) and the
+# same turn pipeline as the chat. The waiting happens in threads; the asyncio
+# loop here only gathers the answers as they finish and handles cancellation.
+import asyncio
+import threading
+from typing import Callable, List, Optional
+from utils.turn_engine import CANCEL_POLL, TurnCancelled, run_turn
+
+
+async def run_agents(client, model: str, agents: List[dict], instructions: List[str], prompt: str,
+                     history: list, dataset: str, dataset_hash: str, use_cache: bool = True,
+                     session_id: str = "", context: Optional[list] = None,
+                     on_answer: Optional[Callable] = None, cancel: Optional[threading.Event] = None) -> List:
+    # Answers in the order of agents. on_answer(index, answer) is called as each
+    # one finishes; setting cancel stops the agents still running and raises
+    # TurnCancelled.
+    tasks = [
+        asyncio.ensure_future(run_turn(client, model, agent, instruction, prompt, history, dataset, dataset_hash,
+                                       use_cache=use_cache, session_id=session_id, context=context))
+        for agent, instruction in zip(agents, instructions)
+    ]
+    answers = [None] * len(tasks)
+    pending = set(tasks)
+    while pending:
+        done, pending = await asyncio.wait(pending, timeout=CANCEL_POLL, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            index = tasks.index(task)
+            answers[index] = task.result()
+            if on_answer is not None:
+                on_answer(index, answers[index])
+        if cancel is not None and cancel.is_set() and pending:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            raise TurnCancelled()
+    return answers
@@ -0,0 +1,135 @@
+# Dataset profile for the agent system instruction
+#
+# Without knowing the columns, the model guesses names and types, the generated
+# code fails, and the user has to ask again. The profile is a compact text
+# summary of the dataset (shape, column dtypes, null rates, cardinalities,
+# numeric ranges, frequent values and a few sample rows) that is appended to
+# every agent's persona, together with a note on how the code can reach the
+# data (`df` and/or the `db` query engine). It is computed once per dataset
+# content hash and kept in memory and under .cache/profiles, and is trimmed to
+# a token budget.
+import json
+import os
+import threading
+import uuid
+from typing import Optional
+import pandas as pd
+from utils.dataset import dataset_fingerprint, load_dataset
+from utils.query_engine import data_access_note, get_engine, is_large
+
+PROFILE_DIR = os.path.join('.cache', 'profiles')
+PROFILE_SAMPLE_ROWS = 100_000  # statistics of large datasets come from a sample
+DEFAULT_TOKEN_BUDGET = 800
+SAMPLE_ROWS = 3
+TOP_VALUES = 3
+CHARS_PER_TOKEN = 4
+
+_profiles = {}
+_lock = threading.Lock()    # guards _profiles and _key_locks; only held briefly
+_key_locks = {}             # (fingerprint, budget) -> lock held while that profile is built
+
+
+def estimate_tokens(text: str) -> int:
+    # Rough token count; good enough for budgeting without an API call
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def _describe_column(series: pd.Series, top_values: int) -> str:
+    null_rate = series.isna().mean() * 100
+    line = f"- {series.name} ({series.dtype}): {null_rate:.0f}% null, {series.nunique()} unique"
+    if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+        if series.notna().any():
+            line += f", range {series.min():.4g} to {series.max():.4g}, mean {series.mean():.4g}"
+    elif top_values:
+        values = series.value_counts().head(top_values).index
+        line += ", top: " + ", ".join(repr(str(value)[:30]) for value in values)
+    return line
+
+
+def _render(frame: pd.DataFrame, path: str, top_values: int, sample_rows: int, max_columns: int,
+            row_count: int) -> str:
+    header = f"Dataset profile ({os.path.basename(path)}, {row_count} rows x {len(frame.columns)} columns"
+    if row_count > len(frame):
+        header += f"; statistics from a random sample of {len(frame)} rows"
+    lines = [header + ").", "Columns:"]
+    for column in frame.columns[:max_columns]:
+        lines.append(_describe_column(frame[column], top_values))
+    if len(frame.columns) > max_columns:
+        lines.append(f"- ... {len(frame.columns) - max_columns} more columns")
+    if sample_rows:
+        lines.append("Sample rows (CSV):")
+        sample = frame.head(sample_rows)[frame.columns[:max_columns]]
+        lines.append(sample.to_csv(index=False).strip())
+    return "\n".join(lines)
+
+
+def build_profile(frame: pd.DataFrame, path: str, token_budget: int = DEFAULT_TOKEN_BUDGET,
+                  row_count: Optional[int] = None) -> str:
+    # Drop detail until the profile fits: sample rows, then top values, then columns
+    row_count = len(frame) if row_count is None else row_count
+    max_columns = len(frame.columns)
+    for top_values, sample_rows in ((TOP_VALUES, SAMPLE_ROWS), (TOP_VALUES, 1), (0, 1), (0, 0)):
+        text = _render(frame, path, top_values, sample_rows, max_columns, row_count)
+        if estimate_tokens(text) <= token_budget:
+            return text
+    while max_columns > 1:
+        max_columns = max_columns * 3 // 4
+        text = _render(frame, path, 0, 0, max_columns, row_count)
+        if estimate_tokens(text) <= token_budget:
+            break
+    return text
+
+
+def _load_or_build(path: str, fingerprint: str, token_budget: int) -> dict:
+    cache_path = os.path.join(PROFILE_DIR, f"{fingerprint}_{token_budget}.json")
+    if os.path.exists(cache_path):
+        try:
+            with open(cache_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            # Unreadable, e.g. left by an older version writing in place; rebuilt below
+            pass
+
+    if is_large(path):
+        engine = get_engine(path)
+        text = build_profile(engine.sample(PROFILE_SAMPLE_ROWS), path, token_budget, engine.count())
+    else:
+        text = build_profile(load_dataset(path), path, token_budget)
+    profile = {"fingerprint": fingerprint, "text": text}
+    try:
+        # Written to a temporary file and renamed, so a reader never sees half a profile
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        tmp_path = f"{cache_path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(profile, f)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        pass
+    return profile
+
+
+def get_profile(path: str, token_budget: int = DEFAULT_TOKEN_BUDGET) -> dict:
+    # Profile of the dataset, computed once per content hash and budget
+    fingerprint = dataset_fingerprint(path)
+    key = (fingerprint, token_budget)
+    with _lock:
+        profile = _profiles.get(key)
+        key_lock = _key_locks.setdefault(key, threading.Lock())
+    if profile is None:
+        # Built under the profile's own lock, so other datasets' profiles stay available
+        with key_lock:
+            with _lock:
+                profile = _profiles.get(key)
+            if profile is None:
+                profile = _load_or_build(path, fingerprint, token_budget)
+                with _lock:
+                    _profiles[key] = profile
+
+    # How the code reaches the data depends on the installed engine and the size
+    access = data_access_note(path)
+    return dict(profile, access=access, tokens=estimate_tokens(f"{access}\n\n{profile['text']}"))
+
+
+def with_profile(persona: str, profile: dict) -> str:
+    # System instruction for an agent: its persona, the data access notes and the dataset profile
+    return f"{persona}\n\n{profile['access']}\n\n{profile['text']}"
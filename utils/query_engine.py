@@ -0,0 +1,188 @@
+# Out-of-core query engine over the dataset
+#
+# Loading the whole dataset into pandas does not work once it is larger than
+# memory. Generated code instead gets `db`, a thin wrapper around an embedded
+# DuckDB connection with the dataset exposed as the table `data`. Queries are
+# executed by DuckDB (aggregations and filters are pushed down and run
+# out-of-core under a memory limit), and only the result is returned as a
+# pandas DataFrame. Results larger than MAX_RESULT_ROWS are returned as a random
+# sample, so plotting a very large table stays bounded. Only read-only
+# statements are accepted, and each sandbox job gets its own connection
+# (open_engine), so nothing a job does is seen by the next one on the worker.
+#
+# CSV files are converted once to Parquet under CACHE_DIR so later queries only
+# read the columns they need. The copy has its own name: DuckDB infers column
+# types differently from utils.dataset, whose pandas-typed copy `df` (and the
+# profile) are read from. Datasets larger than LARGE_DATASET_BYTES are not
+# preloaded into pandas at all; generated code must use `db` for them.
+import os
+import threading
+import uuid
+from typing import Optional
+import numpy as np
+import pandas as pd
+from utils.dataset import CACHE_DIR, dataset_fingerprint
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+LARGE_DATASET_BYTES = 200 * 1024 * 1024
+DEFAULT_MEMORY_LIMIT = '1GB'
+MAX_RESULT_ROWS = 100_000
+BATCH_ROWS = 65_536
+TABLE_NAME = 'data'
+READ_ONLY_STATEMENTS = ('SELECT', 'EXPLAIN')
+
+_engines = {}
+_lock = threading.Lock()
+
+
+def is_large(path: str) -> bool:
+    # Too large to preload into pandas in every worker
+    return duckdb is not None and os.path.getsize(path) > LARGE_DATASET_BYTES
+
+
+def _quote(path: str) -> str:
+    return "'" + path.replace("'", "''") + "'"
+
+
+def columnar_source(path: str) -> str:
+    # Parquet copy of the dataset, converted by DuckDB without loading it into memory
+    if path.endswith('.parquet'):
+        return path
+    columnar_path = os.path.join(CACHE_DIR, f"{dataset_fingerprint(path)}.duckdb.parquet")
+    if not os.path.exists(columnar_path):
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_path = f"{columnar_path}.{uuid.uuid4().hex}.tmp"
+        con = duckdb.connect()
+        try:
+            con.execute(f"SET memory_limit = '{DEFAULT_MEMORY_LIMIT}'")
+            con.execute(
+                f"COPY (SELECT * FROM read_csv_auto({_quote(path)})) "
+                f"TO {_quote(tmp_path)} (FORMAT PARQUET, COMPRESSION ZSTD)"
+            )
+        finally:
+            con.close()
+        os.replace(tmp_path, columnar_path)
+    return columnar_path
+
+
+class QueryEngine:
+    def __init__(self, path: str, memory_limit: str = DEFAULT_MEMORY_LIMIT, max_rows: int = MAX_RESULT_ROWS):
+        if duckdb is None:
+            raise ImportError("duckdb is required for the query engine")
+        self.path = path
+        self.max_rows = max_rows
+        self.memory_limit = memory_limit
+        self.source = columnar_source(path)
+        self._con = None
+        self._con_lock = threading.Lock()
+
+    def _connection(self):
+        # Opened on first use, so a job that never touches db does not pay for it
+        with self._con_lock:
+            if self._con is None:
+                con = duckdb.connect()
+                con.execute(f"SET memory_limit = '{self.memory_limit}'")
+                con.execute(f"SET temp_directory = {_quote(os.path.join(CACHE_DIR, 'duckdb_tmp'))}")
+                con.execute(f"CREATE VIEW {TABLE_NAME} AS SELECT * FROM read_parquet({_quote(self.source)})")
+                self._con = con
+            return self._con
+
+    def close(self):
+        with self._con_lock:
+            if self._con is not None:
+                self._con.close()
+                self._con = None
+
+    def sql(self, query: str, max_rows: Optional[int] = None) -> pd.DataFrame:
+        # Run a read-only query against the table `data`. A result over max_rows
+        # rows comes back as a uniform random sample (in result order) taken
+        # while reading it, so the query runs once; frame.attrs["note"] then says so.
+        max_rows = max_rows or self.max_rows
+        con = self._connection()
+        for statement in con.extract_statements(query):
+            if statement.type.name not in READ_ONLY_STATEMENTS:
+                raise ValueError(f"db.sql only runs read-only queries (SELECT); got a {statement.type.name} "
+                                 "statement. Use pandas for derived tables.")
+        cursor = con.cursor()
+        try:
+            relation = cursor.sql(query)
+            if relation is None:
+                # A statement without a result set
+                return pd.DataFrame()
+            # to_arrow_reader is the newer name of fetch_arrow_reader
+            reader = (relation.to_arrow_reader if hasattr(relation, "to_arrow_reader")
+                      else relation.fetch_arrow_reader)(BATCH_ROWS)
+            rng = np.random.default_rng()
+            frame, keys, total = None, np.empty(0), 0
+            for batch in reader:
+                chunk = batch.to_pandas()
+                chunk.index = pd.RangeIndex(total, total + len(chunk))
+                total += len(chunk)
+                frame = chunk if frame is None else pd.concat([frame, chunk])
+                keys = np.concatenate([keys, rng.random(len(chunk))])
+                if len(frame) > max_rows:
+                    # Keep the rows with the smallest random keys
+                    keep = np.argpartition(keys, max_rows)[:max_rows]
+                    frame, keys = frame.iloc[keep], keys[keep]
+            if frame is None:
+                return reader.schema.empty_table().to_pandas()
+            frame = frame.sort_index().reset_index(drop=True)
+            if total > max_rows:
+                frame.attrs["note"] = f"The query returned {total} rows; this is a random sample of {max_rows}."
+            return frame
+        finally:
+            cursor.close()
+
+    def sample(self, n: int = 10_000) -> pd.DataFrame:
+        # Random sample of whole rows, e.g. for plotting distributions
+        return self.sql(f"SELECT * FROM {TABLE_NAME} USING SAMPLE reservoir({int(n)} ROWS)", max_rows=n)
+
+    def count(self) -> int:
+        return int(self.sql(f"SELECT COUNT(*) AS n FROM {TABLE_NAME}")["n"].iloc[0])
+
+    @property
+    def columns(self) -> dict:
+        # Column name -> DuckDB type
+        frame = self.sql(f"DESCRIBE {TABLE_NAME}")
+        return dict(zip(frame["column_name"], frame["column_type"]))
+
+
+def open_engine(path: str) -> Optional[QueryEngine]:
+    # A private engine for one sandbox job; the caller closes it. None without duckdb
+    if duckdb is None:
+        return None
+    return QueryEngine(path)
+
+
+def get_engine(path: str) -> Optional[QueryEngine]:
+    # Engine for a dataset, shared within the process (profiling, row counts);
+    # None without duckdb
+    if duckdb is None:
+        return None
+    key = (os.path.abspath(path), dataset_fingerprint(path))
+    with _lock:
+        engine = _engines.get(key)
+        if engine is None:
+            engine = QueryEngine(path)
+            _engines[key] = engine
+        return engine
+
+
+def data_access_note(path: str) -> str:
+    # How generated code should reach the data, added to the system instruction
+    if duckdb is None:
+        return "The data is loaded as the pandas DataFrame `df`."
+    api = (
+        f"`db.sql(query)` runs a read-only DuckDB SQL query (SELECT) against the table `{TABLE_NAME}` and "
+        "returns a pandas DataFrame "
+        f"(results over {MAX_RESULT_ROWS} rows are randomly sampled, and the DataFrame's `attrs['note']` says so); "
+        "`db.sample(n)` returns n random rows "
+        "and `db.count()` the number of rows. Do aggregations, filters and group-bys in SQL."
+    )
+    if is_large(path):
+        return f"The dataset is too large to load into memory and `df` is NOT available. {api}"
+    return f"The data is loaded as the pandas DataFrame `df`. For heavy aggregations you can also use `db`: {api}"
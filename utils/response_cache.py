@@ -0,0 +1,148 @@
+# Persistent LLM response cache
+#
+# Answers are keyed by everything that can change them: the model, the agent
+# persona and response schema, the dataset content hash, the normalised prompt
+# and a digest of the earlier turns of the conversation. Entries live in a
+# bounded in-memory LRU in front of an SQLite file, so they survive restarts and
+# can be replayed offline. Both tiers expire entries after a TTL; the disk tier
+# is additionally trimmed to a maximum size, oldest access first.
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+from utils.chat_manager import message_to_text
+
+CACHE_PATH = os.path.join('.cache', 'responses.sqlite')
+DEFAULT_MEMORY_ENTRIES = 256
+DEFAULT_TTL = 7 * 24 * 3600            # seconds
+DEFAULT_MAX_DISK_BYTES = 200 * 1024 * 1024
+
+
+def normalize_prompt(prompt: str) -> str:
+    # Whitespace does not change the question; case can (e.g. sex == 'Male' vs 'male')
+    return " ".join(prompt.split())
+
+
+def history_digest(messages: list) -> str:
+    # Digest of the user/assistant turns before the prompt (charts excluded)
+    digest = hashlib.sha256()
+    for message in messages:
+        if message["role"] not in ("user", "assistant"):
+            continue
+        digest.update(json.dumps([message["role"], message_to_text(message)]).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def make_key(model: str, persona: str, schema: dict, dataset_hash: str, prompt: str, history: list) -> str:
+    parts = [model, persona, json.dumps(schema, sort_keys=True), dataset_hash,
+             normalize_prompt(prompt), history_digest(history)]
+    return hashlib.sha256(json.dumps(parts).encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, path: str = CACHE_PATH, memory_entries: int = DEFAULT_MEMORY_ENTRIES,
+                 ttl: float = DEFAULT_TTL, max_disk_bytes: int = DEFAULT_MAX_DISK_BYTES):
+        self.path = path
+        self.memory_entries = memory_entries
+        self.ttl = ttl
+        self.max_disk_bytes = max_disk_bytes
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, model TEXT, prompt TEXT, text TEXT, "
+            "size INTEGER, created REAL, accessed REAL)"
+        )
+        self._db.commit()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry and now - entry[1] <= self.ttl:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+            row = self._db.execute(
+                "SELECT text, created FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                if row is not None:
+                    self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self._db.commit()
+                self._memory.pop(key, None)
+                self.misses += 1
+                return None
+
+            self._db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self._db.commit()
+            self._remember(key, row[0], row[1])
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, text: str, model: str = "", prompt: str = ""):
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, model, prompt, text, size, created, accessed) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, model, prompt, text, len(text.encode("utf-8")), now, now)
+            )
+            self._evict(now)
+            self._db.commit()
+            self._remember(key, text, now)
+
+    def _remember(self, key: str, text: str, created: float):
+        self._memory[key] = (text, created)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _evict(self, now: float):
+        # Drop expired entries, then the least recently used until under the size cap
+        self._db.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_disk_bytes:
+            return
+        for key, size in self._db.execute(
+            "SELECT key, size FROM responses ORDER BY accessed"
+        ).fetchall():
+            if total <= self.max_disk_bytes:
+                break
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._memory.pop(key, None)
+            total -= size
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "entries": entries}
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._db.execute("DELETE FROM responses")
+            self._db.commit()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> ResponseCache:
+    # Process-wide cache, opened on first use
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache()
+        return _cache
@@ -0,0 +1,332 @@
+# Shared scheduler for model requests
+#
+# Every call to the Gemini API (chat turns, multi-agent and batch turns, history
+# summaries) goes through one process-wide RequestScheduler, which
+#   - limits the request rate per model with a token bucket, so a burst of
+#     sessions queues briefly instead of running into the quota,
+#   - retries transient failures (429, 5xx, dropped connections) with jittered
+#     exponential backoff instead of showing the error to the user,
+#   - coalesces identical requests that are in flight at the same time: when
+#     several sessions send the same prompt with the same history and settings,
+#     one upstream call is made and every caller gets its response (streams are
+#     replayed from the start to late subscribers).
+# A caller can stop waiting by setting a cancel event; once every caller of a
+# request has left, a queued request is dropped and a stream is closed.
+# Calls run on a bounded thread pool. Queue depth, wait time, retries and
+# coalesced calls are exported through utils.metrics, and the latency and
+# outcome of recent attempts per model feed model routing (utils.model_router).
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor, wait
+from typing import Iterator, Optional
+import httpx
+from google.genai import errors
+from utils.metrics import get_registry, percentile
+
+DEFAULT_REQUESTS_PER_MINUTE = 60   # per model; DATACHAT_MODEL_RPM overrides, 0 disables
+BURST_SECONDS = 10                 # a full bucket holds this many seconds of requests
+MAX_CONCURRENT_CALLS = 16
+MAX_RETRIES = 4
+BACKOFF_BASE = 0.5                 # seconds
+BACKOFF_MAX = 8.0
+RETRY_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+RECENT_WAITS = 200
+RECENT_ATTEMPTS = 100              # per model, for model_health
+CANCEL_POLL = 0.1                  # seconds between checks of a caller's cancel event
+
+
+def is_transient(error: Exception) -> bool:
+    if isinstance(error, errors.APIError):
+        return error.code in RETRY_STATUS_CODES
+    return isinstance(error, httpx.TransportError)
+
+
+def backoff_delay(attempt: int) -> float:
+    # "Full jitter": uniform between 0 and the exponential bound
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def _plain(value):
+    # JSON-friendly form of request contents and configs, for coalescing keys
+    if hasattr(value, "model_dump"):
+        return value.model_dump(mode="json", exclude_none=True)
+    if isinstance(value, (list, tuple)):
+        return [_plain(item) for item in value]
+    return value
+
+
+def request_key(kind: str, model: str, contents, config) -> str:
+    payload = json.dumps([kind, model, _plain(contents), _plain(config)], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class TokenBucket:
+    def __init__(self, requests_per_minute: float, burst: Optional[float] = None):
+        self.rate = requests_per_minute / 60.0
+        self.capacity = burst if burst is not None else max(1.0, self.rate * BURST_SECONDS)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        # Take a token and return how long to wait before using it; tokens may go
+        # negative, so waiting callers are served in the order they arrived
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class _Call:
+    # One upstream request and everyone waiting for it. Responses (or stream
+    # chunks) are buffered so that every subscriber sees all of them.
+    def __init__(self, key: str, model: str):
+        self.key = key
+        self.model = model
+        self.items = []
+        self.done = False
+        self.error = None
+        self.submitted = time.perf_counter()
+        self.wait = 0.0
+        self.attempts = 0
+        self.subscribers = 1
+        self.waiting = 1        # subscribers that have not left yet
+        self.future = Future()
+        self._changed = threading.Condition()
+
+    def push(self, item):
+        with self._changed:
+            self.items.append(item)
+            self._changed.notify_all()
+
+    def close(self, error: Optional[Exception] = None):
+        with self._changed:
+            self.done = True
+            self.error = error
+            self._changed.notify_all()
+        if error is not None:
+            self.future.set_exception(error)
+        else:
+            self.future.set_result(self.items[-1] if self.items else None)
+
+    @property
+    def abandoned(self) -> bool:
+        return self.waiting <= 0
+
+    def result(self, cancel: Optional[threading.Event] = None):
+        if cancel is not None:
+            while not wait([self.future], timeout=CANCEL_POLL).done:
+                if cancel.is_set():
+                    raise CancelledError("model request cancelled")
+        return self.future.result()
+
+    def stream(self, cancel: Optional[threading.Event] = None) -> Iterator:
+        index = 0
+        while True:
+            with self._changed:
+                self._changed.wait_for(lambda: index < len(self.items) or self.done, CANCEL_POLL)
+                if cancel is not None and cancel.is_set():
+                    raise CancelledError("model request cancelled")
+                if index < len(self.items):
+                    item = self.items[index]
+                elif self.error is not None:
+                    raise self.error
+                elif self.done:
+                    return
+                else:
+                    continue
+            index += 1
+            yield item
+
+
+class RequestScheduler:
+    def __init__(self, requests_per_minute: Optional[float] = None, max_concurrent: int = MAX_CONCURRENT_CALLS,
+                 max_retries: int = MAX_RETRIES):
+        if requests_per_minute is None:
+            requests_per_minute = float(os.environ.get("DATACHAT_MODEL_RPM", DEFAULT_REQUESTS_PER_MINUTE))
+        self.requests_per_minute = requests_per_minute
+        self.max_retries = max_retries
+        self._buckets = {}      # model -> TokenBucket
+        self._inflight = {}     # request key -> _Call
+        self._queued = {}       # model -> calls waiting for a thread or a token
+        self._running = 0
+        self._coalesced = 0
+        self._retries = 0
+        self._waits = deque(maxlen=RECENT_WAITS)
+        self._attempts = {}     # model -> deque of (seconds, succeeded)
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix="model-call")
+
+    def _bucket(self, model: str) -> Optional[TokenBucket]:
+        if not self.requests_per_minute:
+            return None
+        with self._lock:
+            if model not in self._buckets:
+                self._buckets[model] = TokenBucket(self.requests_per_minute)
+            return self._buckets[model]
+
+    def _set_queue_gauges(self, model: str):
+        # Called with the lock held
+        registry = get_registry()
+        registry.set("datachat_model_queue_depth", self._queued.get(model, 0), model=model)
+        registry.set("datachat_model_in_flight", self._running)
+
+    def _submit(self, kind: str, model: str, contents, config, request) -> _Call:
+        # Join an identical in-flight call or start a new one
+        key = request_key(kind, model, contents, config)
+        with self._lock:
+            call = self._inflight.get(key)
+            if call is not None and not call.abandoned:
+                call.subscribers += 1
+                call.waiting += 1
+                self._coalesced += 1
+                get_registry().inc("datachat_model_coalesced_total", model=model)
+                return call
+            call = self._inflight[key] = _Call(key, model)
+            self._queued[model] = self._queued.get(model, 0) + 1
+            self._set_queue_gauges(model)
+        self._pool.submit(self._execute, call, request)
+        return call
+
+    def _execute(self, call: _Call, request):
+        registry = get_registry()
+        bucket = self._bucket(call.model)
+        started = False
+        try:
+            while True:
+                if bucket is not None:
+                    delay = bucket.reserve()
+                    if delay:
+                        time.sleep(delay)
+                if call.abandoned:
+                    raise CancelledError("model request cancelled")
+                if not started:
+                    started = True
+                    call.wait = time.perf_counter() - call.submitted
+                    registry.observe("datachat_model_wait_seconds", call.wait, model=call.model)
+                    with self._lock:
+                        self._queued[call.model] -= 1
+                        self._running += 1
+                        self._waits.append(call.wait)
+                        self._set_queue_gauges(call.model)
+                call.attempts += 1
+                attempt_start = time.perf_counter()
+                try:
+                    items = request()
+                    for item in items:
+                        call.push(item)
+                        if call.abandoned:
+                            # Nobody is reading the stream any more
+                            getattr(items, "close", lambda: None)()
+                            break
+                    self._record_attempt(call.model, time.perf_counter() - attempt_start, True)
+                    break
+                except Exception as e:
+                    if not call.abandoned:
+                        self._record_attempt(call.model, time.perf_counter() - attempt_start, False)
+                    # Only retry before anything was delivered to the callers
+                    if call.items or not is_transient(e) or call.attempts > self.max_retries:
+                        raise
+                    code = getattr(e, "code", type(e).__name__)
+                    registry.inc("datachat_model_retries_total", model=call.model, code=code)
+                    with self._lock:
+                        self._retries += 1
+                    time.sleep(backoff_delay(call.attempts - 1))
+            registry.inc("datachat_model_requests_total", model=call.model,
+                         outcome="cancelled" if call.abandoned else "ok")
+            error = None
+        except Exception as e:
+            registry.inc("datachat_model_requests_total", model=call.model,
+                         outcome="cancelled" if call.abandoned else "error")
+            error = e
+        finally:
+            with self._lock:
+                if self._inflight.get(call.key) is call:
+                    del self._inflight[call.key]
+                if started:
+                    self._running -= 1
+                else:
+                    self._queued[call.model] -= 1
+                self._set_queue_gauges(call.model)
+        call.close(error)
+
+    def _record_attempt(self, model: str, seconds: float, succeeded: bool):
+        with self._lock:
+            self._attempts.setdefault(model, deque(maxlen=RECENT_ATTEMPTS)).append((seconds, succeeded))
+
+    def model_health(self, model: str) -> dict:
+        # Recent upstream latency and error rate of a model
+        with self._lock:
+            attempts = list(self._attempts.get(model, ()))
+        latencies = [seconds for seconds, succeeded in attempts if succeeded]
+        return {
+            "attempts": len(attempts),
+            "samples": len(latencies),
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "error_rate": (len(attempts) - len(latencies)) / len(attempts) if attempts else 0.0,
+        }
+
+    def release(self, call: _Call, trace=None):
+        # Stop waiting for a call; its wait, retries and sharing go on the trace
+        with self._lock:
+            call.waiting -= 1
+        if trace is not None:
+            trace.add("model_wait", call.wait)
+            trace.record["retries"] = max(0, call.attempts - 1)
+            trace.record["coalesced"] = call.subscribers > 1
+
+    def submit(self, client, model: str, contents, config=None) -> _Call:
+        # Start (or join) a generate_content call; .future resolves to the response.
+        # Callers release() the call once they no longer wait for it.
+        return self._submit("generate", model, contents, config, lambda: [
+            client.models.generate_content(model=model, contents=contents, config=config)
+        ])
+
+    def generate(self, client, model: str, contents, config=None, trace=None,
+                 cancel: Optional[threading.Event] = None):
+        call = self.submit(client, model, contents, config)
+        try:
+            return call.result(cancel)
+        finally:
+            self.release(call, trace)
+
+    def generate_stream(self, client, model: str, contents, config=None, trace=None,
+                        cancel: Optional[threading.Event] = None) -> Iterator:
+        call = self._submit("stream", model, contents, config, lambda: client.models.generate_content_stream(
+            model=model, contents=contents, config=config
+        ))
+        try:
+            yield from call.stream(cancel)
+        finally:
+            self.release(call, trace)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "queued": sum(self._queued.values()),
+                "running": self._running,
+                "coalesced": self._coalesced,
+                "retries": self._retries,
+                "wait_p95": percentile(list(self._waits), 95),
+            }
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> RequestScheduler:
+    # Process-wide scheduler, created on first use
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = RequestScheduler()
+        return _scheduler
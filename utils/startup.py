@@ -0,0 +1,164 @@
+# Server start-up: prewarm and cold-start timings
+#
+# A fresh server process used to pay for everything on its first page load and
+# first turn: importing google.genai and pandas, spawning the sandbox workers
+# (which import pandas and matplotlib, build the matplotlib font cache and load
+# the dataset), profiling the dataset and the TLS handshake to the API. The
+# prewarm does all of it once per process in a background thread, as soon as
+# the server starts (serve.py) or, under a plain `streamlit run`, on the first
+# page load. The time of each step, the import time of each heavy module and
+# the time from process start to the first page and the first answer are
+# logged, exported as metrics, and /ready answers 503 until the prewarm is done.
+import importlib
+import os
+import sys
+import threading
+import time
+from typing import Callable, Optional
+
+try:
+    import psutil
+except ImportError:
+    # Without psutil, times are counted from the first import of this module
+    psutil = None
+
+# Modules the first page and the first turn need, in import order
+PREWARM_MODULES = ("pandas", "google.genai", "utils.profiler", "utils.turn_engine", "utils.multi_agent",
+                   "utils.context_window")
+CONNECTION_MODEL = "models/gemini-2.0-flash"  # looked up to open the API connection pool
+EXECUTOR_READY_TIMEOUT = 120                   # seconds
+
+
+def _process_start() -> float:
+    if psutil is not None:
+        try:
+            return psutil.Process(os.getpid()).create_time()
+        except psutil.Error:
+            pass
+    return time.time()
+
+
+class StartupReport:
+    def __init__(self):
+        self.process_start = _process_start()
+        self.stages = {}      # prewarm step -> seconds
+        self.imports = {}     # module -> seconds, for modules not already loaded
+        self.events = {}      # first_page, first_response, ready -> seconds since process start
+        self.errors = {}      # prewarm step -> error message
+        self.ready = threading.Event()
+        self._lock = threading.Lock()
+
+    def since_start(self) -> float:
+        return time.time() - self.process_start
+
+    def mark(self, event: str):
+        # Record the first occurrence of an event in this process
+        from utils.metrics import get_registry, log_record
+        with self._lock:
+            if event in self.events:
+                return
+            self.events[event] = self.since_start()
+        get_registry().set("datachat_cold_start_seconds", self.events[event], event=event)
+        log_record({"event": event, "seconds": self.events[event], "pid": os.getpid()})
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"stages": dict(self.stages), "imports": dict(self.imports), "events": dict(self.events),
+                    "errors": dict(self.errors), "ready": self.ready.is_set()}
+
+
+def _timed_imports(report: StartupReport):
+    from utils.metrics import get_registry
+    for name in PREWARM_MODULES:
+        if name in sys.modules:
+            continue
+        start_time = time.perf_counter()
+        importlib.import_module(name)
+        report.imports[name] = time.perf_counter() - start_time
+        get_registry().set("datachat_import_seconds", report.imports[name], module=name)
+
+
+def _load_dataset(dataset: str):
+    from utils.dataset import load_dataset
+    from utils.profiler import get_profile
+    from utils.query_engine import get_engine, is_large
+    if is_large(dataset):
+        get_engine(dataset)
+    else:
+        load_dataset(dataset)
+    get_profile(dataset)
+
+
+def _open_connection(client):
+    # Any cheap authenticated request opens the pooled connection and its TLS session
+    client.models.get(model=CONNECTION_MODEL)
+
+
+def app_settings():
+    # (active dataset, API client or None for the fake model), as the chat page picks them
+    from utils.chat_manager import get_client
+    from utils.config_service import get_config_service
+    from utils.dataset_registry import get_dataset_registry
+    from utils.fake_model import use_fake_model
+    api_key = get_config_service().snapshot.api_key
+    return get_dataset_registry().default_path(), None if use_fake_model(api_key) else get_client(api_key)
+
+
+def prewarm(report: StartupReport, dataset: Optional[str] = None, client=None, from_settings: bool = False):
+    # Warm everything a first turn needs; a failed step is recorded, not raised
+    from utils.metrics import get_registry, log_record
+
+    def step(name: str, run: Callable):
+        start_time = time.perf_counter()
+        try:
+            return run()
+        except Exception as e:
+            report.errors[name] = f"{type(e).__name__}: {e}"[:500]
+        finally:
+            report.stages[name] = time.perf_counter() - start_time
+            get_registry().set("datachat_startup_seconds", report.stages[name], stage=name)
+
+    step("imports", lambda: _timed_imports(report))
+    if from_settings:
+        dataset, client = step("settings", app_settings) or (None, None)
+    from utils.executor import get_executor
+    executor = step("executor", lambda: get_executor(dataset))
+    if dataset:
+        step("dataset", lambda: _load_dataset(dataset))
+    if client is not None:
+        step("connection", lambda: _open_connection(client))
+    if executor is not None:
+        step("executor_ready", lambda: executor.wait_ready(EXECUTOR_READY_TIMEOUT))
+    report.ready.set()
+    report.mark("ready")
+    log_record(dict(report.snapshot(), event="prewarm", pid=os.getpid()))
+
+
+_report = None
+_report_lock = threading.Lock()
+
+
+def get_startup_report() -> StartupReport:
+    # Process-wide report, created on first use
+    global _report
+    with _report_lock:
+        if _report is None:
+            _report = StartupReport()
+        return _report
+
+
+_prewarm_thread = None
+
+
+def start_prewarm(dataset: Optional[str] = None, client=None, from_settings: bool = False) -> StartupReport:
+    # Start the prewarm in a daemon thread, once per process. from_settings
+    # looks the dataset and client up the way the chat page does, for a server
+    # that has not served a page yet.
+    global _prewarm_thread
+    report = get_startup_report()
+    with _report_lock:
+        if _prewarm_thread is None:
+            _prewarm_thread = threading.Thread(target=prewarm, args=(report, dataset, client, from_settings),
+                                               name="prewarm", daemon=True)
+            _prewarm_thread.start()
+    return report
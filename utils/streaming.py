@@ -0,0 +1,178 @@
+# Incremental parsing of streamed JSON responses
+#
+# When a response schema is set, Gemini streams a single JSON object such as
+# {"code": "...", "explanation": "..."}. The object is only valid JSON once the
+# stream is complete, so json.loads cannot be used to show the explanation as
+# it arrives. StreamingJSONParser scans the chunks once, character by character,
+# and keeps the (possibly partial) value of every top-level string field.
+from typing import Callable, Dict, Iterable, Optional, Set
+
+_ESCAPES = {
+    '"': '"',
+    '\\': '\\',
+    '/': '/',
+    'b': '\b',
+    'f': '\f',
+    'n': '\n',
+    'r': '\r',
+    't': '\t',
+}
+
+
+class StreamingJSONParser:
+    # Parser states
+    _START = 0          # before the opening '{'
+    _KEY_WAIT = 1       # waiting for a key (or '}')
+    _KEY = 2            # inside a key string
+    _COLON = 3          # waiting for ':'
+    _VALUE_WAIT = 4     # waiting for the start of a value
+    _STRING = 5         # inside a top-level string value
+    _OTHER = 6          # inside a non-string value (number, object, list, ...)
+    _NEXT = 7           # after a value, waiting for ',' or '}'
+    _DONE = 8           # closing '}' seen
+
+    def __init__(self):
+        self.fields: Dict[str, str] = {}
+        self._state = self._START
+        self._key = []
+        self._value = []
+        self._escape = False
+        self._unicode: Optional[str] = None
+        self._high_surrogate: Optional[int] = None  # first half of an escaped surrogate pair
+        self._depth = 0
+        self._nested_string = False
+
+    @property
+    def done(self) -> bool:
+        return self._state == self._DONE
+
+    def get(self, field: str, default: str = "") -> str:
+        # Return the current value of a field, including a partial one
+        if self._state == self._STRING and ''.join(self._key) == field:
+            return ''.join(self._value)
+        return self.fields.get(field, default)
+
+    def feed(self, chunk: str) -> Set[str]:
+        # Consume a chunk and return the names of the fields that changed
+        changed = set()
+        for char in chunk:
+            if self._state == self._STRING:
+                if self._read_string_char(char, self._value):
+                    self.fields[''.join(self._key)] = ''.join(self._value)
+                    self._state = self._NEXT
+                changed.add(''.join(self._key))
+            elif self._state == self._KEY:
+                if self._read_string_char(char, self._key):
+                    self._state = self._COLON
+            elif self._state == self._OTHER:
+                self._read_other_char(char)
+            elif char.isspace():
+                continue
+            elif self._state == self._START:
+                if char == '{':
+                    self._state = self._KEY_WAIT
+            elif self._state == self._KEY_WAIT:
+                if char == '"':
+                    self._key = []
+                    self._state = self._KEY
+                elif char == '}':
+                    self._state = self._DONE
+            elif self._state == self._COLON:
+                if char == ':':
+                    self._state = self._VALUE_WAIT
+            elif self._state == self._VALUE_WAIT:
+                if char == '"':
+                    self._value = []
+                    self._state = self._STRING
+                else:
+                    self._depth = 0
+                    self._nested_string = False
+                    self._state = self._OTHER
+                    self._read_other_char(char)
+            elif self._state == self._NEXT:
+                if char == ',':
+                    self._state = self._KEY_WAIT
+                elif char == '}':
+                    self._state = self._DONE
+        return changed
+
+    def _read_string_char(self, char: str, target: list) -> bool:
+        # Append a decoded character to target; return True on the closing quote
+        if self._unicode is not None:
+            self._unicode += char
+            if len(self._unicode) == 4:
+                try:
+                    self._append_code_unit(int(self._unicode, 16), target)
+                except ValueError:
+                    pass
+                self._unicode = None
+            return False
+        if self._escape:
+            self._escape = False
+            if char == 'u':
+                self._unicode = ""
+            else:
+                self._flush_surrogate(target)
+                target.append(_ESCAPES.get(char, char))
+            return False
+        if char == '\\':
+            self._escape = True
+            return False
+        self._flush_surrogate(target)
+        if char == '"':
+            return True
+        target.append(char)
+        return False
+
+    def _append_code_unit(self, code: int, target: list):
+        # Characters outside the BMP arrive as an escaped surrogate pair
+        # (e.g. "\ud83d\ude00"); lone surrogates cannot be sent to the
+        # browser, so they become U+FFFD
+        if 0xD800 <= code <= 0xDBFF:
+            self._flush_surrogate(target)
+            self._high_surrogate = code
+        elif 0xDC00 <= code <= 0xDFFF and self._high_surrogate is not None:
+            target.append(chr(0x10000 + ((self._high_surrogate - 0xD800) << 10) + (code - 0xDC00)))
+            self._high_surrogate = None
+        else:
+            self._flush_surrogate(target)
+            target.append('\ufffd' if 0xDC00 <= code <= 0xDFFF else chr(code))
+
+    def _flush_surrogate(self, target: list):
+        if self._high_surrogate is not None:
+            target.append('\ufffd')
+            self._high_surrogate = None
+
+    def _read_other_char(self, char: str):
+        # Skip over non-string values, tracking nesting and embedded strings
+        if self._nested_string:
+            if self._escape:
+                self._escape = False
+            elif char == '\\':
+                self._escape = True
+            elif char == '"':
+                self._nested_string = False
+            return
+        if char == '"':
+            self._nested_string = True
+        elif char in '[{':
+            self._depth += 1
+        elif char in ']}':
+            if self._depth == 0:
+                # The closing brace of the top-level object
+                self._state = self._DONE
+            else:
+                self._depth -= 1
+        elif char == ',' and self._depth == 0:
+            self._state = self._KEY_WAIT
+
+
+def stream_text(chunks: Iterable, on_chunk: Optional[Callable] = None) -> Iterable[str]:
+    # Yield the text of each streamed response chunk, skipping empty ones;
+    # on_chunk sees every raw chunk (e.g. to read its usage metadata)
+    for chunk in chunks:
+        if on_chunk is not None:
+            on_chunk(chunk)
+        text = getattr(chunk, "text", None)
+        if text:
+            yield text
@@ -0,0 +1,311 @@
+# Turn pipeline shared by the chat, multi-agent mode and the batch runner
+#
+# One turn is: agent persona + dataset profile -> model call (through the
+# response cache and the request scheduler) -> JSON parse of the structured
+# answer -> execution of the generated code in the sandbox pool (through the
+# execution cache) -> chart capture. answer_turn runs those steps for every
+# caller; only the way the model is asked differs (a _ModelStep): one request
+# with explicit contents for an agent of a multi-agent or batch turn
+# (run_turn), the session's live chat (run_chat_turn) or model routing. It
+# makes no Streamlit calls and returns a plain dict with the answer, the
+# rendered charts and the turn's trace, so it can run in a background thread or
+# a script as well as in the app. It stops early when its cancel event is set.
+import asyncio
+import json
+import threading
+import time
+from concurrent.futures import CancelledError
+from typing import Callable, Optional
+from google import genai
+from google.genai import types
+from utils.blob_store import put_chart
+from utils.chat_manager import build_config, build_history, record_turn, send_message, send_message_stream
+from utils.executor import get_executor
+from utils.metrics import TurnTrace, add_exec_timings
+from utils.model_router import ROUTED_MODEL, choose_route, generate_hedged
+from utils.response_cache import get_response_cache, make_key
+from utils.scheduler import get_scheduler
+from utils.streaming import StreamingJSONParser, stream_text
+
+CANCEL_POLL = 0.1  # seconds
+
+
+class TurnCancelled(Exception):
+    pass
+
+
+def clean_code(code: str) -> str:
+    # Remove any .show() calls from the code as they don't work in Streamlit
+    return code.replace('.show()', '')
+
+
+def parse_answer(response_text: str, schema: dict) -> dict:
+    # Explanation and code of a model answer; free text without a response schema
+    if not schema:
+        return {"explanation": response_text, "code": ""}
+    response_dict = json.loads(response_text)
+    return {"explanation": response_dict.get("explanation", ""), "code": response_dict.get("code", "")}
+
+
+def wait_for_exec(job, cancel: Optional[threading.Event] = None) -> dict:
+    # Result of an executor job; setting cancel kills the job's worker
+    while True:
+        try:
+            return job.result(timeout=CANCEL_POLL)
+        except TimeoutError:
+            if cancel is not None and cancel.is_set():
+                job.cancel()
+                raise TurnCancelled()
+
+
+def _valid(response_text: str, schema: dict) -> bool:
+    try:
+        parse_answer(response_text, schema)
+        return True
+    except (ValueError, TypeError):
+        return False
+
+
+def _run_code(answer: dict, dataset: str, use_cache: bool, trace: TurnTrace, cancel: Optional[threading.Event],
+              progress: Callable, store_charts: bool):
+    # Execute the code in the sandboxed worker pool with the dataset preloaded as df
+    if cancel is not None and cancel.is_set():
+        raise TurnCancelled()
+    progress(status="Running the code...")
+    with trace.span("exec"):
+        job = get_executor(dataset).submit(clean_code(answer["code"]), dataset=dataset,
+                                           explanation=answer["explanation"], use_cache=use_cache)
+        result = wait_for_exec(job, cancel)
+    add_exec_timings(trace, result)
+    answer["charts"] = result["charts"]
+    answer["stdout"] = result["stdout"]
+    answer["error"] = result["error"]
+    answer["exec_cached"] = result.get("cached", False)
+    if store_charts:
+        with trace.span("chart_store"):
+            # Stored once in the blob store; messages keep only the references
+            answer["chart_refs"] = [put_chart(chart) for chart in result["charts"]]
+
+
+class _ModelStep:
+    # How a turn gets its answer from the model. answer_turn looks the answer up
+    # in the response cache under cache_model, calls ask on a miss and caches the
+    # final answer under model.
+    def __init__(self, model: str):
+        self.model = model
+        self.cache_model = model
+
+    def ask(self, answer: dict, trace: TurnTrace, cancel: Optional[threading.Event], progress: Callable) -> str:
+        raise NotImplementedError
+
+    def escalate(self, answer: dict, trace: TurnTrace, progress: Callable) -> bool:
+        # The answer's code failed; return True to ask again
+        return False
+
+    def accept(self):
+        # The answer that was asked for is the turn's final answer
+        pass
+
+
+class _ContentsStep(_ModelStep):
+    # One request with the given history, for an agent of a multi-agent or batch turn
+    def __init__(self, client: genai.Client, model: str, contents: list, config: types.GenerateContentConfig):
+        super().__init__(model)
+        self.client = client
+        self.contents = contents
+        self.config = config
+
+    def ask(self, answer, trace, cancel, progress):
+        with trace.span("model"):
+            response = get_scheduler().generate(self.client, self.model, self.contents, self.config,
+                                                trace=trace, cancel=cancel)
+        trace.add_usage(response.usage_metadata)
+        return response.text
+
+
+class _ChatStep(_ModelStep):
+    # The next message on the session's live chat, streamed or not
+    def __init__(self, client: genai.Client, chat_session: dict, prompt: str, schema: dict, stream: bool):
+        super().__init__(chat_session["model"])
+        self.client = client
+        self.chat_session = chat_session
+        self.prompt = prompt
+        self.schema = schema
+        self.stream = stream
+
+    def ask(self, answer, trace, cancel, progress):
+        with trace.span("model"):
+            if not self.stream:
+                response = send_message(self.client, self.prompt, trace, session=self.chat_session, cancel=cancel)
+                trace.add_usage(response.usage_metadata)
+                return response.text
+            # Show the explanation as it arrives, parse the full JSON at the end
+            parser = StreamingJSONParser()
+            response_text = ""
+            for text in stream_text(send_message_stream(self.client, self.prompt, trace, session=self.chat_session,
+                                                        cancel=cancel),
+                                    on_chunk=lambda chunk: trace.add_usage(chunk.usage_metadata)):
+                trace.first_token()
+                response_text += text
+                if not self.schema:
+                    progress(explanation=response_text)
+                elif 'explanation' in parser.feed(text):
+                    progress(explanation=parser.get('explanation'))
+            return response_text
+
+
+class _RoutedStep(_ModelStep):
+    # Routing mode (see utils.model_router): ask the model chosen for the
+    # question, hedged, and ask once more on the strong tier if that fails or
+    # the answer's code fails. The final answer is recorded on the live chat.
+    def __init__(self, client: genai.Client, chat_session: dict, prompt: str, schema: dict):
+        super().__init__(ROUTED_MODEL)
+        self.client = client
+        self.chat_session = chat_session
+        self.prompt = prompt
+        self.schema = schema
+        self.user_content = types.Content(role="user", parts=[types.Part(text=prompt)])
+        self.route = choose_route(prompt)
+        self.tried = []
+        self.response = None
+
+    def ask(self, answer, trace, cancel, progress):
+        contents = self.chat_session["chat"].get_history(curated=True) + [self.user_content]
+        while True:
+            progress(status=f"Asking {self.route.model}...")
+            try:
+                with trace.span("model"):
+                    model, response, hedged = generate_hedged(
+                        self.client, self.route, contents, self.chat_session["config"],
+                        validate=lambda response: _valid(response.text, self.schema), trace=trace, cancel=cancel
+                    )
+            except CancelledError:
+                raise
+            except Exception as e:
+                if self.route.reason == "escalated":
+                    raise
+                self.tried += [self.route.model] + ([self.route.backup] if self.route.backup else [])
+                self.route = choose_route(self.prompt, escalate=True, exclude=self.tried)
+                trace.record["error"] = None
+                answer["escalated_after"] = f"{type(e).__name__}: {e}"[:200]
+                continue
+            trace.add_usage(response.usage_metadata)
+            answer["routing"] = trace.record["routing"] = {
+                "model": model, "tier": self.route.tier, "reason": self.route.reason, "hedged": hedged
+            }
+            trace.record["model"] = self.model = model
+            self.response = response
+            return response.text
+
+    def escalate(self, answer, trace, progress):
+        if self.route.reason == "escalated":
+            return False
+        # Let a stronger model try
+        self.tried.append(self.model)
+        answer["escalated_after"] = answer["error"][:200]
+        self.route = choose_route(self.prompt, escalate=True, exclude=self.tried)
+        trace.record["error"] = None
+        progress(explanation="", status="The code failed, asking a stronger model...")
+        return True
+
+    def accept(self):
+        if self.response is not None:
+            content = self.response.candidates[0].content if self.response.candidates else None
+            record_turn(self.chat_session["chat"], self.user_content, [content] if content else [])
+
+
+def answer_turn(step: _ModelStep, system_instruction: str, schema: dict, prompt: str, history: list,
+                dataset: str, dataset_hash: str, trace: TurnTrace, use_cache: bool = True,
+                progress: Optional[Callable] = None, cancel: Optional[threading.Event] = None,
+                store_charts: bool = False) -> dict:
+    # The turn pipeline: response cache -> model (step) -> parse -> code
+    # execution. progress(explanation=..., status=...) is called as the answer
+    # arrives and the code runs; with store_charts the charts also go to the
+    # blob store ("chart_refs"). Errors and cancellation are returned in
+    # "failed" and "cancelled", not raised.
+    start_time = time.perf_counter()
+    progress = progress or (lambda **values: None)
+    answer = {"explanation": "", "code": "", "charts": [], "stdout": "", "error": None,
+              "cached": False, "exec_cached": False, "failed": None, "cancelled": False, "chart_refs": [],
+              "routing": None}
+    try:
+        cache = get_response_cache()
+        with trace.span("cache_lookup"):
+            cache_key = make_key(step.cache_model, system_instruction, schema, dataset_hash, prompt, history)
+            response_text = cache.get(cache_key) if use_cache else None
+        if response_text is not None:
+            answer["cached"] = trace.record["cached"] = True
+        while True:
+            if response_text is None:
+                response_text = step.ask(answer, trace, cancel, progress)
+            answer["model_latency"] = time.perf_counter() - start_time
+            with trace.span("parse"):
+                answer.update(parse_answer(response_text, schema))
+            progress(explanation=answer["explanation"])
+            answer["error"] = None
+            if answer["code"]:
+                _run_code(answer, dataset, use_cache, trace, cancel, progress, store_charts)
+            if answer["error"] and not answer["cached"] and step.escalate(answer, trace, progress):
+                response_text = None
+                continue
+            break
+        if not answer["cached"]:
+            step.accept()
+            # Only answers that parse are cached, so a truncated one is asked again
+            cache.put(cache_key, response_text, model=step.model, prompt=prompt)
+    except (TurnCancelled, CancelledError):
+        trace.fail("turn", "cancelled")
+        answer["cancelled"] = True
+    except Exception as e:
+        trace.fail("turn", e)
+        answer["failed"] = str(e)
+    answer["latency"] = time.perf_counter() - start_time
+    answer["trace"] = trace.finish()
+    return answer
+
+
+async def run_turn(client: genai.Client, model: str, agent: dict, system_instruction: str,
+                   prompt: str, history: list, dataset: str, dataset_hash: str, use_cache: bool = True,
+                   session_id: str = "", context: Optional[list] = None, mode: str = "multi") -> dict:
+    # One agent's answer, with its code executed; errors are returned in
+    # "error", not raised. context is the windowed history to send (see
+    # utils.context_window); the full history is used when it is not given.
+    # answer_turn runs on a thread so the agents of a turn overlap; cancelling
+    # the awaiting task stops it.
+    trace = TurnTrace(session_id, model, agent=agent["name"], mode=mode)
+    schema = agent.get("response-schema", {})
+    contents = ((build_history(history) if context is None else context)
+                + [types.Content(role="user", parts=[types.Part(text=prompt)])])
+    step = _ContentsStep(client, model, contents, build_config(system_instruction, schema))
+    cancel = threading.Event()
+    try:
+        answer = await asyncio.to_thread(answer_turn, step, system_instruction, schema, prompt, history, dataset,
+                                         dataset_hash, trace, use_cache=use_cache, cancel=cancel)
+    except asyncio.CancelledError:
+        cancel.set()
+        raise
+    if answer["failed"]:
+        answer["error"] = f"Error generating response: {answer['failed']}"
+    result = {"name": agent["name"]}
+    for key in ("explanation", "code", "charts", "stdout", "error", "cached", "exec_cached", "model_latency",
+                "latency", "trace"):
+        if key in answer:
+            result[key] = answer[key]
+    return result
+
+
+def run_chat_turn(client: genai.Client, chat_session: dict, agent_name: str, system_instruction: str,
+                  schema: dict, prompt: str, history: list, dataset: str, dataset_hash: str,
+                  use_cache: bool = True, stream: bool = True, session_id: str = "",
+                  progress: Optional[Callable] = None, cancel: Optional[threading.Event] = None,
+                  trace: Optional[TurnTrace] = None, routing: bool = False) -> dict:
+    # A single-agent chat turn on the session's live chat (see
+    # chat_manager.get_chat_session). With routing the model is picked per turn
+    # instead of using the chat's model. Charts are stored in the blob store.
+    trace = trace or TurnTrace(session_id, chat_session["model"], agent=agent_name)
+    if routing:
+        step = _RoutedStep(client, chat_session, prompt, schema)
+    else:
+        step = _ChatStep(client, chat_session, prompt, schema, stream)
+    return answer_turn(step, system_instruction, schema, prompt, history, dataset, dataset_hash, trace,
+                       use_cache=use_cache, progress=progress, cancel=cancel, store_charts=True)
@@ -0,0 +1,119 @@
+# Background queue for chat turns
+#
+# A turn (model call, parsing, code execution) used to run inside the session's
+# script, which blocked the page until it finished. Turns now run on a small
+# process-wide thread pool instead: the script submits a TurnJob and returns at
+# once, and the chat page polls the job from an auto-refreshing fragment that
+# shows its progress and a Stop button. When the turn finishes, its on_done
+# callback attaches the answer to the message list of the session that asked,
+# whichever page that session is looking at by then.
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Optional
+
+TURN_WORKERS = 8
+
+# Job states
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+class TurnJob:
+    def __init__(self, session_id: str, prompt: str):
+        self.id = uuid.uuid4().hex[:12]
+        self.session_id = session_id
+        self.prompt = prompt
+        self.status = QUEUED
+        self.progress = {}       # latest values reported by the turn, e.g. the explanation so far
+        self.result = None
+        self.error = None
+        self.submitted = time.time()
+        self.cancel_event = threading.Event()
+        self.future = Future()
+
+    def update(self, **values):
+        # Replace rather than mutate, so readers always see a consistent dict
+        self.progress = dict(self.progress, **values)
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_event.is_set()
+
+    def done(self) -> bool:
+        return self.future.done()
+
+    def elapsed(self) -> float:
+        return time.time() - self.submitted
+
+
+class TurnQueue:
+    def __init__(self, workers: int = TURN_WORKERS):
+        self._jobs = {}     # job id -> unfinished TurnJob
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="turn")
+
+    def submit(self, session_id: str, prompt: str, work: Callable,
+               on_done: Optional[Callable] = None) -> TurnJob:
+        # work(job) returns the turn's result; on_done(job) runs after it, also
+        # for failed and cancelled jobs
+        job = TurnJob(session_id, prompt)
+        with self._lock:
+            self._jobs[job.id] = job
+        self._pool.submit(self._run, job, work, on_done)
+        return job
+
+    def _run(self, job: TurnJob, work: Callable, on_done: Optional[Callable]):
+        try:
+            if job.cancelled:
+                job.status = CANCELLED
+            else:
+                job.status = RUNNING
+                try:
+                    job.result = work(job)
+                    job.status = DONE
+                except Exception as e:
+                    if job.cancelled:
+                        job.status = CANCELLED
+                    else:
+                        job.error = f"{type(e).__name__}: {e}"
+                        job.status = FAILED
+            if on_done is not None:
+                try:
+                    on_done(job)
+                except Exception as e:
+                    job.error = job.error or f"{type(e).__name__}: {e}"
+                    job.status = FAILED
+        finally:
+            with self._lock:
+                self._jobs.pop(job.id, None)
+            job.future.set_result(job)
+
+    def jobs(self, session_id: Optional[str] = None) -> list:
+        with self._lock:
+            return [job for job in self._jobs.values() if session_id is None or job.session_id == session_id]
+
+    def stats(self) -> dict:
+        jobs = self.jobs()
+        return {"queued": sum(1 for job in jobs if job.status == QUEUED),
+                "running": sum(1 for job in jobs if job.status == RUNNING)}
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_turn_queue() -> TurnQueue:
+    # Process-wide queue, created on first use
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = TurnQueue()
+        return _queue